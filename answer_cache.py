@@ -0,0 +1,129 @@
+"""Semantic answer cache in front of the LLM for repeated FAQ questions.
+Questions are normalised (case, ё, punctuation, spacing) and matched per language:
+first exactly, then by Jaccard similarity of character 3-gram shingles against
+candidates that share a word (inverted index). A near match must also agree on
+numbers and content words (compared by their first 3 letters, so inflection and
+a typo past them still match): "бар у бассейна ночью" is not "бар у бассейна". Entries carry the prompt/model
+fingerprint; a new fingerprint empties the cache. Only context-free questions
+should be looked up — the caller decides (see main._ask).
+"""
+import os
+import re
+import threading
+
+import cache
+
+TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX", "500"))
+THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.8"))
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+_DIGITS = re.compile(r"\d+")
+# answers to these depend on the moment they were asked ("are you open now?")
+_TIME_WORDS = frozenset(("сейчас", "сегодня", "завтра", "вчера", "щас", "now", "today", "tonight",
+                         "tomorrow", "yesterday", "қазір", "бүгін", "ертең", "кеше"))
+# words that don't change the question; anything else of 3+ letters is a content word
+_STOP = frozenset((
+    "вас", "вам", "ваш", "есть", "можно", "как", "что", "это", "там", "для", "или", "какой", "какая", "какие",
+    "скажите", "подскажите", "пожалуйста", "плиз", "привет", "здравствуйте",
+    "сіз", "сіздер", "сіздерде", "бар", "қандай", "айтыңызшы", "сәлем",
+    "the", "you", "are", "and", "can", "does", "your", "what", "for", "with", "there", "please", "hello", "any",
+))
+
+
+def normalise(text):
+    t = _NON_WORD.sub(" ", text.lower().replace("ё", "е"))
+    return _SPACES.sub(" ", t).strip()
+
+
+def shingles(norm, n=3):
+    padded = f" {norm} "
+    return frozenset(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def stems(norm):
+    """Content words of a normalised question, cut to 3 letters."""
+    return frozenset(w[:3] for w in norm.split() if len(w) >= 3 and w not in _STOP and not w.isdigit())
+
+
+def cacheable(norm):
+    """Short, time-independent questions only."""
+    words = norm.split()
+    return 0 < len(words) <= 20 and not _TIME_WORDS.intersection(words)
+
+
+class AnswerCache:
+    def __init__(self, fingerprint=None, maxsize=MAX_ENTRIES, ttl=TTL, threshold=THRESHOLD):
+        self.fingerprint = fingerprint
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._index = {}                                 # (lang, word) -> {keys}
+        self._entries = cache.TTLCache(maxsize, ttl, on_evict=self._unindex)
+        self.lookups = self.exact_hits = self.near_hits = self.stores = self.invalidations = 0
+
+    def _unindex(self, key, _value):
+        lang, norm = key
+        for w in set(norm.split()):
+            keys = self._index.get((lang, w))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(lang, w)]
+
+    def set_fingerprint(self, fingerprint):
+        """Drop everything when the system prompt or model changes."""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            self.fingerprint = fingerprint
+            self._entries.clear()
+            self._index.clear()
+            self.invalidations += 1
+
+    def lookup(self, question, lang):
+        norm = normalise(question)
+        if not cacheable(norm):
+            return None
+        with self._lock:
+            self.lookups += 1
+            hit = self._entries.get((lang, norm))
+            if hit is not None:
+                self.exact_hits += 1
+                return hit[2]
+            sh, st, digits = shingles(norm), stems(norm), _DIGITS.findall(norm)
+            best, best_score = None, self.threshold
+            candidates = set()
+            for w in set(norm.split()):
+                candidates |= self._index.get((lang, w), set())
+            for key in candidates:
+                entry = self._entries.get(key)
+                if entry is None or _DIGITS.findall(key[1]) != digits:   # "на 5" must not match "на 10"
+                    continue
+                if entry[1] != st:                      # an added / missing qualifier is another question
+                    continue
+                score = len(sh & entry[0]) / len(sh | entry[0])
+                if score >= best_score:
+                    best, best_score = entry[2], score
+            if best is not None:
+                self.near_hits += 1
+            return best
+
+    def store(self, question, lang, answer):
+        norm = normalise(question)
+        if not cacheable(norm):
+            return
+        key = (lang, norm)
+        with self._lock:
+            self._entries.set(key, (shingles(norm), stems(norm), answer))
+            for w in set(norm.split()):
+                self._index.setdefault((lang, w), set()).add(key)
+            self.stores += 1
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.near_hits
+            return {"size": len(self._entries), "lookups": self.lookups, "exact_hits": self.exact_hits,
+                    "near_hits": self.near_hits, "hit_rate": round(hits / self.lookups, 3) if self.lookups else 0.0,
+                    "stores": self.stores, "invalidations": self.invalidations}
+
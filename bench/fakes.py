@@ -0,0 +1,159 @@
+"""Local stand-ins for the bot's providers, for benchmarks and load tests.
+GreenAPIStub records every send (so a driver can wait for the reply to a given
+chat) and takes uploadFile; OpenRouterStub answers chat completions, plain or
+SSE-streamed; FileStub serves an image over GET, like the origin of a file we
+send by URL. All take a latency (seconds) and an error rate (share of requests
+answered 500).
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _Stub:
+    def __init__(self, latency=0.0, error_rate=0.0, jitter=0.0):
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.requests = self.errors = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"            # keep-alive, like the real providers
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if "json" in (self.headers.get("Content-Type") or "json"):
+                    body = json.loads(body or b"{}")
+                stub._serve(self, body)
+
+            def do_GET(self):
+                stub._serve(self, None)
+
+            def log_message(self, *a):
+                pass
+
+        self.server = _Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _serve(self, h, body):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        with self._lock:
+            self.requests += 1
+            fail = random.random() < self.error_rate
+            self.errors += fail
+        if fail:
+            return _reply(h, 500, {"error": "stub failure"})
+        self.handle(h, body)
+
+    def handle(self, h, body):
+        raise NotImplementedError
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _reply(h, status, obj):
+    data = json.dumps(obj).encode()
+    h.send_response(status)
+    h.send_header("Content-Type", "application/json")
+    h.send_header("Content-Length", str(len(data)))
+    h.end_headers()
+    h.wfile.write(data)
+
+
+class GreenAPIStub(_Stub):
+    """POST /waInstance{id}/sendMessage|sendFileByUrl|uploadFile/{token}; set main.GREEN_HOST to .url.
+    sendFileByUrl with a URL that isn't one of our uploads first "downloads" it (fetch_latency)."""
+    def __init__(self, fetch_latency=0.0, **kw):
+        super().__init__(**kw)
+        self.fetch_latency = fetch_latency
+        self.sent = []                                # (monotonic time, chatId, text or caption)
+        self.uploads = self.fetches = 0
+        self._cv = threading.Condition()
+
+    def handle(self, h, body):
+        if "/uploadFile/" in h.path:
+            with self._cv:
+                self.uploads += 1
+                n = self.uploads
+            return _reply(h, 200, {"urlFile": f"{self.url}/media/{n}/{h.headers.get('GA-Filename', 'file')}"})
+        if "/sendFileByUrl/" in h.path and not body.get("urlFile", "").startswith(self.url):
+            with self._cv:
+                self.fetches += 1
+            time.sleep(self.fetch_latency)
+        with self._cv:
+            self.sent.append((time.monotonic(), body.get("chatId"), body.get("message", body.get("caption", ""))))
+            self._cv.notify_all()
+        _reply(h, 200, {"idMessage": f"stub-{len(self.sent)}"})
+
+    def mark(self):
+        with self._cv:
+            return len(self.sent)
+
+    def wait_for(self, chat_id, since, timeout=30.0):
+        """Time of the first send to chat_id after index `since` (see mark()), or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cv:
+            while True:
+                for t, chat, _ in self.sent[since:]:
+                    if chat == chat_id:
+                        return t
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self._cv.wait(left)
+
+
+class FileStub(_Stub):
+    """GET anything -> a small PNG-typed body."""
+    BODY = b"\x89PNG\r\n\x1a\n" + bytes(2048)
+
+    def handle(self, h, body):
+        h.send_response(200)
+        h.send_header("Content-Type", "image/png")
+        h.send_header("Content-Length", str(len(self.BODY)))
+        h.end_headers()
+        h.wfile.write(self.BODY)
+
+
+class OpenRouterStub(_Stub):
+    """OpenAI-style /chat/completions; streams SSE (12-char deltas) when the request asks for it.
+    cut_after=N drops the connection after N deltas, like a stream that breaks off."""
+    ANSWER = ("Вход в будни 7000 ₸, в выходные 10000 ₸ (21+). Сауна включена, полотенца можно взять на месте. "
+              "Ждём вас в Tsunami! 🌊")
+
+    def __init__(self, answer=None, cut_after=None, **kw):
+        super().__init__(**kw)
+        self.answer = answer or self.ANSWER
+        self.cut_after = cut_after
+
+    def handle(self, h, body):
+        usage = {"prompt_tokens": 900, "completion_tokens": 60, "prompt_tokens_details": {"cached_tokens": 800}}
+        if not body.get("stream"):
+            return _reply(h, 200, {"choices": [{"message": {"role": "assistant", "content": self.answer}}],
+                                   "usage": usage})
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.send_header("Connection", "close")
+        h.end_headers()
+        h.wfile.write(b": OPENROUTER PROCESSING\n\n")
+        for n, i in enumerate(range(0, len(self.answer), 12)):
+            if n == self.cut_after:
+                h.close_connection = True
+                return
+            chunk = {"choices": [{"delta": {"content": self.answer[i:i + 12]}}]}
+            h.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            h.wfile.flush()
+        h.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+        h.close_connection = True
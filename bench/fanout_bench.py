@@ -0,0 +1,128 @@
+"""Multi-part replies against local stubs: time until each guest has everything.
+Every guest gets a greeting + the menu, the prize image with a caption, and a
+long LLM answer, all at once (a lunchtime burst). Compared:
+
+  sequential   blocking posts one after another on the handler threads (the
+               original path: 4 worker threads, Green API fetches the image
+               by URL on every send)
+  outbox/url   main.ga_send / ga_send_file through the outbox (coalescing,
+               sender threads), image still sent by its origin URL
+  outbox/upl   the same with the image uploaded to Green API once (uploadFile)
+
+    python bench/fanout_bench.py [guests] [ga_latency_s] [fetch_latency_s]
+
+Outbox rate limits are raised for the run so they don't mask the send path.
+"""
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("OUTBOX_RATE", "200")
+os.environ.setdefault("OUTBOX_BURST", "200")
+os.environ.setdefault("OUTBOX_CHAT_RATE", "20")
+os.environ.setdefault("OUTBOX_CHAT_BURST", "20")
+os.environ["DATABASE_URL"] = ""
+os.environ["GREENAPI_INSTANCE_ID"], os.environ["GREENAPI_TOKEN"] = "1101", "bench"
+
+import requests  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import fakes  # noqa: E402
+import main  # noqa: E402
+
+THREADS = 4
+LONG = ("Вход в будни 7000 ₸, в выходные 10000 ₸. " * 60).strip()
+
+
+def guest_parts(image):
+    """(kind, text, url) in the order the guest must see them; the answer ends the reply."""
+    return [("text", main.wa_t("ru", "welcome"), None), ("text", main.wa_t("ru", "wa_menu"), None),
+            ("file", "🎉 Твой приз", image), ("text", LONG + " #END", None)]
+
+
+def sequential(ga, image, chats):
+    session = requests.Session()
+    todo = list(chats)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                chat = todo.pop(0)
+            for kind, text, url in guest_parts(image):
+                if kind == "file":
+                    session.post(f"{ga.url}/waInstance1101/sendFileByUrl/bench", timeout=25,
+                                 json={"chatId": chat, "urlFile": url, "fileName": "prize.png", "caption": text})
+                else:
+                    session.post(f"{ga.url}/waInstance1101/sendMessage/bench", json={"chatId": chat, "message": text},
+                                 timeout=20)
+
+    ts = [threading.Thread(target=worker) for _ in range(THREADS)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+
+def via_outbox(ga, image, chats):
+    for chat in chats:
+        for kind, text, url in guest_parts(image):
+            if kind == "file":
+                main.ga_send_file(chat, url, text)
+            else:
+                main.ga_send(chat, text)
+
+
+def pct(values, p):
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+
+def run(label, fn, ga, image, chats):
+    mark = ga.mark()
+    calls = ga.requests
+    t0 = time.monotonic()
+    fn(ga, image, chats)
+    done = []
+    for chat in chats:
+        deadline = time.monotonic() + 60
+        while True:
+            with ga._cv:
+                t = next((t for t, c, text in ga.sent[mark:] if c == chat and text.endswith("#END")), None)
+            if t is not None or time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+        done.append((t or time.monotonic()) - t0)
+    print(f"{label:12s}: p50 {pct(done, 0.5):5.2f} s  p95 {pct(done, 0.95):5.2f} s  all {max(done):5.2f} s  "
+          f"{ga.requests - calls:4d} Green API calls")
+
+
+def bench():
+    guests = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.15
+    fetch = float(sys.argv[3]) if len(sys.argv) > 3 else 0.6
+    ga = fakes.GreenAPIStub(latency=latency, fetch_latency=fetch)
+    origin = fakes.FileStub(latency=0.1)
+    main.GREEN_HOST = main.GREEN_MEDIA_HOST = ga.url
+    image = f"{origin.url}/prize.png"
+    print(f"{guests} guests, Green API {latency * 1000:.0f} ms/call, image fetch by Green API {fetch * 1000:.0f} ms, "
+          f"{THREADS} sender threads")
+    try:
+        run("sequential", sequential, ga, image, [f"7701{i:07d}@c.us" for i in range(guests)])
+        main.MEDIA_UPLOAD = False
+        run("outbox/url", via_outbox, ga, image, [f"7702{i:07d}@c.us" for i in range(guests)])
+        main.MEDIA_UPLOAD = True
+        run("outbox/upl", via_outbox, ga, image, [f"7703{i:07d}@c.us" for i in range(guests)])
+        print(f"image uploads {ga.uploads}, origin fetches by our process {origin.requests}, "
+              f"fetches by Green API {ga.fetches}; outbox {main.dispatcher.stats()}")
+    finally:
+        ga.close()
+        origin.close()
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,121 @@
+"""Language detection: accuracy on a labelled RU/KK/EN set, switch churn, throughput.
+"legacy" is the original detector (Kazakh letter -> kk, any Cyrillic -> ru,
+any Latin -> en) with update_lang switching on every differing message; "new"
+is translations.detect() with main.update_lang's hysteresis. None of the
+labelled texts are in the training strings (translations.T / _LANG_SEED).
+
+    python bench/lang_bench.py [iterations]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import translations as i18n  # noqa: E402
+from tests.test_lang import LABELLED  # noqa: E402
+
+# one-word replies a guest sends in any language: they must not flip a settled chat
+SHORT = ["ok", "ок", "да", "yes", "vip", "😂", "норм", "+", "спс", "👍", "ok ok", "dj", "wow", "иә", "ага", "thx"]
+# settled chats: (stored language, what the guest sends over one visit)
+CHATS = [
+    ("ru", ["привет", "ok", "сколько стоит вход", "vip", "👍", "спасибо"]),
+    ("kk", ["сәлем", "ok", "бағасы қанша", "ок", "рахмет", "vip бар ма"]),
+    ("kk", ["salem", "kiru qansha", "ok", "rakhmet"]),
+    ("en", ["hi", "how much is entry", "ок", "vip", "dj tonight?", "thx"]),
+    ("ru", ["добрый день", "a do skolki rabotaete", "ok", "спс", "wow", "до встречи"]),
+    ("en", ["hello", "what time do you open", "спасибо", "thanks", "ok", "see you"]),
+    ("ru", ["hi", "what time do you open tonight", "ok", "thanks"]),    # a real switch: one write
+]
+
+_KK = set("әғқңөұүһі")
+
+
+def legacy_detect(t):
+    t = t.lower()
+    if any(c in _KK for c in t):
+        return "kk"
+    if re.search(r"[а-яё]", t):
+        return "ru"
+    if re.search(r"[a-z]", t):
+        return "en"
+    return None
+
+
+_KK_RE, _RU_RE, _EN_RE = re.compile("[әғқңөұүһі]"), re.compile("[а-яё]"), re.compile("[a-z]")
+
+
+def script_detect(t):
+    """The detector this replaces: precompiled script regexes, lowercased input."""
+    if _KK_RE.search(t):
+        return "kk"
+    if _RU_RE.search(t):
+        return "ru"
+    if _EN_RE.search(t):
+        return "en"
+    return None
+
+
+def accuracy(fn):
+    ok = sum(fn(text) == want for text, want in LABELLED)
+    by = {}
+    for text, want in LABELLED:
+        n, k = by.get(want, (0, 0))
+        by[want] = (n + 1, k + (fn(text) == want))
+    return ok / len(LABELLED), {k: f"{b}/{a}" for k, (a, b) in sorted(by.items())}
+
+
+def churn():
+    """DB language writes over CHATS: legacy switches on any differing message."""
+    import db
+    import main
+    writes = []
+    db.set_user_lang = lambda chat, lang: writes.append((chat, lang))
+    legacy = 0
+    for i, (lang, texts) in enumerate(CHATS):
+        cur = lang
+        for text in texts:
+            d = legacy_detect(text)
+            if d and d != cur:
+                cur, legacy = d, legacy + 1
+        chat = f"7709{i:07d}@c.us"
+        main.store.set_lang(chat, lang)
+        for text in texts:
+            main.update_lang(chat, main.message.parse(chat, text))
+    return legacy, len(writes)
+
+
+def timed(fn, texts, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - t0) / (n * len(texts)) * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    legacy_acc, legacy_by = accuracy(legacy_detect)
+    new_acc, new_by = accuracy(lambda t: i18n.detect(t)[0])
+    print(f"labelled set ({len(LABELLED)}, tests/test_lang.py): legacy {legacy_acc:.0%} {legacy_by}  new {new_acc:.0%} {new_by}")
+    for text, want in LABELLED:
+        got = i18n.detect(text)
+        if got[0] != want:
+            print(f"  miss: {text!r} -> {got} (want {want})")
+    weak = [t for t in SHORT if i18n.detect(t)[1] >= 0.7]
+    print(f"short replies ({len(SHORT)}): {len(weak)} confident enough to flip a chat on their own {weak or ''}")
+    legacy, new = churn()
+    print(f"language writes over {len(CHATS)} settled chats: legacy {legacy}, new {new}")
+
+    texts = [t.lower() for t, _ in LABELLED] + SHORT
+    rng = random.Random(1)
+    stream = [rng.choice(texts) for _ in range(len(texts))]     # chat traffic repeats itself
+    print(f"legacy lower + char scan + regex : {timed(legacy_detect, texts, n):6.2f} us/msg")
+    print(f"script regexes only (previous)   : {timed(script_detect, texts, n):6.2f} us/msg")
+    print(f"detect, new text (words cached)  : {timed(i18n._detect, texts, n):6.2f} us/msg")
+    print(f"detect, repeated text            : {timed(i18n.detect_lower, stream, n):6.2f} us/msg")
+
+
+if __name__ == "__main__":
+    main()
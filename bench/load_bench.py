@@ -0,0 +1,351 @@
+"""Load test of the whole webhook pipeline against local fakes.
+Simulated guests post Green API `incomingMessageReceived` payloads (greetings,
+menu digits/words, free text in RU/KK/EN, some duplicate redeliveries of the
+same idMessage) to the real Flask app over HTTP and wait for their reply at
+the Green API stub before sending the next one. OpenRouter is a stub too
+(latency / error-rate knobs); Postgres is used only with BENCH_DATABASE_URL
+(throwaway `bench_load` schema), otherwise the bot runs without a DB.
+
+    python bench/load_bench.py [--users 50] [--messages 20] [--llm-latency 0.3] ...
+    python bench/load_bench.py --save bench/load_baseline.json      # new baseline
+    python bench/load_bench.py --compare bench/load_baseline.json   # diff, exit 1 on regression
+
+    python bench/load_bench.py --server gunicorn                   # production server (gunicorn.conf.py)
+
+Reports throughput, webhook (ack) and end-to-end reply latency p50/p95/p99,
+and memory growth over a second round of new chats (tracemalloc, in-process
+server only). The gunicorn run ends with SIGTERM and reports how long the
+graceful drain took. Several gunicorn workers need --redis (BENCH_REDIS_URL):
+without it they keep separate dedupe state and chats, so some redeliveries show
+up as answered and bursts as several LLM calls.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from fakes import GreenAPIStub, OpenRouterStub  # noqa: E402
+
+SCHEMA = "bench_load"
+BASELINE = os.path.join(os.path.dirname(__file__), "load_baseline.json")
+
+GREETINGS = ["Привет", "Здравствуйте!", "Сәлем", "Hi", "hello"]
+MENU = ["меню", "0", "menu", "мәзір"]
+DIGITS = ["1", "2", "3", "4", "5", "6"]
+ROUTED = ["сколько стоит вход?", "до скольки работаете", "где вы находитесь?", "кіру қанша тұрады?",
+          "what time do you open?", "номер администратора"]
+FAQ = ["можно ли с детьми?", "есть ли сауна", "is there a dress code", "балалармен келуге бола ма",
+       "do you have towels", "какая температура воды"]
+UNIQUE = ["можно прийти с {n} друзьями в субботу вечером?", "we are {n} people, any group discount?",
+          "{n} адам болсақ, жеңілдік бар ма?"]
+# follow-ups typed right after a free-text question, as separate messages
+FRAGMENTS = ["в субботу", "на {n} человек", "и с детьми можно?", "this weekend", "балалармен", "вечером"]
+# share of each kind in a guest's conversation (first message is always a greeting)
+MIX = [(DIGITS, 0.3), (ROUTED, 0.2), (FAQ, 0.2), (UNIQUE, 0.15), (MENU, 0.1), (GREETINGS, 0.05)]
+# metric -> True when higher is better
+METRICS = {"throughput_msg_s": True, "llm_calls_per_guest": False, "webhook_ms.p50": False, "webhook_ms.p95": False,
+           "webhook_ms.p99": False, "e2e_ms.p50": False, "e2e_ms.p95": False, "e2e_ms.p99": False,
+           "mem_growth_kb": False}
+
+
+def script(rnd, n, burst=0.0):
+    """n messages; a free-text question becomes a burst (tuple) of 2-4 quick messages with share `burst`."""
+    texts, sent = [rnd.choice(GREETINGS)], 1
+    kinds, weights = zip(*MIX)
+    while sent < n:
+        pool = rnd.choices(kinds, weights)[0]
+        text = rnd.choice(pool).format(n=rnd.randint(2, 99))
+        if pool in (FAQ, UNIQUE) and rnd.random() < burst:
+            extra = rnd.sample(FRAGMENTS, min(n - sent - 1, rnd.randint(1, 3)))
+            text = (text, *(f.format(n=rnd.randint(2, 9)) for f in extra))
+        texts.append(text)
+        sent += len(text) if isinstance(text, tuple) else 1
+    return texts
+
+
+def payload(chat_id, text, message_id):
+    return {"typeWebhook": "incomingMessageReceived", "idMessage": message_id, "timestamp": int(time.time()),
+            "instanceData": {"idInstance": 1101000000, "wid": "77000000000@c.us", "typeInstance": "whatsapp"},
+            "senderData": {"chatId": chat_id, "sender": chat_id, "senderName": "Bench"},
+            "messageData": {"typeMessage": "textMessage", "textMessageData": {"textMessage": text}}}
+
+
+def pct(values, p):
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(len(s) * p))] * 1000, 1) if s else 0.0
+
+
+def summary(values):
+    return {"p50": pct(values, 0.5), "p95": pct(values, 0.95), "p99": pct(values, 0.99)}
+
+
+class Run:
+    def __init__(self, webhook_url, ga, args, seed):
+        self.url, self.ga, self.args = webhook_url, ga, args
+        self.rnd = random.Random(seed)
+        self.webhook, self.e2e = [], []
+        self.status = Counter()
+        self.duplicates = self.missing = 0
+        self._lock = threading.Lock()
+
+    def post(self, s, chat_id, text, rnd):
+        body = payload(chat_id, text, uuid.uuid4().hex.upper())
+        t0 = time.monotonic()
+        status = s.post(self.url, json=body, timeout=30).json().get("status")
+        ack = time.monotonic() - t0
+        dup = rnd.random() < self.args.duplicates
+        if dup:                                       # Green API redelivery of the same event
+            status_dup = s.post(self.url, json=body, timeout=30).json().get("status")
+        with self._lock:
+            self.webhook.append(ack)
+            self.status[status] += 1
+            if dup:
+                self.duplicates += 1
+                self.status[f"redelivery:{status_dup}"] += 1
+        return t0, status
+
+    def guest(self, chat_id, texts, rnd):
+        s = requests.Session()
+        for text in texts:
+            parts = text if isinstance(text, tuple) else (text,)
+            mark = self.ga.mark()
+            for i, part in enumerate(parts):
+                if i:
+                    time.sleep(rnd.uniform(0.3, 0.8))     # typing the next fragment
+                t0, status = self.post(s, chat_id, part, rnd)
+            # reply latency is counted from the last message of a burst
+            accepted = status in ("ok", "forwarded")             # forwarded: queued on the chat's worker
+            got = self.ga.wait_for(chat_id, mark, timeout=self.args.timeout) if accepted else None
+            with self._lock:
+                if got is not None:
+                    self.e2e.append(max(0.0, got - t0))
+                elif accepted:
+                    self.missing += 1
+            if self.args.think:
+                time.sleep(rnd.uniform(0, 2 * self.args.think))
+
+    def go(self, users, prefix):
+        threads = []
+        for i in range(users):
+            rnd = random.Random(self.rnd.random())
+            chat_id = f"7{prefix}{i:08d}@c.us"
+            th = threading.Thread(target=self.guest,
+                                  args=(chat_id, script(rnd, self.args.messages, self.args.burst), rnd))
+            threads.append(th)
+        t0 = time.monotonic()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return time.monotonic() - t0
+
+
+def setup_env(args, ga, llm):
+    db_url = os.getenv("BENCH_DATABASE_URL", "")
+    if db_url:
+        sep = "&" if "?" in db_url else "?"
+        db_url = f"{db_url}{sep}options=-csearch_path%3D{SCHEMA}"
+    os.environ.update({
+        "GREENAPI_HOST": ga.url, "GREENAPI_INSTANCE_ID": "1101000000", "GREENAPI_TOKEN": "bench",
+        "OPENROUTER_URL": f"{llm.url}/api/v1/chat/completions", "OPENROUTER_API_KEY": "bench",
+        "OPENROUTER_STREAM": "1" if args.stream else "0", "DATABASE_URL": db_url, "REDIS_URL": args.redis,
+        "BOT_CHAT_ID": "77000000000@c.us", "HTTP_BACKOFF": "0.05",
+        # measure the pipeline, not the production send throttle
+        "OUTBOX_RATE": str(args.outbox_rate), "OUTBOX_BURST": str(args.outbox_rate),
+        "OUTBOX_CHAT_RATE": "50", "OUTBOX_CHAT_BURST": "50",
+    })
+    if db_url:
+        import psycopg2
+        conn = psycopg2.connect(os.environ["BENCH_DATABASE_URL"])
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+        conn.close()
+    return bool(db_url)
+
+
+def drop_schema():
+    import psycopg2
+    conn = psycopg2.connect(os.environ["BENCH_DATABASE_URL"])
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.close()
+
+
+def bench(args):
+    ga = GreenAPIStub(latency=args.ga_latency, error_rate=args.ga_errors, jitter=args.ga_latency / 2)
+    llm = OpenRouterStub(latency=args.llm_latency, error_rate=args.llm_errors, jitter=args.llm_latency / 3)
+    with_db = setup_env(args, ga, llm)
+    if args.server == "gunicorn":
+        result = bench_gunicorn(args, ga, with_db)
+    else:
+        result = bench_inprocess(args, ga, with_db)
+    ga.close()
+    llm.close()
+    return {"config": {k: getattr(args, k) for k in ("server", "workers", "users", "messages", "duplicates",
+                                                     "burst", "llm_latency", "llm_errors", "ga_latency",
+                                                     "ga_errors", "stream", "think", "seed")} | {"db": with_db},
+            **result, "llm_calls": llm.requests, "ga_sends": ga.requests,
+            "llm_calls_per_guest": round(llm.requests / result.pop("guests"), 2)}
+
+
+def report(run, elapsed):
+    sent = sum(v for k, v in run.status.items() if not k.startswith("redelivery"))
+    return {"messages": sent, "redeliveries": run.duplicates, "statuses": dict(run.status),
+            "replies_missing": run.missing, "elapsed_s": round(elapsed, 2),
+            "throughput_msg_s": round(sent / elapsed, 1),
+            "webhook_ms": summary(run.webhook), "e2e_ms": summary(run.e2e)}
+
+
+def bench_inprocess(args, ga, with_db):
+    """Werkzeug's threaded server in this process (what `python main.py` runs); measures memory too."""
+    quiet = io.StringIO() if not args.verbose else None
+    with contextlib.ExitStack() as stack:
+        if quiet is not None:                         # the bot prints every webhook / error
+            stack.enter_context(contextlib.redirect_stdout(quiet))
+            stack.enter_context(contextlib.redirect_stderr(quiet))
+        import main
+        from werkzeug.serving import make_server
+        main.init_once()
+        srv = make_server("127.0.0.1", 0, main.app, threaded=True)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{srv.server_port}/webhook"
+
+        run = Run(url, ga, args, args.seed)
+        elapsed = run.go(args.users, "1")
+
+        # second round of new guests under tracemalloc: what the same traffic leaves behind
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        Run(url, ga, args, args.seed + 1).go(args.users, "2")
+        main.pool.drain(5)
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        stats = main.app.test_client().get("/stats").get_json()
+        srv.shutdown()
+        main.shutdown(5)
+        if with_db:
+            main.db.close_pool()
+            drop_schema()
+    return {**report(run, elapsed), "guests": 2 * args.users, "mem_growth_kb": round(growth / 1024, 1),
+            "rss_max_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "answer_cache": stats.get("answer_cache"), "intents": stats.get("intents")}
+
+
+def bench_gunicorn(args, ga, with_db):
+    """The production server (gunicorn.conf.py) as a subprocess; ends with SIGTERM to time the drain."""
+    root = os.path.join(os.path.dirname(__file__), "..")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app",
+           "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers)]
+    out = None if args.verbose else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=root, stdout=out, stderr=out)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(200):
+            try:
+                requests.get(base + "/", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.05)
+        run = Run(base + "/webhook", ga, args, args.seed)
+        elapsed = run.go(args.users, "1")
+        stats = requests.get(base + "/stats", timeout=5).json()   # one worker's view
+    finally:
+        t0 = time.monotonic()
+        proc.terminate()
+        proc.wait(timeout=60)
+        stopped = time.monotonic() - t0
+    if with_db:
+        drop_schema()
+    return {**report(run, elapsed), "guests": args.users, "shutdown_s": round(stopped, 2),
+            "exit_code": proc.returncode,
+            "answer_cache": stats.get("answer_cache"), "intents": stats.get("intents")}
+
+
+def _get(d, path):
+    for part in path.split("."):
+        d = d.get(part, {}) if isinstance(d, dict) else {}
+    return d if isinstance(d, (int, float)) else None
+
+
+def compare(result, baseline, tolerance):
+    """Print metric deltas against a saved run; returns the names that got worse by > tolerance."""
+    worse = []
+    if baseline.get("config") != result["config"]:
+        print("note: baseline was recorded with a different config:", baseline.get("config"))
+    print(f"{'metric':<20}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, higher_better in METRICS.items():
+        old, new = _get(baseline, name), _get(result, name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        bad = (-change if higher_better else change) > tolerance
+        if bad:
+            worse.append(name)
+        print(f"{name:<20}{old:>12}{new:>12}{change:>+10.1%}{'  REGRESSION' if bad else ''}")
+    return worse
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--server", choices=("werkzeug", "gunicorn"), default="werkzeug",
+                   help="in-process dev server, or gunicorn.conf.py in a subprocess (no memory figures)")
+    p.add_argument("--workers", type=int, default=1, help="gunicorn worker processes")
+    p.add_argument("--redis", default=os.getenv("BENCH_REDIS_URL", ""),
+                   help="REDIS_URL for the bot: shared state and chat leases across workers")
+    p.add_argument("--users", type=int, default=50, help="concurrent guests")
+    p.add_argument("--messages", type=int, default=20, help="messages per guest")
+    p.add_argument("--duplicates", type=float, default=0.1, help="share of events redelivered")
+    p.add_argument("--burst", type=float, default=0.3,
+                   help="share of free-text questions typed as several quick messages")
+    p.add_argument("--llm-latency", type=float, default=0.3, help="seconds")
+    p.add_argument("--llm-errors", type=float, default=0.0, help="share of 500s")
+    p.add_argument("--ga-latency", type=float, default=0.02, help="seconds")
+    p.add_argument("--ga-errors", type=float, default=0.0, help="share of 500s")
+    p.add_argument("--outbox-rate", type=float, default=1000.0, help="OUTBOX_RATE for the run")
+    p.add_argument("--stream", action="store_true", help="OPENROUTER_STREAM=1")
+    p.add_argument("--think", type=float, default=0.0, help="mean pause between a guest's messages, s")
+    p.add_argument("--timeout", type=float, default=30.0, help="max wait for a reply, s")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", metavar="PATH", help="write the result as a baseline")
+    p.add_argument("--compare", metavar="PATH", nargs="?", const=BASELINE, help="diff against a baseline")
+    p.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    p.add_argument("--verbose", action="store_true", help="keep the bot's own output")
+    args = p.parse_args()
+
+    result = bench(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            worse = compare(result, json.load(f), args.tolerance)
+        sys.exit(1 if worse else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Per-message CPU of the inbound parse + outbound formatting path.
+"legacy" is the pre-message.py code (regex re.sub per call, tuple scans, three
+lowercasings, wa_format on every send); "parsed" is message.parse() with
+frozenset lookups and pre-rendered WhatsApp strings.
+
+    python bench/parse_bench.py [iterations]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import message  # noqa: E402
+import translations as i18n  # noqa: E402
+
+TEXTS = [
+    "Привет!", "меню", "1", "сколько стоит вход?", "Сәлеметсіз бе, кіру қанша тұрады?",
+    "What time do you open?", "можно ли с детьми и сколько стоит бронь vip на субботу",
+    "5", "👍", "/start", "Hello, is there a dress code?", "до скольки работаете сегодня",
+]
+CHATS = [f"7701{i:07d}@c.us" for i in range(50)]
+REPLIES = [("prices", {}), ("hours", {}), ("wa_menu", {}), ("loc", {"g": "https://g", "d": "https://d"})]
+
+_MENU = ("меню", "menu", "мәзір", "0", "/start", "start", "старт")
+_GREET = ("привет", "приветик", "здравствуй", "здравствуйте", "добрый", "доброе",
+          "хай", "ассалам", "ассалаумағалейкум", "салам", "салем", "сәлем",
+          "сәлеметсіз", "сәлеметсіңіз", "hi", "hello", "hey", "start", "начать")
+_KK = set("әғқңөұүһіӘҒҚҢӨҰҮҺІ")
+
+
+# ----- legacy path -----
+def legacy_detect(text):
+    t = text.lower()
+    if any(c in _KK for c in t):
+        return "kk"
+    if re.search(r"[а-яё]", t):
+        return "ru"
+    if re.search(r"[a-z]", t):
+        return "en"
+    return None
+
+
+def legacy_db_id(chat_id):
+    digits = re.sub(r"\D", "", str(chat_id).split("@")[0])
+    return int(digits) if digits else 0
+
+
+def legacy_wa_format(s):
+    s = re.sub(r'<a href="([^"]+)">([^<]+)</a>', r"\2: \1", s)
+    s = s.replace("<b>", "*").replace("</b>", "*")
+    s = s.replace("<code>", "").replace("</code>", "")
+    return s
+
+
+def legacy(chat_id, text, reply):
+    did = legacy_db_id(chat_id)
+    low = text.strip().lower()
+    lang = None
+    if not low.startswith("/") and low not in _MENU:
+        lang = legacy_detect(text)
+    body = text.strip()
+    low = body.lower()
+    words = re.sub(r"[^\w\s]", " ", low).split()
+    greet = bool(words) and words[0] in _GREET
+    key, kw = reply
+    out = legacy_wa_format(i18n.t(lang or "ru", key, **kw))
+    return did, lang, greet, low in _MENU, out
+
+
+# ----- parsed path -----
+MENU = frozenset(_MENU)
+GREET = frozenset(_GREET)
+WA_T = {lang: {k: legacy_wa_format(v) for k, v in d.items()} for lang, d in i18n.T.items()}
+
+
+def parsed(chat_id, text, reply):
+    msg = message.parse(chat_id, text)
+    lang = msg.lang if not msg.is_command and msg.low not in MENU else None
+    greet = msg.first in GREET
+    key, kw = reply
+    s = WA_T[lang or "ru"][key]
+    out = s.format(**kw) if kw else s
+    if "<" in out:                              # main.wa_format fast path
+        out = legacy_wa_format(out)
+    return msg.db_id, lang, greet, msg.low in MENU, out
+
+
+def run(fn, n):
+    cases = [(CHATS[i % len(CHATS)], TEXTS[i % len(TEXTS)], REPLIES[i % len(REPLIES)]) for i in range(n)]
+    t0 = time.perf_counter()
+    for c in cases:
+        fn(*c)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    for c, t in zip(CHATS, TEXTS):                # same answers both ways
+        for r in REPLIES:
+            assert legacy(c, t, r) == parsed(c, t, r), (c, t, r)
+    run(legacy, 2000), run(parsed, 2000)          # warm up
+    a, b = run(legacy, n), run(parsed, n)
+    print(f"legacy  {a:6.2f} us/message")
+    print(f"parsed  {b:6.2f} us/message  ({a / b:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
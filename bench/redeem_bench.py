@@ -0,0 +1,134 @@
+"""Prize scan benchmark on Postgres: the evening-rush QR path at the bar.
+Compares the old per-scan lookups (db.get_prize, then db.redeem_prize) with
+redemption.redeem(), which answers rejects (used, expired, last week's, typos)
+from the in-memory index of all issued codes. Also checks that a second index
+(standing in for another process) follows issues and redeems through NOTIFY,
+and how long that takes.
+
+    BENCH_DATABASE_URL=postgresql://... python bench/redeem_bench.py [codes_per_day] [scans]
+
+Runs in a throwaway `bench_redeem` schema, dropped at the end.
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import db  # noqa: E402
+import prizes  # noqa: E402
+import redemption  # noqa: E402
+
+SCHEMA = "bench_redeem"
+
+
+def _url(base):
+    sep = "&" if "?" in base else "?"
+    return f"{base}{sep}options=-csearch_path%3D{SCHEMA}"
+
+
+def seed(url, per_day, today):
+    """Prizes from last week, yesterday and today, a third of today's already redeemed."""
+    conn = psycopg2.connect(url)
+    codes = {}
+    with conn, conn.cursor() as cur:
+        for day in (today - datetime.timedelta(days=7), today - datetime.timedelta(days=1), today):
+            rows = [(prizes.new_code(), i, "shot", "🥃 Shot", "cashier",
+                     "redeemed" if day == today and i % 3 == 0 else "issued", day) for i in range(per_day)]
+            execute_values(cur, "INSERT INTO prizes (code, chat_id, prize_key, prize_label, role, status, valid_date) "
+                           "VALUES %s", rows)
+            codes[day] = rows
+    conn.close()
+    return codes
+
+
+def legacy_redeem(code, staff_id):
+    today = redemption.today()
+    p = db.get_prize(code)
+    v = redemption.verdict(p, today)
+    if v != "ok":
+        return v
+    return "ok" if db.redeem_prize(code, staff_id, today) else "used"
+
+
+def wait(pred, timeout=5.0):
+    t0 = time.perf_counter()
+    while not pred():
+        if time.perf_counter() - t0 > timeout:
+            return None
+        time.sleep(0.0005)
+    return (time.perf_counter() - t0) * 1000
+
+
+def main():
+    base = os.environ.get("BENCH_DATABASE_URL")
+    if not base:
+        sys.exit("set BENCH_DATABASE_URL to a throwaway Postgres")
+    per_day = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    admin = psycopg2.connect(base)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    db.DATABASE_URL = _url(base)
+    try:
+        db.init_db()
+        today = redemption.today()
+        rows = seed(db.DATABASE_URL, per_day, today)
+        db._run("ANALYZE")
+        valid = [r[0] for r in rows[today] if r[5] == "issued"]
+        used = [r[0] for r in rows[today] if r[5] == "redeemed"]
+        expired = [r[0] for r in rows[today - datetime.timedelta(days=1)]]
+        old = [r[0] for r in rows[today - datetime.timedelta(days=7)]]
+        rng = random.Random(7)
+        # a rush: mostly good codes, plus re-scans, yesterday's / last week's screenshots and typos
+        mix = [rng.choice(used) if x < 0.2 else rng.choice(expired) if x < 0.3 else rng.choice(old) if x < 0.33
+               else prizes.new_code() if x < 0.4 else None for x in (rng.random() for _ in range(n))]
+        good = iter(valid)
+        scans = [c if c is not None else next(good) for c in mix]
+        half = len(scans) // 2
+
+        db.PREPARE = True
+        t0 = time.perf_counter()
+        legacy = [legacy_redeem(c, 1) for c in scans[:half]]
+        ms_legacy = (time.perf_counter() - t0) / half * 1000
+
+        redemption.codes.start()
+        wait(lambda: redemption.codes.stats()["live"])
+        q0 = db.stats()["queries"]
+        t0 = time.perf_counter()
+        new = [redemption.redeem(c, 2)[0] for c in scans[half:]]
+        ms_new = (time.perf_counter() - t0) / (len(scans) - half) * 1000
+        q1 = db.stats()["queries"]
+        trips = sum(v["calls"] for v in q1.values()) - sum(v["calls"] for v in q0.values())
+        print(f"{per_day} codes/day, {len(scans)} scans ({sum(v != 'ok' for v in legacy + new)} rejects)")
+        print(f"legacy get_prize + redeem_prize : {ms_legacy:6.3f} ms/scan, "
+              f"{len(legacy) + sum(v == 'ok' for v in legacy)} queries")
+        print(f"redemption.redeem (code index)  : {ms_new:6.3f} ms/scan, {trips} queries "
+              f"({sum(v == 'ok' for v in new)} redeems)")
+        assert sorted(set(legacy)) == sorted(set(new)), (set(legacy), set(new))
+        assert [redemption.check(c)[0] for c in old[:20]] == ["expired"] * 20
+        print(f"index: {redemption.codes.stats()['codes']} codes, "
+              f"{redemption.codes.stats()['codes'] / max(1, sum(len(r) for r in rows.values())):.0%} of prizes")
+
+        other = redemption.CodeIndex()                     # another process's index
+        other.start()
+        wait(lambda: other.stats()["live"])
+        code = prizes.new_code()
+        db.create_prize(code, 42, "beer", "🍺 Beer", "cashier", today)
+        issue_ms = wait(lambda: other.get(code)[1] is not None)
+        redemption.redeem(code, 3)
+        redeem_ms = wait(lambda: other.get(code)[1]["status"] == "redeemed")
+        print(f"NOTIFY to another index: issue seen in {issue_ms:.1f} ms, redeem in {redeem_ms:.1f} ms")
+        print("rescan:", redemption.redeem(code, 3)[0], "| index:", other.stats())
+    finally:
+        db.close_pool()
+        admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        admin.close()
+
+
+if __name__ == "__main__":
+    main()
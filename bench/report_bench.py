@@ -0,0 +1,120 @@
+"""Daily report benchmark on a seeded Postgres.
+Compares the old four-query report (a fresh connection per query, no indexes)
+with the single-round-trip report (pooled, indexed) and the daily_stats path
+(the day's counters read as they are), plus what a one-day reconcile costs.
+
+    BENCH_DATABASE_URL=postgresql://... python bench/report_bench.py [days] [rows_per_day]
+
+Everything is created in a throwaway `bench_report` schema, dropped at the end.
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import db  # noqa: E402
+
+SCHEMA = "bench_report"
+
+
+def _url(base):
+    sep = "&" if "?" in base else "?"
+    return f"{base}{sep}options=-csearch_path%3D{SCHEMA}"
+
+
+def legacy_report(url, day, day_start_utc):
+    def one(sql, params, many=False):
+        conn = psycopg2.connect(url, connect_timeout=10)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchall() if many else cur.fetchone()
+        finally:
+            conn.close()
+    spins = one("SELECT count(*) FROM spins WHERE spin_date=%s", (day,))[0]
+    won = one("SELECT prize_label, count(*) FROM prizes WHERE valid_date=%s GROUP BY prize_label ORDER BY 2 DESC",
+              (day,), many=True)
+    redeemed = one("SELECT count(*) FROM prizes WHERE valid_date=%s AND status='redeemed'", (day,))[0]
+    contacts = one("SELECT count(*) FROM contacts WHERE created_at >= %s", (day_start_utc,))[0]
+    return {"spins": spins, "won": won, "redeemed": redeemed, "contacts": contacts}
+
+
+def seed(url, days, per_day):
+    conn = psycopg2.connect(url)
+    labels = ["🥃 Shot", "🍺 Beer", "🥤 Welcome", "🍕 Pizza", "🎟 Entry"]
+    start = datetime.date.today() - datetime.timedelta(days=days - 1)
+    with conn, conn.cursor() as cur:
+        for d in range(days):
+            day = start + datetime.timedelta(days=d)
+            ts = datetime.datetime.combine(day, datetime.time(12), datetime.timezone.utc)
+            execute_values(cur, "INSERT INTO spins (chat_id, spin_date, prize) VALUES %s",
+                           [(i, day, "x") for i in range(per_day)])
+            execute_values(cur, "INSERT INTO prizes (code, chat_id, prize_label, status, valid_date) VALUES %s",
+                           [(f"{d}-{i}", i, random.choice(labels), random.choice(("issued", "redeemed")), day)
+                            for i in range(per_day // 2)])
+            execute_values(cur, "INSERT INTO contacts (chat_id, name, phone, created_at) VALUES %s",
+                           [(i, "n", "p", ts) for i in range(per_day // 10)])
+    conn.close()
+
+
+def timed(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        out = fn()
+    return (time.perf_counter() - t0) / n * 1000, out
+
+
+def main():
+    base = os.environ.get("BENCH_DATABASE_URL")
+    if not base:
+        sys.exit("set BENCH_DATABASE_URL to a throwaway Postgres")
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    admin = psycopg2.connect(base)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    url = _url(base)
+    db.DATABASE_URL = url
+    try:
+        db.init_db()
+        seed(url, days, per_day)
+        db._run("ANALYZE")
+        day = datetime.date.today()
+        start = datetime.datetime.combine(day, datetime.time(0), datetime.timezone.utc)
+        n = 20
+        print(f"seeded {days} days x {per_day} spins ({days * per_day // 2} prizes)")
+
+        db._run("DROP INDEX prizes_valid_date_status_idx; DROP INDEX spins_spin_date_idx; "
+                "DROP INDEX contacts_created_at_idx")
+        ms, ref = timed(lambda: legacy_report(url, day, start), n)
+        print(f"legacy 4 queries, new conn each, no indexes : {ms:8.2f} ms")
+        ms, out = timed(lambda: db.report_data(day, start), n)
+        print(f"single query, pooled, no indexes            : {ms:8.2f} ms")
+        db.init_db()                                       # recreate indexes
+        db._run("ANALYZE")
+        ms, out = timed(lambda: db.report_data(day, start), n)
+        print(f"single query, pooled, indexed               : {ms:8.2f} ms")
+        assert out["spins"] == ref["spins"] and out["redeemed"] == ref["redeemed"], (out, ref)
+        db.DAILY_STATS = True
+        t0 = time.perf_counter()
+        db.init_db()                                       # creates + backfills daily_stats
+        label = f"daily_stats backfill of {days} days (once)"
+        print(f"{label:<44}: {(time.perf_counter() - t0) * 1000:8.2f} ms")
+        ms, out = timed(lambda: db.report_data(day, start), n)
+        print(f"daily_stats, counters read                  : {ms:8.2f} ms")
+        assert out["spins"] == ref["spins"] and sorted(out["won"]) == sorted(ref["won"]), (out, ref)
+        ms, _ = timed(lambda: db.reconcile_daily_stats(day), n)
+        print(f"reconcile one day (nightly, not per report) : {ms:8.2f} ms")
+    finally:
+        db.close_pool()
+        admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        admin.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Wheel spin benchmark on Postgres.
+Compares the old issue path (can_spin_today + record_spin + create_prize: three
+round trips, check-then-act) with prizes.spin() (one statement, pooled codes),
+with every chat spinning from several threads at once as a double-tap would.
+
+    BENCH_DATABASE_URL=postgresql://... python bench/spin_bench.py [chats] [taps_per_chat] [threads]
+
+Reports spins/s and checks: one spin row per chat, one prize per winning chat,
+no duplicate codes. Runs in a throwaway `bench_spin` schema, dropped at the end.
+"""
+import datetime
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import db  # noqa: E402
+import prizes  # noqa: E402
+
+SCHEMA = "bench_spin"
+
+
+def _url(base):
+    sep = "&" if "?" in base else "?"
+    return f"{base}{sep}options=-csearch_path%3D{SCHEMA}"
+
+
+def legacy_spin(chat_id, lang, valid_date):
+    if not db.can_spin_today(chat_id):
+        return {"status": "already"}
+    prize = prizes.draw()
+    label = prize.get(lang) or prize["ru"]
+    db.record_spin(chat_id, prize["key"])
+    if not prize["real"]:
+        return {"status": "lose"}
+    code = prizes.new_code()
+    db.create_prize(code, chat_id, prize["key"], label, prize["role"], valid_date)
+    return {"status": "win", "code": code}
+
+
+def hammer(fn, chats, taps, threads, offset):
+    """Each chat spins `taps` times, the taps spread over different threads."""
+    jobs = [offset + c for c in range(chats) for _ in range(taps)]    # taps of one chat back to back
+    lock = threading.Lock()
+    results = []
+    day = datetime.date.today()
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                chat = jobs.pop()
+            r = fn(chat, "ru", day)
+            with lock:
+                results.append((chat, r))
+
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return time.perf_counter() - t0, results
+
+
+def check(results, offset, chats):
+    admin = psycopg2.connect(db.DATABASE_URL)
+    with admin.cursor() as cur:
+        cur.execute("SELECT count(*), count(DISTINCT chat_id) FROM spins WHERE chat_id >= %s AND chat_id < %s",
+                    (offset, offset + chats))
+        spin_rows, spin_chats = cur.fetchone()
+        cur.execute("SELECT count(*), count(DISTINCT chat_id) FROM prizes WHERE chat_id >= %s AND chat_id < %s",
+                    (offset, offset + chats))
+        prize_rows, prize_chats = cur.fetchone()
+    admin.close()
+    granted = Counter(chat for chat, r in results if r["status"] != "already")
+    codes = [r["code"] for _, r in results if r.get("code")]
+    return {"spin_rows": spin_rows, "double_spins": sum(n - 1 for n in granted.values() if n > 1),
+            "extra_prizes": prize_rows - prize_chats, "dup_codes": len(codes) - len(set(codes)),
+            "ok": spin_rows == spin_chats == chats and prize_rows == prize_chats}
+
+
+def main():
+    base = os.environ.get("BENCH_DATABASE_URL")
+    if not base:
+        sys.exit("set BENCH_DATABASE_URL to a throwaway Postgres")
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    admin = psycopg2.connect(base)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    db.DATABASE_URL = _url(base)
+    db.POOL_MAX = max(db.POOL_MAX, threads)
+    try:
+        db.init_db()
+        print(f"{chats} chats x {taps} taps, {threads} threads")
+        for label, fn, offset in (("legacy check + 2 inserts", legacy_spin, 0),
+                                  ("prizes.spin, one statement", prizes.spin, 10_000_000)):
+            if fn is prizes.spin:
+                t0 = time.perf_counter()
+                prizes.refill_codes(chats)
+                print(f"  code pool stocked with {chats} in {(time.perf_counter() - t0) * 1000:.1f} ms")
+            secs, results = hammer(fn, chats, taps, threads, offset)
+            db.flush_writes()                              # legacy record_spin may be write-behind
+            c = check(results, offset, chats)
+            print(f"{label:28s}: {len(results) / secs:8.0f} spins/s  double spins {c['double_spins']:4d}  "
+                  f"extra prizes {c['extra_prizes']:4d}  dup codes {c['dup_codes']}  "
+                  f"{'OK' if c['ok'] and not c['double_spins'] else 'FAIL'}")
+    finally:
+        db.close_pool()
+        admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        admin.close()
+
+
+if __name__ == "__main__":
+    main()
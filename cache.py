@@ -0,0 +1,155 @@
+"""Bounded in-process caches for the bot's per-chat state.
+LRU + sliding TTL on an OrderedDict: every get/set moves the key to the end,
+so the front is always the least recently used *and* the first to expire —
+eviction just pops from the front, O(1) per operation. An optional `weigh`
+function caps the total size (a rough byte ceiling) on top of the entry cap;
+`on_evict(key, value)` is called (lock held) whenever an entry expires or is evicted.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, weigh=None, max_weight=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.on_evict = on_evict
+        self.weight = 0
+        self._data = OrderedDict()          # key -> (expires_at, value, weight)
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    # ----- internals (lock held) -----
+    def _purge(self, now):
+        while self._data:
+            key, (exp, value, w) = next(iter(self._data.items()))
+            if exp > now:
+                break
+            self._data.popitem(last=False)
+            self.weight -= w
+            self.expirations += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+
+    def _shrink(self):
+        while self._data and (len(self._data) > self.maxsize or
+                              (self.max_weight is not None and self.weight > self.max_weight)):
+            key, (_, value, w) = self._data.popitem(last=False)
+            self.weight -= w
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+
+    def _lookup(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        exp, value, w = item
+        if exp <= now:
+            del self._data[key]
+            self.weight -= w
+            self.expirations += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+            return _MISSING
+        self._data[key] = (now + self.ttl, value, w)
+        self._data.move_to_end(key)
+        return value
+
+    def _store(self, key, value, now):
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.weight -= old[2]
+        w = self.weigh(value) if self.weigh else 0
+        self._data[key] = (now + self.ttl, value, w)
+        self.weight += w
+        self._shrink()
+
+    # ----- public -----
+    def get(self, key, default=None):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            value = self._lookup(key, now)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._store(key, value, now)
+
+    def add_if_absent(self, key, value=True):
+        """Atomic set-if-absent. True if the key was added (i.e. not seen before)."""
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            if self._lookup(key, now) is not _MISSING:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._store(key, value, now)
+            return True
+
+    def update(self, key, fn, default=None):
+        """Atomically store fn(current value or default); returns the new value."""
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            value = self._lookup(key, now)
+            value = fn(default if value is _MISSING else value)
+            self._store(key, value, now)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self.weight -= item[2]
+            return item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "weight": self.weight, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expirations": self.expirations}
+
+
+class TTLSet(TTLCache):
+    """Set view over TTLCache (membership only)."""
+    def add(self, key):
+        self.set(key, True)
+
+    def discard(self, key):
+        self.pop(key)
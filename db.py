@@ -2,43 +2,403 @@
 Stores guest contacts (from bookings) and daily wheel spins.
 Degrades gracefully: if DATABASE_URL is missing or DB is unreachable,
 functions no-op / allow, so the bot keeps working without the DB.
+Connections come from a small per-process pool; fixed queries are prepared
+once per connection (see _run's `name`).
 """
+import atexit
+import datetime
 import os
+import re
+import threading
+import time
 import traceback
 import psycopg2
+import psycopg2.extensions
+import pytz
+from psycopg2.extras import execute_values
+
+import metrics
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))          # connections per process
+POOL_WAIT = float(os.environ.get("DB_POOL_WAIT", "5"))      # seconds to wait for a free connection
+POOL_PING = float(os.environ.get("DB_POOL_PING", "30"))     # idle seconds before SELECT 1 on checkout
+PREPARE = os.environ.get("DB_PREPARE", "1") == "1"         # off behind pgbouncer transaction pooling
+DAILY_STATS = os.environ.get("DB_DAILY_STATS", "0") == "1"  # keep daily_stats counters for O(1) reports
+RECONCILE_DAYS = int(os.environ.get("DB_STATS_RECONCILE_DAYS", "3"))   # recent days init_db re-counts
+WRITE_BEHIND = os.environ.get("DB_WRITE_BEHIND", "1") == "1"   # batch lang / spin / contact writes
+FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "1.0"))  # seconds
+FLUSH_SIZE = int(os.environ.get("DB_FLUSH_SIZE", "200"))          # pending writes that force a flush
+BUFFER_MAX = int(os.environ.get("DB_BUFFER_MAX", "5000"))         # writes kept per table while the DB is down
+
+ALMATY = pytz.timezone("Asia/Almaty")          # spin days and report days are Almaty calendar days
+_RETRYABLE = (psycopg2.OperationalError, psycopg2.InterfaceError)
+_DEFAULT = object()
+
+
+class _Conn(psycopg2.extensions.connection):
+    """Pooled connection; remembers which statements are prepared on it."""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class _Pool:
+    """Small LIFO pool: bounded by a semaphore, health-checked on checkout."""
+    def __init__(self, maxconn):
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def get(self):
+        if not self._slots.acquire(timeout=POOL_WAIT):
+            raise psycopg2.OperationalError("DB pool exhausted")
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return _conn(), False
+                if _healthy(conn):
+                    _count("checkouts")
+                    return conn, True
+                _count("dropped")
+                _close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put(self, conn, discard=False):
+        try:
+            if discard or conn.closed:
+                _close(conn)
+            else:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _close(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_stats = {"connects": 0, "connect_s": 0.0, "checkouts": 0, "dropped": 0, "retries": 0}
+_query_stats = {}                   # statement name -> [calls, total seconds]
+_stats_lock = threading.Lock()
+_QUERY_SECONDS = metrics.histogram("wa_db_query_seconds", "Postgres statement time incl. pool checkout",
+                                   ("statement",))
+_QUERY_ERRORS = metrics.counter("wa_db_query_errors_total", "Postgres statements that failed", ("statement",))
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
 
 
 def _conn():
-    return psycopg2.connect(DATABASE_URL, connect_timeout=10)
+    t0 = time.monotonic()
+    conn = psycopg2.connect(DATABASE_URL, connect_timeout=10, connection_factory=_Conn)
+    with _stats_lock:
+        _stats["connects"] += 1
+        _stats["connect_s"] += time.monotonic() - t0
+    return conn
 
 
-def _run(sql, params=(), fetch=False, many=False):
-    if not DATABASE_URL:
-        return [] if many else None
-    conn = None
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _healthy(conn):
+    if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if time.monotonic() - conn.last_used < POOL_PING:
+        return True
     try:
-        conn = _conn()
         with conn.cursor() as cur:
-            cur.execute(sql, params)
-            row = cur.fetchall() if many else (cur.fetchone() if fetch else None)
-        conn.commit()
-        return row
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _get_pool():
+    """Process-wide pool, rebuilt after a fork (sockets must not be shared)."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool, _pool_pid = _Pool(POOL_MAX), os.getpid()
+    return _pool
+
+
+def _to_pg(sql):
+    """'%s' placeholders -> '$1..$n' for PREPARE; returns (sql, n_params)."""
+    n = 0
+
+    def sub(_):
+        nonlocal n
+        n += 1
+        return f"${n}"
+    return re.sub(r"%s", sub, sql), n
+
+
+def _execute(conn, cur, sql, params, name):
+    if not (PREPARE and name):
+        cur.execute(sql, params)
+        return
+    if name not in conn.prepared:
+        pg_sql, n = _to_pg(sql)
+        cur.execute(f"PREPARE {name} AS {pg_sql}")
+        conn.prepared.add(name)
+    else:
+        n = len(params)
+    cur.execute(f"EXECUTE {name}" + (f" ({', '.join(['%s'] * n)})" if n else ""), params)
+
+
+def _with_conn(work, key, default, rejected=_DEFAULT):
+    """Run work(conn, cur) in one transaction on a pooled connection; `default` on any failure, or
+    `rejected` (if given) when the failure is not a connection problem (bad data, constraint)."""
+    t0 = time.monotonic()
+    try:
+        for attempt in (1, 2):
+            pool = _get_pool()
+            conn, reused = pool.get()
+            try:
+                with conn.cursor() as cur:
+                    result = work(conn, cur)
+                conn.commit()
+                pool.put(conn)
+                return result
+            except Exception as e:
+                # never hand back a connection in an unknown state (aborted tx, half-prepared statement)
+                pool.put(conn, discard=True)
+                if isinstance(e, _RETRYABLE) and attempt == 1 and reused:
+                    _count("retries")           # stale socket (e.g. Postgres restarted) -> reconnect once
+                    continue
+                raise
     except Exception as e:
         print("[DB] query failed:", e)
         traceback.print_exc()
-        return [] if many else None
+        _QUERY_ERRORS.inc(key)
+        return default if rejected is _DEFAULT or isinstance(e, _RETRYABLE) else rejected
     finally:
-        if conn is not None:
-            conn.close()
+        elapsed = time.monotonic() - t0
+        _QUERY_SECONDS.observe(elapsed, key)
+        with _stats_lock:
+            st = _query_stats.setdefault(key, [0, 0.0])
+            st[0] += 1
+            st[1] += elapsed
 
 
-def init_db():
+def _run(sql, params=(), fetch=False, many=False, name=None):
+    """Run one statement on a pooled connection. `name` marks a fixed query:
+    it is prepared once per connection and timed under that name."""
     if not DATABASE_URL:
-        print("[DB] DATABASE_URL not set — DB disabled, bot runs without persistence")
-        return
-    _run("""CREATE TABLE IF NOT EXISTS contacts (
+        return [] if many else None
+
+    def work(conn, cur):
+        _execute(conn, cur, sql, params, name)
+        return cur.fetchall() if many else (cur.fetchone() if fetch else None)
+    return _with_conn(work, name or " ".join(sql.split()[:3]), [] if many else None)
+
+
+def _run_values(sql, rows, template, name):
+    """Multi-row statement (execute_values) in one round trip. True on success, False if the DB
+    could not be reached, None if it rejected the rows (retrying the same batch won't help)."""
+    if not DATABASE_URL or not rows:
+        return True
+
+    def work(conn, cur):
+        execute_values(cur, sql, rows, template=template, page_size=len(rows))
+        return True
+    return _with_conn(work, name, False, None)
+
+
+def stats():
+    """Pool and per-statement timings. handshakes_saved = checkouts served by a live connection."""
+    with _stats_lock:
+        s = dict(_stats)
+        queries = {k: {"calls": c, "avg_ms": round(t / c * 1000, 2)} for k, (c, t) in _query_stats.items()}
+    avg_connect = s["connect_s"] / s["connects"] if s["connects"] else 0.0
+    return {"connects": s["connects"], "avg_connect_ms": round(avg_connect * 1000, 2),
+            "handshakes_saved": s["checkouts"],
+            "saved_ms_est": round(s["checkouts"] * avg_connect * 1000, 1),
+            "dropped": s["dropped"], "retries": s["retries"], "queries": queries,
+            "write_behind": {"flushes": _writes.flushes, "rows": _writes.rows, "failed": _writes.failed,
+                             "rejected": _writes.rejected, "dropped": _writes.dropped}}
+
+
+def close_pool():
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close_all()
+
+
+# ----- Write-behind buffer -----
+class _WriteBuffer:
+    """Collects user_prefs / spins / contacts writes and flushes them as multi-row statements
+    every FLUSH_INTERVAL or FLUSH_SIZE writes (and at exit). user_prefs keeps the last write per
+    chat, spins the first per chat and day (as ON CONFLICT DO NOTHING would). Reads in this process
+    see pending writes (read-your-writes) until the flush has committed. A batch that fails on the
+    connection is put back and retried on the next flush; one the DB rejects (bad data) is split
+    until the bad rows are found and dropped. While the DB is down each table keeps at most
+    BUFFER_MAX writes (oldest dropped first), so an outage costs bounded memory, not a crash."""
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self.langs, self.spins, self.contacts = {}, {}, []
+        self._inflight = ({}, {})                # (langs, spins) being written right now
+        self.flushes = self.rows = self.failed = 0
+        self.rejected = self.dropped = 0        # rows the DB refused / rows over BUFFER_MAX
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():            # lazily, and again in a forked child
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="db-write-behind", daemon=True).start()
+
+    def _pending(self):
+        return len(self.langs) + len(self.spins) + len(self.contacts)
+
+    def set_lang(self, chat_id, lang):
+        with self._cv:
+            self._ensure_thread()
+            self.langs[chat_id] = lang
+            self._kick()
+
+    def add_spin(self, chat_id, day, prize):
+        with self._cv:
+            self._ensure_thread()
+            self.spins.setdefault((chat_id, day), prize)
+            self._kick()
+
+    def add_contact(self, row):
+        with self._cv:
+            self._ensure_thread()
+            self.contacts.append(row)
+            self._kick()
+
+    def _kick(self):
+        self._trim()
+        if self._pending() >= FLUSH_SIZE:
+            self._cv.notify()
+
+    def _trim(self):
+        """Drop the oldest writes over BUFFER_MAX per table. Lock held."""
+        for d in (self.langs, self.spins):
+            while len(d) > BUFFER_MAX:
+                del d[next(iter(d))]
+                self.dropped += 1
+        if len(self.contacts) > BUFFER_MAX:
+            self.dropped += len(self.contacts) - BUFFER_MAX
+            del self.contacts[:len(self.contacts) - BUFFER_MAX]
+
+    def lang(self, chat_id):
+        with self._cv:
+            return self.langs.get(chat_id) or self._inflight[0].get(chat_id)
+
+    def has_spin(self, chat_id, day):
+        with self._cv:
+            return (chat_id, day) in self.spins or (chat_id, day) in self._inflight[1]
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                self._cv.wait(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cv:
+                langs, spins, contacts = self.langs, self.spins, self.contacts
+                if not (langs or spins or contacts):
+                    return
+                self.langs, self.spins, self.contacts = {}, {}, []
+                self._inflight = (langs, spins)
+            retry = (list(langs.items()), [(chat, day, prize) for (chat, day), prize in spins.items()], contacts)
+            written, bad = sum(map(len, retry)), []
+            try:
+                retry = _flush_writes(*retry, bad)
+            finally:
+                with self._cv:
+                    # what failed on the connection goes back in front of what was buffered meanwhile
+                    self.langs = {**dict(retry[0]), **self.langs}
+                    for chat, day, prize in retry[1]:
+                        self.spins.setdefault((chat, day), prize)
+                    self.contacts = retry[2] + self.contacts
+                    self._inflight = ({}, {})
+                    kept = sum(map(len, retry))
+                    if kept:
+                        self.failed += 1
+                    else:
+                        self.flushes += 1
+                    self.rejected += len(bad)
+                    self.rows += written - kept - len(bad)
+                    self._trim()
+            if kept:
+                print(f"[DB] write-behind flush failed, {self._pending()} writes kept for retry")
+
+
+def _write_rows(sql, rows, name, bad):
+    """One multi-row statement; returns the rows to retry. A batch the DB rejects is split in
+    halves until the offending rows are found; those go to `bad`, the rest is written."""
+    ok = _run_values(sql, rows, None, name)
+    if ok:
+        return []
+    if ok is False:                             # connection trouble: keep all of it for the next flush
+        return rows
+    if len(rows) == 1:
+        print(f"[DB] {name}: dropped a row the DB rejects (chat {rows[0][0]})")
+        bad.append(rows[0])
+        return []
+    mid = len(rows) // 2
+    return _write_rows(sql, rows[:mid], name, bad) + _write_rows(sql, rows[mid:], name, bad)
+
+
+def _flush_writes(langs, spins, contacts, bad):
+    """Write one batch per table (lists of rows); returns the rows to retry per table.
+    Rows the DB refuses are appended to `bad`."""
+    langs = _write_rows("INSERT INTO user_prefs (chat_id, lang) VALUES %s "
+                        "ON CONFLICT (chat_id) DO UPDATE SET lang=EXCLUDED.lang, updated_at=now()",
+                        langs, "set_user_lang_batch", bad)
+    sql = "INSERT INTO spins (chat_id, spin_date, prize) VALUES %s ON CONFLICT (chat_id, spin_date) DO NOTHING"
+    if DAILY_STATS:
+        sql = ("WITH ins AS (" + sql + " RETURNING spin_date) INSERT INTO daily_stats (day, metric, label, n) "
+               "SELECT spin_date, 'spins', '', count(*) FROM ins GROUP BY spin_date "
+               "ON CONFLICT (day, metric, label) DO UPDATE SET n = daily_stats.n + EXCLUDED.n")
+    spins = _write_rows(sql, spins, "record_spin_batch", bad)
+    sql = "INSERT INTO contacts (chat_id, name, phone, source, extra) VALUES %s"
+    if DAILY_STATS:
+        sql = ("WITH ins AS (" + sql + " RETURNING (created_at AT TIME ZONE 'Asia/Almaty')::date AS day) "
+               "INSERT INTO daily_stats (day, metric, label, n) SELECT day, 'contacts', '', count(*) FROM ins "
+               "GROUP BY day ON CONFLICT (day, metric, label) DO UPDATE SET n = daily_stats.n + EXCLUDED.n")
+    contacts = _write_rows(sql, contacts, "save_contact_batch", bad)
+    return langs, spins, contacts
+
+
+_writes = _WriteBuffer()
+atexit.register(_writes.flush)
+
+
+def flush_writes():
+    """Write out buffered writes now (shutdown hooks, tests)."""
+    _writes.flush()
+
+
+_SCHEMA_LOCK = 0x54534E01        # pg_advisory_xact_lock key: one schema setup at a time across bots/processes
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS contacts (
         id SERIAL PRIMARY KEY,
         chat_id BIGINT,
         name TEXT,
@@ -46,20 +406,20 @@ def init_db():
         source TEXT,
         extra TEXT,
         created_at TIMESTAMPTZ DEFAULT now()
-    )""")
-    _run("""CREATE TABLE IF NOT EXISTS spins (
+    )""",
+    """CREATE TABLE IF NOT EXISTS spins (
         chat_id BIGINT,
         spin_date DATE,
         prize TEXT,
         created_at TIMESTAMPTZ DEFAULT now(),
         PRIMARY KEY (chat_id, spin_date)
-    )""")
-    _run("""CREATE TABLE IF NOT EXISTS user_prefs (
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_prefs (
         chat_id BIGINT PRIMARY KEY,
         lang TEXT,
         updated_at TIMESTAMPTZ DEFAULT now()
-    )""")
-    _run("""CREATE TABLE IF NOT EXISTS prizes (
+    )""",
+    """CREATE TABLE IF NOT EXISTS prizes (
         code TEXT PRIMARY KEY,
         chat_id BIGINT,
         prize_key TEXT,
@@ -70,23 +430,135 @@ def init_db():
         created_at TIMESTAMPTZ DEFAULT now(),
         redeemed_at TIMESTAMPTZ,
         redeemed_by BIGINT
-    )""")
-    _run("""CREATE TABLE IF NOT EXISTS daily_reports (
+    )""",
+    """CREATE TABLE IF NOT EXISTS prize_codes (
+        code TEXT PRIMARY KEY,
+        created_at TIMESTAMPTZ DEFAULT now()
+    )""",
+    """CREATE TABLE IF NOT EXISTS daily_reports (
         report_date DATE PRIMARY KEY,
         sent_at TIMESTAMPTZ DEFAULT now()
-    )""")
-    print("[DB] init OK")
+    )""",
+    """CREATE TABLE IF NOT EXISTS wa_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id TEXT,
+        kind TEXT,
+        payload TEXT,
+        priority INT DEFAULT 0,
+        attempts INT DEFAULT 0,
+        next_at TIMESTAMPTZ DEFAULT now(),
+        created_at TIMESTAMPTZ DEFAULT now()
+    )""",
+    # report / redemption filters
+    "CREATE INDEX IF NOT EXISTS prizes_valid_date_status_idx ON prizes (valid_date, status)",
+    "CREATE INDEX IF NOT EXISTS spins_spin_date_idx ON spins (spin_date)",
+    "CREATE INDEX IF NOT EXISTS contacts_created_at_idx ON contacts (created_at)",
+    # every issue / redeem is announced on the `prizes` channel (redemption.py keeps caches current)
+    """CREATE OR REPLACE FUNCTION prizes_notify() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('prizes', json_build_object('code', NEW.code, 'prize_key', NEW.prize_key,
+            'prize_label', NEW.prize_label, 'role', NEW.role, 'status', NEW.status,
+            'valid_date', NEW.valid_date)::text);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS prizes_notify ON prizes",
+    "CREATE TRIGGER prizes_notify AFTER INSERT OR UPDATE OF status ON prizes "
+    "FOR EACH ROW EXECUTE FUNCTION prizes_notify()",
+]
+# per-day counters maintained by the write functions; report_data reads them as they are. They drift
+# while something writes without bumping them (DB_DAILY_STATS off for a while, a bot on an older db.py),
+# so reconcile_daily_stats() re-counts days from the source tables: the whole history once when the
+# table is new, the last RECONCILE_DAYS days at every init_db, and whatever a nightly job asks for.
+_STATS_REBUILD = """WITH h (day, metric, label, n) AS (
+        SELECT spin_date, 'spins', '', count(*) FROM spins {spins} GROUP BY spin_date
+        UNION ALL SELECT valid_date, 'won', prize_label, count(*) FROM prizes {prizes} GROUP BY valid_date, prize_label
+        UNION ALL SELECT valid_date, 'redeemed', '', count(*) FROM prizes {prizes_and} status='redeemed'
+            GROUP BY valid_date
+        UNION ALL SELECT (created_at AT TIME ZONE 'Asia/Almaty')::date, 'contacts', '', count(*) FROM contacts
+            {contacts} GROUP BY 1),
+    stale AS (DELETE FROM daily_stats d WHERE {stale} NOT EXISTS
+        (SELECT 1 FROM h WHERE h.day=d.day AND h.metric=d.metric AND h.label=d.label) RETURNING 1),
+    up AS (INSERT INTO daily_stats (day, metric, label, n) SELECT * FROM h
+        ON CONFLICT (day, metric, label) DO UPDATE SET n=EXCLUDED.n WHERE daily_stats.n <> EXCLUDED.n RETURNING 1)
+    SELECT (SELECT count(*) FROM stale) + (SELECT count(*) FROM up)"""
+_STATS_REBUILD_ALL = _STATS_REBUILD.format(spins="", prizes="", prizes_and="WHERE", contacts="", stale="")
+# days >= %s (the same date in all five places)
+_STATS_REBUILD_SINCE = _STATS_REBUILD.format(
+    spins="WHERE spin_date >= %s", prizes="WHERE valid_date >= %s", prizes_and="WHERE valid_date >= %s AND",
+    contacts="WHERE created_at >= %s::date::timestamp AT TIME ZONE 'Asia/Almaty'", stale="d.day >= %s AND")
+_DAILY_STATS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS daily_stats (
+        day DATE,
+        metric TEXT,
+        label TEXT DEFAULT '',
+        n BIGINT DEFAULT 0,
+        PRIMARY KEY (day, metric, label)
+    )""",
+]
+
+
+def _reconcile(cur, since):
+    if since is None:
+        cur.execute(_STATS_REBUILD_ALL)
+    else:
+        cur.execute(_STATS_REBUILD_SINCE, (since,) * 5)
+    return cur.fetchone()[0]
+
+
+def reconcile_daily_stats(since):
+    """Re-count daily_stats for days >= `since` (None = all history) from the source tables.
+    Returns how many counters were corrected, None if the DB is unreachable."""
+    if not (DATABASE_URL and DAILY_STATS):
+        return 0
+    fixed = _with_conn(lambda conn, cur: _reconcile(cur, since), "reconcile_daily_stats", None)
+    if fixed:
+        print(f"[DB] daily_stats: {fixed} counters corrected since {since or 'the start'}")
+    return fixed
+
+
+def init_db():
+    """Create tables and indexes in one transaction on one connection. Run it once per deploy
+    (gunicorn.conf.py does it in the master before forking), not in every worker."""
+    if not DATABASE_URL:
+        print("[DB] DATABASE_URL not set — DB disabled, bot runs without persistence")
+        return
+    stmts = _SCHEMA + (_DAILY_STATS_SCHEMA if DAILY_STATS else [])
+
+    def work(conn, cur):
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK,))
+        for sql in stmts:
+            cur.execute(sql)
+        if DAILY_STATS:                         # a new table is backfilled, an old one re-counts recent days
+            cur.execute("SELECT EXISTS (SELECT 1 FROM daily_stats)")
+            since = spin_day() - datetime.timedelta(days=RECONCILE_DAYS - 1) if cur.fetchone()[0] else None
+            return _reconcile(cur, since), since
+        return 0, None
+    done = _with_conn(work, "init_db", None)
+    if done:
+        print("[DB] init OK" + (f", daily_stats: {done[0]} counters corrected since {done[1] or 'the start'}"
+                                if done[0] else ""))
 
 
 # ----- Prizes -----
+_BUMP = ("INSERT INTO daily_stats (day, metric, label, n) SELECT {day}, '{metric}', {label}, 1 FROM {src} "
+         "ON CONFLICT (day, metric, label) DO UPDATE SET n = daily_stats.n + 1")
+
+
 def create_prize(code, chat_id, prize_key, prize_label, role, valid_date):
+    if DAILY_STATS:
+        _run("WITH ins AS (INSERT INTO prizes (code, chat_id, prize_key, prize_label, role, valid_date) "
+             "VALUES (%s,%s,%s,%s,%s,%s) RETURNING valid_date, prize_label) "
+             + _BUMP.format(day="valid_date", metric="won", label="prize_label", src="ins"),
+             (code, chat_id, prize_key, prize_label, role, valid_date), name="create_prize_stats")
+        return
     _run("INSERT INTO prizes (code, chat_id, prize_key, prize_label, role, valid_date) "
-         "VALUES (%s,%s,%s,%s,%s,%s)", (code, chat_id, prize_key, prize_label, role, valid_date))
+         "VALUES (%s,%s,%s,%s,%s,%s)", (code, chat_id, prize_key, prize_label, role, valid_date),
+         name="create_prize")
 
 
 def get_prize(code):
     row = _run("SELECT prize_key, prize_label, role, status, valid_date FROM prizes WHERE code=%s",
-               (code,), fetch=True)
+               (code,), fetch=True, name="get_prize")
     if not row:
         return None
     return {"prize_key": row[0], "prize_label": row[1], "role": row[2], "status": row[3], "valid_date": row[4]}
@@ -94,66 +566,208 @@ def get_prize(code):
 
 def redeem_prize(code, staff_id, today):
     """Atomically redeem if issued and valid today. Returns prize_label or None."""
+    if DAILY_STATS:
+        row = _run("WITH upd AS (UPDATE prizes SET status='redeemed', redeemed_at=now(), redeemed_by=%s "
+                   "WHERE code=%s AND status='issued' AND valid_date=%s RETURNING prize_label, valid_date), "
+                   "st AS (" + _BUMP.format(day="valid_date", metric="redeemed", label="''", src="upd") + ") "
+                   "SELECT prize_label FROM upd",
+                   (staff_id, code, today), fetch=True, name="redeem_prize_stats")
+        return row[0] if row else None
     row = _run("UPDATE prizes SET status='redeemed', redeemed_at=now(), redeemed_by=%s "
                "WHERE code=%s AND status='issued' AND valid_date=%s RETURNING prize_label",
-               (staff_id, code, today), fetch=True)
+               (staff_id, code, today), fetch=True, name="redeem_prize")
     return row[0] if row else None
 
 
+def prize_index():
+    """Every issued code as (code, status, valid_date, prize_key, prize_label, role) rows.
+    None if the DB is unreachable."""
+    if not DATABASE_URL:
+        return None
+
+    def work(conn, cur):
+        _execute(conn, cur, "SELECT code, status, valid_date, prize_key, prize_label, role FROM prizes", (),
+                 "prize_index")
+        return cur.fetchall()
+    return _with_conn(work, "prize_index", None)
+
+
+def listen(channel):
+    """Own autocommit connection LISTENing on `channel` (not pooled: it idles in select() for hours;
+    needs a session, so not through pgbouncer transaction pooling). The caller closes it."""
+    conn = psycopg2.connect(DATABASE_URL, connect_timeout=10)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("LISTEN " + channel)
+    return conn
+
+
+def spin(chat_id, prize_key, prize_label, role, real, valid_date, fallback_code):
+    """Today's spin and, for a real prize, its redemption code in one statement.
+    Returns (spun, code, pooled): spun=False if the chat already spun today (nothing written);
+    code is taken from the prize_codes pool (pooled=True), or fallback_code if the pool is empty.
+    Concurrent spins of one chat serialise on the spins primary key: exactly one wins."""
+    if not DATABASE_URL:
+        return True, (fallback_code if real else None), False
+    day = spin_day()
+    if _writes.has_spin(chat_id, day):          # buffered by record_spin, not flushed yet
+        return False, None, False
+    sql = ("WITH s AS (INSERT INTO spins (chat_id, spin_date, prize) VALUES (%s, %s::date, %s) "
+           "ON CONFLICT (chat_id, spin_date) DO NOTHING RETURNING spin_date), "
+           "c AS (DELETE FROM prize_codes WHERE code = (SELECT code FROM prize_codes "
+           "WHERE %s::boolean AND EXISTS (SELECT 1 FROM s) ORDER BY code LIMIT 1 FOR UPDATE SKIP LOCKED) "
+           "RETURNING code), "
+           "p AS (INSERT INTO prizes (code, chat_id, prize_key, prize_label, role, valid_date) "
+           "SELECT COALESCE((SELECT code FROM c), %s::text), %s, %s, %s, %s, %s::date FROM s WHERE %s::boolean "
+           "RETURNING code, valid_date, prize_label)")
+    name = "spin"
+    if DAILY_STATS:
+        sql += (", st1 AS (" + _BUMP.format(day="spin_date", metric="spins", label="''", src="s") + "), "
+                "st2 AS (" + _BUMP.format(day="valid_date", metric="won", label="prize_label", src="p") + ")")
+        name = "spin_stats"
+    sql += " SELECT (SELECT count(*) FROM s), (SELECT code FROM p), (SELECT count(*) FROM c)"
+    row = _run(sql, (chat_id, day, prize_key, real, fallback_code, chat_id, prize_key, prize_label, role,
+                     valid_date, real), fetch=True, name=name)
+    if not row:                                 # DB trouble: allow, like can_spin_today
+        return True, (fallback_code if real else None), False
+    return bool(row[0]), row[1], bool(row[2])
+
+
+def add_prize_codes(codes):
+    """Stock the code pool in one round trip; codes already pooled or issued are skipped."""
+    return _run_values("INSERT INTO prize_codes (code) SELECT v.code FROM (VALUES %s) v(code) "
+                       "WHERE NOT EXISTS (SELECT 1 FROM prizes p WHERE p.code = v.code) ON CONFLICT DO NOTHING",
+                       [(c,) for c in codes], None, "add_prize_codes")
+
+
+def prize_code_stock():
+    row = _run("SELECT count(*) FROM prize_codes", fetch=True, name="prize_code_stock")
+    return row[0] if row else 0
+
+
+# ----- WhatsApp outbox (sends parked for retry / across restarts) -----
+def outbox_push(chat_id, kind, payload, priority, attempts, delay_s):
+    _run("INSERT INTO wa_outbox (chat_id, kind, payload, priority, attempts, next_at) "
+         "VALUES (%s,%s,%s,%s,%s, now() + make_interval(secs => %s))",
+         (chat_id, kind, payload, priority, attempts, delay_s), name="outbox_push")
+
+
+def outbox_claim(limit):
+    """Take up to `limit` due sends off the queue (safe with several processes polling)."""
+    return _run("DELETE FROM wa_outbox WHERE id IN (SELECT id FROM wa_outbox WHERE next_at <= now() "
+                "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+                "RETURNING chat_id, kind, payload, priority, attempts",
+                (limit,), many=True, name="outbox_claim")
+
+
 # ----- Daily report -----
 def report_data(day, day_start_utc):
-    spins = (_run("SELECT count(*) FROM spins WHERE spin_date=%s", (day,), fetch=True) or [0])[0]
-    won = _run("SELECT prize_label, count(*) FROM prizes WHERE valid_date=%s GROUP BY prize_label ORDER BY 2 DESC",
-               (day,), many=True) or []
-    redeemed = (_run("SELECT count(*) FROM prizes WHERE valid_date=%s AND status='redeemed'", (day,), fetch=True) or [0])[0]
-    contacts = (_run("SELECT count(*) FROM contacts WHERE created_at >= %s", (day_start_utc,), fetch=True) or [0])[0]
-    return {"spins": spins, "won": won, "redeemed": redeemed, "contacts": contacts}
+    """One round trip: with DB_DAILY_STATS the day's counters as they are (a primary-key range read;
+    reconcile_daily_stats keeps them exact), else one aggregate over the indexed tables."""
+    if DAILY_STATS:
+        rows = _run("SELECT metric, label, n FROM daily_stats WHERE day=%s", (day,), many=True,
+                    name="report_daily_stats") or []
+        out = {"spins": 0, "won": [], "redeemed": 0, "contacts": 0}
+        for metric, label, n in rows:
+            if metric == "won":
+                out["won"].append((label, n))
+            else:
+                out[metric] = n
+        out["won"].sort(key=lambda r: r[1], reverse=True)
+        return out
+    row = _run("""WITH won AS (
+            SELECT prize_label, count(*) AS n, count(*) FILTER (WHERE status='redeemed') AS redeemed
+            FROM prizes WHERE valid_date=%s GROUP BY prize_label)
+        SELECT (SELECT count(*) FROM spins WHERE spin_date=%s),
+               (SELECT coalesce(json_agg(json_build_array(prize_label, n) ORDER BY n DESC), '[]') FROM won),
+               (SELECT coalesce(sum(redeemed), 0)::bigint FROM won),
+               (SELECT count(*) FROM contacts WHERE created_at >= %s)""",
+               (day, day, day_start_utc), fetch=True, name="report_data")
+    if not row:
+        return {"spins": 0, "won": [], "redeemed": 0, "contacts": 0}
+    return {"spins": row[0], "won": [tuple(w) for w in row[1]], "redeemed": row[2], "contacts": row[3]}
 
 
 def report_sent(day):
-    return _run("SELECT 1 FROM daily_reports WHERE report_date=%s", (day,), fetch=True) is not None
+    return _run("SELECT 1 FROM daily_reports WHERE report_date=%s", (day,), fetch=True,
+                name="report_sent") is not None
 
 
 def mark_report(day):
-    _run("INSERT INTO daily_reports (report_date) VALUES (%s) ON CONFLICT DO NOTHING", (day,))
+    _run("INSERT INTO daily_reports (report_date) VALUES (%s) ON CONFLICT DO NOTHING", (day,), name="mark_report")
 
 
 def get_user_lang(chat_id):
     if not DATABASE_URL:
         return None
-    row = _run("SELECT lang FROM user_prefs WHERE chat_id=%s", (chat_id,), fetch=True)
+    pending = _writes.lang(chat_id)
+    if pending:
+        return pending
+    row = _run("SELECT lang FROM user_prefs WHERE chat_id=%s", (chat_id,), fetch=True, name="get_user_lang")
     return row[0] if row else None
 
 
 def set_user_lang(chat_id, lang):
+    if WRITE_BEHIND and DATABASE_URL:
+        _writes.set_lang(chat_id, lang)
+        return
     _run("INSERT INTO user_prefs (chat_id, lang) VALUES (%s, %s) "
          "ON CONFLICT (chat_id) DO UPDATE SET lang=EXCLUDED.lang, updated_at=now()",
-         (chat_id, lang))
+         (chat_id, lang), name="set_user_lang")
 
 
 def save_contact(chat_id, name, phone, source="booking", extra=None):
     """Store a guest contact (name + phone). Called when a booking is completed."""
+    if WRITE_BEHIND and DATABASE_URL:
+        _writes.add_contact((chat_id, name, phone, source, extra))
+        return
+    if DAILY_STATS:
+        _run("WITH ins AS (INSERT INTO contacts (chat_id, name, phone, source, extra) VALUES (%s,%s,%s,%s,%s) "
+             "RETURNING (created_at AT TIME ZONE 'Asia/Almaty')::date AS day) "
+             + _BUMP.format(day="day", metric="contacts", label="''", src="ins"),
+             (chat_id, name, phone, source, extra), name="save_contact_stats")
+        return
     _run(
         "INSERT INTO contacts (chat_id, name, phone, source, extra) VALUES (%s,%s,%s,%s,%s)",
-        (chat_id, name, phone, source, extra),
+        (chat_id, name, phone, source, extra), name="save_contact",
     )
 
 
+def spin_day():
+    """Today in Almaty. Every spin path (spin, can_spin_today, record_spin, buffered or not) passes
+    this to the SQL instead of CURRENT_DATE, so the buffer and the DB agree on the day whatever the
+    server's or the session's time zone."""
+    return datetime.datetime.now(ALMATY).date()
+
+
 def can_spin_today(chat_id):
     """True if this chat has NOT spun the wheel yet today. No DB -> allow."""
     if not DATABASE_URL:
         return True
+    day = spin_day()
+    if _writes.has_spin(chat_id, day):
+        return False
     row = _run(
-        "SELECT 1 FROM spins WHERE chat_id=%s AND spin_date=CURRENT_DATE",
-        (chat_id,), fetch=True,
+        "SELECT 1 FROM spins WHERE chat_id=%s AND spin_date=%s",
+        (chat_id, day), fetch=True, name="can_spin_today",
     )
     return row is None
 
 
 def record_spin(chat_id, prize):
     """Mark today's spin for this chat (idempotent per day)."""
+    day = spin_day()                            # the day it happened, not the day it flushes
+    if WRITE_BEHIND and DATABASE_URL:
+        _writes.add_spin(chat_id, day, prize)
+        return
+    if DAILY_STATS:
+        _run("WITH ins AS (INSERT INTO spins (chat_id, spin_date, prize) VALUES (%s, %s::date, %s) "
+             "ON CONFLICT (chat_id, spin_date) DO NOTHING RETURNING spin_date) "
+             + _BUMP.format(day="spin_date", metric="spins", label="''", src="ins"),
+             (chat_id, day, prize), name="record_spin_stats")
+        return
     _run(
-        "INSERT INTO spins (chat_id, spin_date, prize) VALUES (%s, CURRENT_DATE, %s) "
+        "INSERT INTO spins (chat_id, spin_date, prize) VALUES (%s, %s::date, %s) "
         "ON CONFLICT (chat_id, spin_date) DO NOTHING",
-        (chat_id, prize),
+        (chat_id, day, prize), name="record_spin",
     )
@@ -0,0 +1,109 @@
+"""Per-chat debounce for free-text messages.
+Guests often type one question as several quick messages ("а сколько вход",
+"в субботу", "на 5 человек"). add() buffers them per chat; once the chat has
+been quiet for WINDOW seconds (or MAX_WAIT after its first fragment, or after
+MAX_PARTS fragments) a timer thread hands the batch to on_ready(key, items),
+which queues one answer for all of them. take() lets the chat's own worker
+claim the batch early, e.g. when a menu command must be answered after it.
+"""
+import heapq
+import os
+import threading
+import time
+import traceback
+
+WINDOW = float(os.getenv("DEBOUNCE_SECONDS", "1.5"))       # 0 = answer every message on its own
+MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", "6"))
+MAX_PARTS = 8
+RETRY = 0.5                                                 # on_ready refused (queue full): try again in
+
+
+class Debouncer:
+    def __init__(self, on_ready, window=WINDOW, max_wait=MAX_WAIT, max_parts=MAX_PARTS):
+        """on_ready(key, items) -> False to have the batch retried a little later."""
+        self.on_ready = on_ready
+        self.window, self.max_wait, self.max_parts = window, max_wait, max_parts
+        self._cv = threading.Condition()
+        self._pending = {}                      # key -> [first_at, due, items]
+        self._heap = []                         # (due, key); stale entries are skipped
+        self._thread = None
+        self.batches = self.parts = self.retried = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, key, item):
+        now = time.monotonic()
+        with self._cv:
+            p = self._pending.get(key)
+            if p is None:
+                p = self._pending[key] = [now, now, []]
+            p[2].append(item)
+            p[1] = now if len(p[2]) >= self.max_parts else min(now + self.window, p[0] + self.max_wait)
+            heapq.heappush(self._heap, (p[1], key))
+            if self._thread is None:            # started lazily: safe to create before a fork
+                self._thread = threading.Thread(target=self._loop, name="wa-debounce", daemon=True)
+                self._thread.start()
+            self._cv.notify()
+
+    def pending(self, key):
+        with self._cv:
+            return key in self._pending
+
+    def take(self, key):
+        """Claim the chat's buffered items now (None if there are none)."""
+        with self._cv:
+            p = self._pending.pop(key, None)
+        return p[2] if p else None
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                now = time.monotonic()
+                while not self._heap or self._heap[0][0] > now:
+                    self._cv.wait(self._heap[0][0] - now if self._heap else None)
+                    now = time.monotonic()
+                key = heapq.heappop(self._heap)[1]
+                p = self._pending.get(key)
+                if p is None or p[1] > now:             # taken already, or extended by a newer fragment
+                    continue
+                del self._pending[key]
+            self._ready(key, p[2])
+
+    def _ready(self, key, items):
+        try:
+            ok = self.on_ready(key, items) is not False
+        except Exception:
+            print("[DEBOUNCE] on_ready failed:"); traceback.print_exc()
+            ok = True                           # don't loop on a broken batch
+        with self._cv:
+            if ok:
+                self.batches += 1
+                self.parts += len(items)
+                return
+            self.retried += 1
+            now = time.monotonic()
+            p = self._pending.get(key)
+            if p is None:
+                p = self._pending[key] = [now, now + RETRY, []]
+            p[1] = min(p[1], now + RETRY)
+            p[2][:0] = items                    # keep arrival order ahead of anything newer
+            heapq.heappush(self._heap, (p[1], key))
+            self._cv.notify()
+
+    def flush_all(self):
+        """Hand over every buffered batch now (shutdown)."""
+        with self._cv:
+            batches = [(k, p[2]) for k, p in self._pending.items()]
+            self._pending.clear()
+            self._heap.clear()
+        for key, items in batches:
+            self._ready(key, items)
+
+    def stats(self):
+        with self._cv:
+            return {"window_s": self.window, "pending_chats": len(self._pending), "batches": self.batches,
+                    "messages": self.parts,
+                    "avg_batch": round(self.parts / self.batches, 2) if self.batches else 0.0,
+                    "retried": self.retried}
@@ -0,0 +1,37 @@
+"""gunicorn settings for production: `gunicorn -c gunicorn.conf.py main:app` (see Procfile).
+gthread workers: each process serves webhooks on a thread pool and runs its own
+WorkerPool / Outbox threads. The app is preloaded in the master, which runs the
+schema migrations once (on_starting) before forking.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gthread"
+# several processes need REDIS_URL: per-chat ordering (WorkerPool), the free-text debounce and the
+# language-switch votes are per process, and the Redis chat lease (state.RedisState.owner_of) sends
+# every message of a chat to the one process holding it. Without Redis keep one process.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("WEB_THREADS", "8"))
+preload_app = True
+timeout = 60
+keepalive = 5
+# SIGTERM: stop accepting, finish requests, then main.shutdown() drains queued/in-flight LLM work
+graceful_timeout = int(float(os.getenv("DRAIN_TIMEOUT", "20"))) + 10
+accesslog = None
+
+
+def on_starting(server):
+    import db
+    import main
+    main.init_once()
+    db.close_pool()         # workers must not inherit the master's pooled connection (one socket, many forks)
+
+
+def post_fork(server, worker):
+    import main
+    main.post_fork()
+
+
+def worker_exit(server, worker):
+    import main
+    main.shutdown()
@@ -0,0 +1,139 @@
+"""Shared outbound HTTP layer for Green API and OpenRouter.
+One keep-alive requests.Session per provider (pooled connections), bounded
+retries with jittered exponential backoff on 429/5xx and connection errors,
+and a circuit breaker that fails fast with CircuitOpen while a provider is
+down, so callers can serve their canned fallback instead of waiting on
+timeouts. Latency of every attempt goes to the wa_http_request_seconds
+histogram (provider, endpoint labels) on /metrics.
+"""
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))           # first retry delay, seconds (x2 each time)
+BACKOFF_CAP = 8.0
+BREAKER_FAILURES = int(os.getenv("HTTP_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("HTTP_BREAKER_COOLDOWN", "30"))
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+_LATENCY = metrics.histogram("wa_http_request_seconds", "Outbound HTTP attempt time", ("provider", "endpoint"))
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Breaker:
+    """closed -> (N consecutive failures) -> open -> (cooldown) -> half-open: one probe decides."""
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.fails = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+                return True                         # the probe
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state, self.fails = "closed", 0
+
+    def failure(self):
+        with self._lock:
+            self.fails += 1
+            if self.state == "half-open" or self.fails >= self.failures:
+                if self.state != "open":
+                    self.trips += 1
+                self.state, self.opened_at = "open", time.monotonic()
+
+
+class Client:
+    def __init__(self, name, retries=RETRIES, pool_size=10, breaker=None):
+        self.name = name
+        self.retries = retries
+        self.breaker = breaker or Breaker()
+        self.pool_size = pool_size
+        self.session = self._session()
+        self.retried = 0
+
+    def _session(self):
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        return s
+
+    def reset(self):
+        """New connection pool, e.g. in a forked worker. The old session is dropped, not closed:
+        its sockets may still be the parent's."""
+        self.session = self._session()
+
+    def _observe(self, endpoint, seconds):
+        _LATENCY.observe(seconds, self.name, endpoint)
+
+    def post(self, endpoint, url, **kw):
+        return self.request("POST", endpoint, url, **kw)
+
+    def get(self, endpoint, url, **kw):
+        return self.request("GET", endpoint, url, **kw)
+
+    def request(self, method, endpoint, url, **kw):
+        """Request with retries. Returns the last response (caller checks .ok); raises CircuitOpen
+        when the provider is marked down, or the last connection error once retries are spent."""
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name} circuit open")
+        for attempt in range(self.retries + 1):
+            t0 = time.monotonic()
+            try:
+                r = self.session.request(method, url, **kw)
+            except requests.ConnectionError:           # incl. ConnectTimeout and stale keep-alive sockets
+                # not ReadTimeout: the provider may already be working on it (LLM) or have sent it (WA)
+                self._observe(endpoint, time.monotonic() - t0)
+                if attempt == self.retries:
+                    self.breaker.failure()
+                    raise
+                delay = None
+            except Exception:
+                self._observe(endpoint, time.monotonic() - t0)
+                self.breaker.failure()
+                raise
+            else:
+                self._observe(endpoint, time.monotonic() - t0)
+                if r.status_code not in RETRY_STATUSES:
+                    self.breaker.success()
+                    return r
+                if attempt == self.retries:
+                    self.breaker.failure()
+                    return r
+                delay = _retry_after(r)
+                r.close()
+            self.retried += 1
+            time.sleep(delay if delay is not None else
+                       random.uniform(0, min(BACKOFF_CAP, BACKOFF * 2 ** attempt)))   # full jitter
+
+    def stats(self):
+        return {"breaker": self.breaker.state, "trips": self.breaker.trips, "retried": self.retried,
+                "latency": {ep: _LATENCY.snapshot(name, ep) for name, ep in _LATENCY.series() if name == self.name}}
+
+
+def _retry_after(r):
+    try:
+        return min(BACKOFF_CAP, float(r.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
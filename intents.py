@@ -0,0 +1,111 @@
+"""Local intent router: answers menu-type questions (RU/KK/EN) without the LLM.
+Each intent has weighted regex rules, compiled once at import. A message scores
+every intent; confidence = dominance of the best intent over the runner-up x the
+share of words explained by the matched rules (plus filler words). Long or mixed
+questions therefore score low and fall through to the LLM.
+The labelled set is in tests/test_intents.py.
+"""
+import re
+import threading
+
+THRESHOLD = 0.75            # route to menu_action at/above this
+THRESHOLD_CTX = 0.9         # ... when the chat already has LLM history (follow-ups are context-dependent)
+
+_RULES = {
+    "prices": [
+        (r"сколько\s+сто", 1.0), (r"стоимост", 1.0), (r"\bцен[аыуе]?\b", 1.0), (r"прайс", 1.0),
+        (r"поч[её]м", 1.0), (r"\bвход\w*", 0.5), (r"\bбилет\w*", 0.5), (r"\bсколько\b", 0.3),
+        (r"баға", 1.0), (r"қанша\s+тұрады", 1.0), (r"құны", 1.0), (r"\bкіру\w*", 0.5), (r"\bқанша\b", 0.3),
+        (r"\bprices?\b", 1.0), (r"how\s+much", 1.0), (r"\bcosts?\b", 1.0), (r"\bentry\b", 0.5),
+        (r"\btickets?\b", 0.5), (r"\bfee\b", 0.5),
+    ],
+    "hours": [
+        (r"до\s+скольк", 1.0), (r"во\s+сколько\s+(?:вы\s+)?(?:открыва|закрыва|работа)", 1.0),
+        (r"час\w*\s+работ", 1.0), (r"режим\s+работ", 1.0), (r"график", 1.0),
+        (r"когда\s+(?:вы\s+)?(?:открыва|закрыва|работа)", 1.0), (r"\bработаете\b", 0.7),
+        (r"\bоткрыт\w*|\bзакрыт\w*", 0.5),
+        (r"жұмыс\s+уақыт", 1.0), (r"нешеге\s+дейін", 1.0), (r"қашан\s+(?:ашыла|жабыла)", 1.0),
+        (r"сағат\s+нешеде", 1.0), (r"\bашықсыз", 0.7),
+        (r"\bhours\b", 1.0), (r"what\s+time", 1.0), (r"\bopen(?:ing)?\b", 0.7), (r"\bclos(?:e|ing)\b", 0.7),
+    ],
+    "location": [
+        (r"где\s+(?:вы|находит|располож)", 1.0), (r"\bадрес\w*", 1.0), (r"как\s+(?:к\s+вам\s+)?(?:добрат|доехат|проехат|найти)", 1.0),
+        (r"локаци", 1.0), (r"геолокац", 1.0), (r"\bгде\b", 0.5), (r"\bнаходит\w*", 0.5),
+        (r"\bқайда\b", 1.0), (r"мекен\s*жай", 1.0), (r"орналас", 1.0), (r"қалай\s+жет", 1.0),
+        (r"where\s+are\s+you(?:\s+located)?", 1.0), (r"\bwhere\b", 0.5), (r"\baddress\b", 1.0), (r"\blocation\b", 1.0), (r"\bdirections?\b", 1.0),
+        (r"how\s+(?:do\s+i\s+|to\s+)?get\s+there", 1.0),
+    ],
+    "bar": [
+        (r"\bбар(?:а|е|у|ом|ы)?\b(?!\s+(?:ма|ме|ба|бе)\b)", 1.0),      # RU forms only; "бар ма" is Kazakh
+        (r"коктейл", 1.0), (r"напит", 1.0), (r"алкогол", 1.0), (r"\bкухн", 0.7),
+        (r"\bеда\b|\bпоесть\b", 0.7), (r"\bпив[оа]\b", 0.7),
+        (r"сусын", 1.0), (r"тамақ", 0.7),
+        (r"\bbar\b", 1.0), (r"\bdrinks?\b", 1.0), (r"cocktails?", 1.0), (r"\bfood\b", 0.7),
+    ],
+    "booking": [
+        (r"брон", 1.0), (r"топчан", 1.0), (r"резерв", 1.0), (r"забронир", 1.0),
+        (r"\bbook(?:ing)?\b", 1.0), (r"reserv", 1.0), (r"loungers?", 1.0),
+    ],
+    "admin": [
+        (r"администратор|\bадмин\w*", 1.0), (r"менеджер", 1.0), (r"оператор", 1.0),
+        (r"номер\s+телефон", 1.0), (r"\bномер\w*", 0.5), (r"позвонить|связаться|\bконтакт\w*", 0.7), (r"живой\s+человек", 1.0),
+        (r"әкімші", 1.0), (r"нөмір", 0.7), (r"хабарлас", 0.7),
+        (r"\badmin\w*", 1.0), (r"\bmanager\b", 1.0), (r"phone\s+number", 1.0), (r"\bcontacts?\b", 0.7),
+        (r"\bcall\b", 0.5), (r"\bhuman\b", 0.7),
+    ],
+}
+_COMPILED = [(intent, re.compile(p), w) for intent, rules in _RULES.items() for p, w in rules]
+_WORD = re.compile(r"\w+")
+# not fillers: "на"/"of" bring in an object ("закрываетесь на зиму", "address of the sauna")
+_FILLER = frozenset((
+    "а", "и", "у", "в", "к", "вы", "вас", "вам", "ли", "ваш", "ваша", "ваши", "это", "скажите", "подскажите",
+    "пожалуйста", "плиз", "мне", "нам", "хочу", "нужен", "нужна", "скиньте", "скинь", "дайте", "с", "со",
+    "поговорить", "меню", "какие", "какая", "какой", "есть", "можно", "как", "там", "до", "по",
+    "сіздер", "сіз", "сіздің", "бар", "ма", "ме", "ба", "бе", "айтыңызшы", "өтінемін", "қандай", "және",
+    "the", "a", "an", "is", "are", "do", "does", "you", "your", "what", "please", "can", "i", "to", "for",
+    "there", "it", "me", "tell", "and", "how", "any", "menu", "send", "want", "with",
+))
+
+
+class Router:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = self.routed = 0
+        self.by_intent = {k: 0 for k in _RULES}
+
+    def classify(self, low):
+        """(intent, confidence) for lowercased text; intent is None when nothing matched."""
+        words = [(m.start(), m.end(), m.group()) for m in _WORD.finditer(low)]
+        if not words:
+            return None, 0.0
+        scores, spans = {}, {}
+        for intent, rx, w in _COMPILED:
+            for m in rx.finditer(low):
+                scores[intent] = scores.get(intent, 0.0) + w
+                spans.setdefault(intent, []).append((m.start(), m.end()))
+        if not scores:
+            return None, 0.0
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        best, top = ranked[0]
+        second = ranked[1][1] if len(ranked) > 1 else 0.0
+        dominance = min(1.0, top) * top / (top + second)
+        covered = sum(1 for s, e, w in words
+                      if w in _FILLER or any(s < me and ms < e for ms, me in spans[best]))
+        return best, round(dominance * covered / len(words), 3)
+
+    def route(self, low, has_history=False):
+        """Intent to answer locally, or None to fall through to the LLM. Counts traffic share."""
+        intent, conf = self.classify(low)
+        ok = intent is not None and conf >= (THRESHOLD_CTX if has_history else THRESHOLD)
+        with self._lock:
+            self.total += 1
+            if ok:
+                self.routed += 1
+                self.by_intent[intent] += 1
+        return intent if ok else None
+
+    def stats(self):
+        with self._lock:
+            return {"seen": self.total, "routed": self.routed,
+                    "offload_share": round(self.routed / self.total, 3) if self.total else 0.0,
+                    "by_intent": dict(self.by_intent)}
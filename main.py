@@ -1,162 +1,558 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Blueprint, Flask, Response, request, jsonify
+import atexit
 import traceback
+import hashlib
+import json
 import os
 import re
 import random
+import signal
+import sys
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
 import pytz
 from dotenv import load_dotenv
 
+import answer_cache
+import cache
 import db
+import debounce
+import http_client
+import intents
+import message
+import metrics
+import outbox
+import prompt_budget
+import state
 import translations as i18n
+import workers
 
 load_dotenv()
 
 SYSTEM_PROMPT_PATH = os.environ.get("SYSTEM_PROMPT_PATH", "system_prompt.txt")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-2.5-flash-lite")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_STREAM = os.getenv("OPENROUTER_STREAM", "0") == "1"  # flush sentences to WhatsApp as they arrive
+STREAM_MIN_CHUNK = int(os.getenv("STREAM_MIN_CHUNK", "250"))    # chars; no tiny messages
 BOT_CHAT_ID = os.environ.get("BOT_CHAT_ID")                 # e.g. 77775885000@c.us
 INSTANCE = os.getenv("GREENAPI_INSTANCE_ID")
 TOKEN = os.getenv("GREENAPI_TOKEN")
-GREEN_HOST = "https://7105.api.greenapi.com"
+GREEN_HOST = os.getenv("GREENAPI_HOST", "https://7105.api.greenapi.com")
+# uploadFile lives on the instance's media host (7105.api.greenapi.com -> 7105.media.greenapi.com);
+# with a host we can't map and no GREENAPI_MEDIA_HOST, uploads stay off
+GREEN_MEDIA_HOST = os.getenv("GREENAPI_MEDIA_HOST") or (
+    GREEN_HOST.replace(".api.greenapi.", ".media.greenapi.", 1) if ".api.greenapi." in GREEN_HOST else None)
+MEDIA_UPLOAD = os.getenv("GREENAPI_UPLOAD_MEDIA", "1") == "1" and bool(GREEN_MEDIA_HOST)  # send files from Green API storage
 
 ADMIN_PHONE = os.getenv("ADMIN_PHONE", "77777195000")
 INSTAGRAM_URL = "https://www.instagram.com/tsunami_almaty"
 GMAPS_URL = "https://www.google.com/maps/search/?api=1&query=43.1624331,76.8991943"
 GIS_URL = "https://go.2gis.com/Jbq8h"
 BOT_USERNAME = os.getenv("BOT_USERNAME", "tsunamiAIBot")    # Telegram bot for prize redemption
-
-with open(SYSTEM_PROMPT_PATH, "r", encoding="utf-8") as f:
-    SYSTEM_PROMPT = f.read()
-
-db.init_db()
-app = Flask(__name__)
+DEBUG = os.getenv("LOG_LEVEL", "info").lower() == "debug"
+WEBHOOK_LOG_SAMPLE = float(os.getenv("WEBHOOK_LOG_SAMPLE", "0.01"))   # share of payloads printed (all when DEBUG)
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))   # s to finish in-flight messages on SIGTERM
+# language hysteresis: a settled chat switches on one confident message or two in a row at LANG_HINT
+LANG_SWITCH = float(os.getenv("LANG_SWITCH", "0.7"))
+LANG_HINT = float(os.getenv("LANG_HINT", "0.35"))
+
+bp = Blueprint("whatsapp", __name__)
 ALMATY = pytz.timezone("Asia/Almaty")
 
-conversation_memory = {}
-processed_ids = set()
-user_lang = {}
-seen = set()                # chat_ids we've already greeted (show menu on first contact)
-
-MENU_WORDS = ("меню", "menu", "мәзір", "0", "/start", "start", "старт")
-GREET_WORDS = ("привет", "приветик", "здравствуй", "здравствуйте", "добрый", "доброе",
-               "хай", "ассалам", "ассалаумағалейкум", "салам", "салем", "сәлем",
-               "сәлеметсіз", "сәлеметсіңіз", "hi", "hello", "hey", "start", "начать")
-CANCEL_WORDS = ("отмена", "cancel", "стоп", "болдырмау", "тоқта")
+greenapi = http_client.Client("greenapi")                  # keep-alive sessions, retries, circuit breaker
+openrouter = http_client.Client("openrouter", retries=1)
+media_origin = http_client.Client("media", retries=1)      # where our images live (fetched once per upload)
+store = state.from_env()    # dedupe, first contact, language cache, chat history
+pool = workers.WorkerPool()
+router = intents.Router()     # menu-type questions answered locally, no LLM
+# repeated FAQ answers; keyed to the prompt+model (see system_prompt()) so edits to either start a fresh cache
+answers = answer_cache.AnswerCache()
+lang_votes = cache.TTLCache(20000, 1800)     # chat -> language of its last weak switch signal
+lang_unset = cache.TTLSet(20000, 1800)       # chats with no language yet (no DB row): "ru" until detected
+
+# /metrics (Prometheus); /stats keeps the JSON view
+WEBHOOKS = metrics.counter("wa_webhook_requests_total", "Webhook calls by outcome", ("status",))
+STAGE = metrics.histogram("wa_stage_seconds", "Time spent per pipeline stage", ("stage",))
+ROUTES = metrics.counter("wa_messages_routed_total", "Handled messages by how they were answered", ("route",))
+BATCHES = metrics.counter("wa_debounce_batches_total", "Buffered free-text bursts by how they were answered "
+                          "(their messages are counted once, as route=buffered)", ("route",))
+LLM_CALLS = metrics.counter("wa_llm_requests_total", "OpenRouter completions", ("mode", "result"))
+LLM_TOKENS = metrics.counter("wa_llm_tokens_total", "OpenRouter tokens (estimated = local count)", ("type",))
+SENDS = metrics.counter("wa_ga_sends_total", "Green API send attempts", ("kind", "result"))
+MERGED = metrics.counter("wa_debounce_merged_total", "Free-text messages answered together with an earlier one")
+metrics.gauge("wa_worker_queue_depth", "Messages waiting for a worker", lambda: pool.depth())
+metrics.gauge("wa_outbox_depth", "Sends waiting in the outbox", lambda: dispatcher.depth())
+metrics.gauge("wa_circuit_open", "1 while a provider's circuit breaker is not closed",
+              lambda: {(c.name,): int(c.breaker.state != "closed") for c in (greenapi, openrouter)}, ("provider",))
+
+MENU_WORDS = frozenset(("меню", "menu", "мәзір", "0", "/start", "start", "старт"))
+GREET_WORDS = frozenset(("привет", "приветик", "здравствуй", "здравствуйте", "добрый", "доброе",
+                         "хай", "ассалам", "ассалаумағалейкум", "салам", "салем", "сәлем",
+                         "сәлеметсіз", "сәлеметсіңіз", "hi", "hello", "hey", "start", "начать"))
+CANCEL_WORDS = frozenset(("отмена", "cancel", "стоп", "болдырмау", "тоқта"))
 MENU_ACTIONS = {"1": "prices", "2": "hours", "3": "location", "4": "bar",
                 "5": "booking", "6": "admin"}
 
 
 # ===================== Helpers =====================
-def db_id(chat_id):
-    digits = re.sub(r"\D", "", str(chat_id).split("@")[0])
-    return int(digits) if digits else 0
+db_id = message.db_id
+_LINK = re.compile(r'<a href="([^"]+)">([^<]+)</a>')
 
 
 def wa_format(s):
     """Convert the HTML-ish shared strings to WhatsApp-friendly text."""
-    s = re.sub(r'<a href="([^"]+)">([^<]+)</a>', r"\2: \1", s)
+    if "<" not in s:                           # plain text / LLM replies / pre-rendered WA_T
+        return s
+    s = _LINK.sub(r"\2: \1", s)
     s = s.replace("<b>", "*").replace("</b>", "*")
     s = s.replace("<code>", "").replace("</code>", "")
     return s
 
 
-def ga_send(chat_id, text):
+# shared strings rendered for WhatsApp once, not on every send
+WA_T = {lang: {k: wa_format(v) for k, v in d.items()} for lang, d in i18n.T.items()}
+
+
+def wa_t(lang, key, **kw):
+    """i18n.t() over the pre-rendered WhatsApp strings."""
+    d = WA_T.get(lang) or WA_T["ru"]
+    s = d.get(key) or WA_T["ru"].get(key, key)
+    return s.format(**kw) if kw else s
+
+
+def _ga_deliver(kind, chat_id, payload):
+    """Outbox transport: one Green API call. True = done (sent or permanently rejected), False = retry."""
+    if not (INSTANCE and TOKEN):
+        print("[ERROR] Green API creds missing"); return True
+    with STAGE.time("ga_send_file" if kind == "file" else "ga_send"):
+        result = _ga_post(kind, chat_id, payload)
+    SENDS.inc(kind, result)
+    return result in ("ok", "rejected")
+
+
+def _ga_post(kind, chat_id, payload):
     try:
-        if not (INSTANCE and TOKEN):
-            print("[ERROR] Green API creds missing"); return
-        url = f"{GREEN_HOST}/waInstance{INSTANCE}/sendMessage/{TOKEN}"
-        requests.post(url, json={"chatId": chat_id, "message": wa_format(text)}, timeout=20)
+        if kind == "file":
+            payload = dict(payload, urlFile=media_url(payload["urlFile"], payload.get("fileName", "file")))
+            url = f"{GREEN_HOST}/waInstance{INSTANCE}/sendFileByUrl/{TOKEN}"
+            r = greenapi.post("sendFileByUrl", url, json={"chatId": chat_id, **payload}, timeout=25)
+        else:
+            url = f"{GREEN_HOST}/waInstance{INSTANCE}/sendMessage/{TOKEN}"
+            r = greenapi.post("sendMessage", url, json={"chatId": chat_id, **payload}, timeout=20)
+    except http_client.CircuitOpen as e:
+        print("[ERROR] ga_send deferred:", e)
+        return "deferred"
     except Exception:
         print("[ERROR] ga_send failed:"); traceback.print_exc()
+        return "error"
+    if r.ok:
+        return "ok"
+    print("[ERROR] ga_send rejected:", r.status_code, r.text[:200])
+    # 4xx won't get better by retrying
+    return "rejected" if r.status_code < 500 and r.status_code != 429 else "error"
 
 
-def ga_send_file(chat_id, url_file, caption=""):
-    try:
-        if not (INSTANCE and TOKEN):
-            print("[ERROR] Green API creds missing"); return
-        url = f"{GREEN_HOST}/waInstance{INSTANCE}/sendFileByUrl/{TOKEN}"
-        requests.post(url, json={"chatId": chat_id, "urlFile": url_file,
-                                 "fileName": "prize.png", "caption": wa_format(caption)}, timeout=25)
-    except Exception:
-        print("[ERROR] ga_send_file failed:"); traceback.print_exc()
+# sendFileByUrl makes Green API fetch the URL on every send; a copy uploaded to its storage once
+# (kept there 15 days) is sent without that fetch
+MEDIA_TTL = 14 * 86400
+MEDIA_RETRY = 300                               # s before retrying a failed upload (sent by origin URL meanwhile)
+uploaded = cache.TTLCache(256, MEDIA_TTL)       # origin url -> (Green API urlFile or None, monotonic time)
+_upload_locks = {}                              # origin url -> Lock (a handful of images: never pruned)
+_upload_locks_guard = threading.Lock()
+
+
+def media_url(url, file_name="file"):
+    """URL to hand to sendFileByUrl: the uploaded copy of `url`, uploading it on first use."""
+    if not MEDIA_UPLOAD or not (INSTANCE and TOKEN):
+        return url
+    hit = uploaded.get(url)
+    if hit is None or not _fresh(hit):
+        with _upload_locks_guard:
+            lock = _upload_locks.setdefault(url, threading.Lock())
+        with lock:                              # one upload per image; only senders of that image wait for it
+            hit = uploaded.get(url)
+            if hit is None or not _fresh(hit):
+                hit = uploaded[url] = (_upload(url, file_name), time.monotonic())
+    return hit[0] or url
+
+
+def _fresh(hit):
+    hosted, at = hit
+    return time.monotonic() - at < (MEDIA_TTL if hosted else MEDIA_RETRY)
+
+
+def _upload(url, file_name):
+    with STAGE.time("ga_upload"):
+        try:
+            src = media_origin.get("fetch", url, timeout=15)
+            if not src.ok:
+                print("[ERROR] media fetch failed:", src.status_code, url)
+                return None
+            r = greenapi.post("uploadFile", f"{GREEN_MEDIA_HOST}/waInstance{INSTANCE}/uploadFile/{TOKEN}",
+                              data=src.content, timeout=30,
+                              headers={"Content-Type": src.headers.get("Content-Type", "application/octet-stream"),
+                                       "GA-Filename": file_name})
+            if r.ok and r.json().get("urlFile"):
+                return r.json()["urlFile"]
+            print("[ERROR] uploadFile rejected:", r.status_code, r.text[:200])
+        except Exception as e:
+            print("[ERROR] media upload failed:", e)
+    return None
+
+
+def warm_media(url, file_name="file"):
+    """Upload in the background, so the send that needs it doesn't wait (e.g. while texts go first)."""
+    if MEDIA_UPLOAD and INSTANCE and TOKEN and url not in uploaded:
+        threading.Thread(target=media_url, args=(url, file_name), name="ga-upload", daemon=True).start()
+
+
+dispatcher = outbox.Outbox(_ga_deliver)         # rate limits, coalescing, splitting, retry queue
+
+
+def ga_send(chat_id, text, priority=outbox.REPLY):
+    dispatcher.send(chat_id, wa_format(text), priority)
+
+
+def ga_send_file(chat_id, url_file, caption="", file_name="prize.png", priority=outbox.REPLY):
+    warm_media(url_file, file_name)
+    dispatcher.send_file(chat_id, url_file, wa_format(caption), file_name=file_name, priority=priority)
 
 
 # ===================== Language =====================
-def update_lang(chat_id, text=None):
-    did = db_id(chat_id)
-    if chat_id not in user_lang:
-        user_lang[chat_id] = db.get_user_lang(did) or "ru"
-    if text:
-        low = text.strip().lower()
-        if not low.startswith("/") and low not in MENU_WORDS:
-            d = i18n.detect_lang(text)
-            if d and d != user_lang.get(chat_id):
-                user_lang[chat_id] = d
-                db.set_user_lang(did, d)
-    return user_lang[chat_id]
+def _chat_lang(chat_id):
+    """(lang, settled). A chat nothing was detected for yet answers in "ru" but stays unsettled: the
+    default is never cached in the store, so the first real detection replaces it."""
+    lang = store.get_lang(chat_id)
+    if lang is not None:
+        return lang, True
+    if chat_id not in lang_unset:
+        lang = db.get_user_lang(db_id(chat_id))
+        if lang is not None:
+            store.set_lang(chat_id, lang)
+            return lang, True
+        lang_unset.add(chat_id)
+    return "ru", False
+
+
+def update_lang(chat_id, msg=None):
+    """Cached language for the chat, switched when a parsed message is clearly in another one.
+    A new chat takes the first detection, however weak ("hi" -> en); a settled one needs a confident
+    message (LANG_SWITCH) or two weaker ones in a row, so "ok" or one odd word doesn't flip it."""
+    with STAGE.time("update_lang"):
+        lang, settled = _chat_lang(chat_id)
+        if msg is not None and not msg.is_command and msg.low not in MENU_WORDS:
+            d, conf = msg.lang, msg.lang_conf
+            if not d or (settled and conf < LANG_HINT):
+                return lang
+            if d == lang and settled:
+                lang_votes.pop(chat_id)
+                return lang
+            if settled and conf < LANG_SWITCH and lang_votes.get(chat_id) != d:
+                lang_votes[chat_id] = d
+                return lang
+            lang_votes.pop(chat_id)
+            lang_unset.discard(chat_id)
+            lang = d
+            store.set_lang(chat_id, d)
+            db.set_user_lang(db_id(chat_id), d)
+        return lang
 
 
 def L(chat_id):
-    if chat_id not in user_lang:
-        user_lang[chat_id] = db.get_user_lang(db_id(chat_id)) or "ru"
-    return user_lang[chat_id]
+    return _chat_lang(chat_id)[0]
 
 
 # ===================== OpenRouter =====================
-def ask_openrouter(question, history=[]):
+AI_ERROR = "⚠️ Ошибка ИИ. Попробуй позже."
+AI_CUT = "…\n" + AI_ERROR          # after a reply that broke off mid-stream
+_system_prompt = None
+
+
+def system_prompt():
+    """system_prompt.txt, read on first use (init_once() preloads it before forking)."""
+    global _system_prompt
+    if _system_prompt is None:
+        with open(SYSTEM_PROMPT_PATH, "r", encoding="utf-8") as f:
+            text = f.read()
+        answers.set_fingerprint(hashlib.sha1(f"{OPENROUTER_MODEL}\0{text}".encode()).hexdigest())
+        _system_prompt = text
+    return _system_prompt
+
+
+llm_stats = {"calls": 0, "errors": 0, "streamed": 0, "truncated": 0,
+             "ttfm": deque(maxlen=500),                  # seconds to first message
+             "input_tokens_est": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+
+def _llm_request(question, history):
+    # the timestamp rides on the last message, so the system prompt stays a byte-identical cacheable prefix
+    now = datetime.now(ALMATY).strftime("%A, %d %B %Y, %H:%M")
+    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json",
+               "HTTP-Referer": "https://tsunami-whatsapp-bot-production.up.railway.app",
+               "X-Title": "Tsunami WhatsApp Bot"}
+    messages, est = prompt_budget.build_messages(system_prompt(), history, f"[{now}] {question}")
+    llm_stats["input_tokens_est"] += est
+    LLM_TOKENS.inc("estimated", n=est)
+    return headers, {"model": OPENROUTER_MODEL, "messages": messages, "usage": {"include": True}}, est
+
+
+def _log_usage(est, usage):
+    usage = usage or {}
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+    llm_stats["prompt_tokens"] += usage.get("prompt_tokens", 0) or 0
+    llm_stats["completion_tokens"] += usage.get("completion_tokens", 0) or 0
+    llm_stats["cached_tokens"] += cached
+    LLM_TOKENS.inc("prompt", n=usage.get("prompt_tokens", 0) or 0)
+    LLM_TOKENS.inc("cached", n=cached)
+    LLM_TOKENS.inc("completion", n=usage.get("completion_tokens", 0) or 0)
+    if DEBUG:
+        print(f"[LLM] input ~{est} tok (billed {usage.get('prompt_tokens', '?')}, cached {cached}), "
+              f"output {usage.get('completion_tokens', '?')}")
+
+
+def ask_openrouter(question, history=None):
+    t0 = time.monotonic()
+    llm_stats["calls"] += 1
+    result = "error"
     try:
-        now = datetime.now(ALMATY).strftime("%A, %d %B %Y, %H:%M")
-        headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json",
-                   "HTTP-Referer": "https://tsunami-whatsapp-bot-production.up.railway.app",
-                   "X-Title": "Tsunami WhatsApp Bot"}
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}, *history,
-                    {"role": "user", "content": f"[{now}] {question}"}]
-        r = requests.post("https://openrouter.ai/api/v1/chat/completions",
-                          headers=headers, json={"model": OPENROUTER_MODEL, "messages": messages}, timeout=60)
+        headers, payload, est = _llm_request(question, history)
+        r = openrouter.post("chat", OPENROUTER_URL, headers=headers, json=payload, timeout=60)
         r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
+        data = r.json()
+        _log_usage(est, data.get("usage"))
+        reply = data["choices"][0]["message"]["content"]
+        result = "ok"
+        return reply
     except Exception as e:
+        llm_stats["errors"] += 1
         print("[ERROR] OpenRouter failed:", e); traceback.print_exc()
-        return "⚠️ Ошибка ИИ. Попробуй позже."
+        return AI_ERROR
+    finally:
+        llm_stats["ttfm"].append(time.monotonic() - t0)
+        STAGE.observe(time.monotonic() - t0, "llm")
+        LLM_CALLS.inc("plain", result)
+
+
+def _sse_deltas(r, usage):
+    """Content deltas from an OpenAI-style SSE stream (OpenRouter sends ': comment' keep-alives).
+    The final chunk's token usage is stored into `usage`. A stream that ends before [DONE] was cut off."""
+    r.encoding = "utf-8"
+    for line in r.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        obj = json.loads(data)
+        if obj.get("error"):
+            raise RuntimeError(f"stream error: {obj['error']}")
+        if obj.get("usage"):
+            usage.update(obj["usage"])
+        delta = (obj.get("choices") or [{}])[0].get("delta", {}).get("content")
+        if delta:
+            yield delta
+    raise RuntimeError("stream ended without [DONE]")
+
+
+def _split_ready(buf, min_chunk):
+    """Cut buf at the last paragraph (else sentence) boundary past min_chunk -> (ready, rest)."""
+    if len(buf) < min_chunk:
+        return None, buf
+    for sep in ("\n\n", "\n", ". ", "! ", "? ", "… "):
+        i = buf.rfind(sep, min_chunk)
+        if i != -1:
+            i += len(sep)
+            return buf[:i].rstrip(), buf[i:]
+    return None, buf
+
+
+def ask_openrouter_stream(question, history, send):
+    """Stream the completion and send() complete paragraphs/sentences as they arrive.
+    Returns (reply, complete): reply is what the guest actually received; complete is False after
+    an error. A reply cut off mid-stream is followed by AI_CUT so the guest knows it is unfinished."""
+    t0 = time.monotonic()
+    llm_stats["calls"] += 1
+    llm_stats["streamed"] += 1
+    parts, buf, usage = [], "", {}
+
+    def emit(chunk):
+        if not parts:
+            llm_stats["ttfm"].append(time.monotonic() - t0)
+        parts.append(chunk)
+        send(chunk)
+
+    try:
+        headers, payload, est = _llm_request(question, history)
+        with openrouter.post("chat.stream", OPENROUTER_URL, headers=headers, json={**payload, "stream": True},
+                             timeout=(10, 60), stream=True) as r:
+            r.raise_for_status()
+            for delta in _sse_deltas(r, usage):
+                buf += delta
+                ready, buf = _split_ready(buf, STREAM_MIN_CHUNK)
+                if ready:
+                    emit(ready)
+        _log_usage(est, usage)
+    except Exception as e:
+        llm_stats["errors"] += 1
+        print("[ERROR] OpenRouter stream failed:", e); traceback.print_exc()
+        STAGE.observe(time.monotonic() - t0, "llm")
+        LLM_CALLS.inc("stream", "error")
+        if not parts and not buf.strip():
+            emit(AI_ERROR)
+            return AI_ERROR, False
+        complete = False
+    else:
+        complete = True
+        STAGE.observe(time.monotonic() - t0, "llm")
+        LLM_CALLS.inc("stream", "ok")
+    if buf.strip():                             # tail (or whatever arrived before a mid-stream error)
+        emit(buf.strip())
+    if not complete:
+        llm_stats["truncated"] += 1
+        send(AI_CUT)
+    return "\n\n".join(parts), complete
+
+
+def _pct_ms(values, p):
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(len(s) * p))] * 1000, 1) if s else 0.0
 
 
 # ===================== Menu / actions =====================
 def send_menu(chat_id):
-    ga_send(chat_id, i18n.t(L(chat_id), "wa_menu"))
+    ga_send(chat_id, wa_t(L(chat_id), "wa_menu"))
 
 
 def menu_action(chat_id, key):
     lang = L(chat_id)
     if key == "prices":
-        ga_send(chat_id, i18n.t(lang, "prices"))
+        ga_send(chat_id, wa_t(lang, "prices"))
     elif key == "hours":
-        ga_send(chat_id, i18n.t(lang, "hours"))
+        ga_send(chat_id, wa_t(lang, "hours"))
     elif key == "location":
-        ga_send(chat_id, i18n.t(lang, "loc", g=GMAPS_URL, d=GIS_URL))
+        ga_send(chat_id, wa_t(lang, "loc", g=GMAPS_URL, d=GIS_URL))
     elif key == "bar":
         ga_send(chat_id, f"🍸 {INSTAGRAM_URL}")
     elif key == "admin":
         ga_send(chat_id, f"📞 +7 777 719 5000\nhttps://wa.me/{ADMIN_PHONE}")
     elif key == "booking":
-        ga_send(chat_id, i18n.t(lang, "book_call"))
+        ga_send(chat_id, wa_t(lang, "book_call"))
+
+
+# ===================== Routing (runs on a worker) =====================
+def _timed(counter, fn, *args):
+    t0, route = time.perf_counter(), "error"
+    try:
+        route = fn(*args)
+    finally:
+        counter.inc(route)
+        STAGE.observe(time.perf_counter() - t0, "handle")
+
+
+def handle_message(sender_id, text):
+    _timed(ROUTES, _answer, sender_id, text)
+
+
+def _answer_buffered(sender_id, items):
+    _timed(BATCHES, _ask, sender_id, items)
+
+
+# quiet period over -> one answer for the chat's buffered fragments, on the chat's own worker
+chat_debounce = debounce.Debouncer(lambda chat_id, items: pool.submit(chat_id, _answer_buffered, chat_id, items))
+
+
+def _answer(sender_id, text):
+    """Reply to one message; returns how it was answered (menu/action/intent/buffered/cache/llm)."""
+    msg = message.parse(sender_id, text)      # strip/lower/tokens/script once
+    lang = update_lang(sender_id, msg)
+    low = msg.low
+
+    # menu by default: on first contact, on greetings, or when explicitly asked
+    first_contact = store.first_contact(sender_id)
+    is_greet = msg.first in GREET_WORDS
+    is_menu = low in MENU_WORDS or first_contact or is_greet
+
+    if is_menu or msg.body in MENU_ACTIONS:
+        buffered = chat_debounce.take(sender_id)
+        if buffered:                           # typed before this command: answer it first
+            _answer_buffered(sender_id, buffered)
+
+    if is_menu:                                # explicit "меню" shows the menu
+        send_menu(sender_id)
+        return "menu"
+
+    if msg.body in MENU_ACTIONS:
+        menu_action(sender_id, MENU_ACTIONS[msg.body])
+        return "action"
+
+    # a fragment following buffered free text belongs to that question, not to an intent
+    if not chat_debounce.pending(sender_id):
+        intent = router.route(low, has_history=bool(store.get_history(sender_id)))
+        if intent:                             # "сколько стоит вход?" -> canned prices, no LLM
+            menu_action(sender_id, intent)
+            return "intent"
+
+    if chat_debounce.enabled:                  # "а сколько вход" / "в субботу" / "на 5 человек" -> one LLM call
+        chat_debounce.add(sender_id, (text, lang))
+        return "buffered"
+    return _ask(sender_id, [(text, lang)])
+
+
+def _ask(sender_id, items):
+    """Answer free text (one message or a merged burst) from the answer cache or the LLM."""
+    text = "\n".join(t for t, _ in items)
+    lang = items[-1][1]
+    MERGED.inc(n=len(items) - 1)
+    history = store.get_history(sender_id)     # trimmed to the token budget in prompt_budget
+
+    # only context-free questions may be served from / stored in the answer cache
+    reply = None if history else answers.lookup(text, lang)
+    sent, route, complete = False, "cache", True
+    if reply is None:
+        route = "llm"
+        if OPENROUTER_STREAM:
+            reply, complete = ask_openrouter_stream(text, history, lambda part: ga_send(sender_id, part))
+            sent = True
+        else:
+            reply = ask_openrouter(text, history)
+            complete = reply != AI_ERROR
+        if not history and complete:
+            answers.store(text, lang, reply)
+    # question and answer in one call: the turn is stored whole, never half-written; a failed or
+    # truncated answer is not stored at all (the model would take the fragment as what it said)
+    if complete:
+        store.append_history(sender_id, {"role": "user", "content": text},
+                             {"role": "assistant", "content": reply})
+    if not sent:
+        ga_send(sender_id, reply)
+    return route
 
 
 # ===================== Webhook =====================
-@app.route("/webhook", methods=["POST"])
+@bp.route("/webhook", methods=["POST"])
 def whatsapp_webhook():
+    t0 = time.perf_counter()
+    status, code = _webhook(request)
+    WEBHOOKS.inc(status)
+    STAGE.observe(time.perf_counter() - t0, "webhook")
+    return jsonify({"status": status}), code
+
+
+def _webhook(req):
     try:
-        data = request.get_json(force=True)
-        print("[WA WEBHOOK]", data)
+        data = req.get_json(force=True)
+        if DEBUG or random.random() < WEBHOOK_LOG_SAMPLE:    # not every payload: stdout is synchronous
+            print("[WA WEBHOOK]", data)
 
         if data.get("typeWebhook") and data.get("typeWebhook") != "incomingMessageReceived":
-            return jsonify({"status": "ignored"}), 200
+            return "ignored", 200
 
         message_id = data.get("idMessage") or data.get("body", {}).get("idMessage")
-        if message_id in processed_ids:
-            return jsonify({"status": "duplicate"}), 200
-        processed_ids.add(message_id)
+        if not store.claim_message(message_id):
+            return "duplicate", 200
 
         msg_data = data.get("body", {}).get("messageData", {}) or data.get("messageData", {})
         text = None
@@ -167,50 +563,111 @@ def whatsapp_webhook():
 
         sender_id = data.get("senderData", {}).get("chatId")
         if not text or not sender_id:
-            return jsonify({"status": "no-message"}), 200
+            return "no-message", 200
         if sender_id == BOT_CHAT_ID:
-            return jsonify({"status": "self"}), 200
-
-        update_lang(sender_id, text)
-        body = text.strip()
-        low = body.lower()
-
-        # menu by default: on first contact, on greetings, or when explicitly asked
-        first_contact = sender_id not in seen
-        seen.add(sender_id)
-        words = re.sub(r"[^\w\s]", " ", low).split()
-        is_greet = bool(words) and words[0] in GREET_WORDS
-
-        if low in MENU_WORDS:                      # explicit "меню" shows the menu
-            send_menu(sender_id)
-            return jsonify({"status": "ok"}), 200
-        if first_contact or is_greet:
-            send_menu(sender_id)
-            return jsonify({"status": "ok"}), 200
-
-        if body in MENU_ACTIONS:
-            menu_action(sender_id, MENU_ACTIONS[body])
-            return jsonify({"status": "ok"}), 200
-
-        # free text -> AI
-        history = conversation_memory.get(sender_id, [])[-6:]
-        reply = ask_openrouter(text, history)
-        history.append({"role": "user", "content": text})
-        history.append({"role": "assistant", "content": reply})
-        conversation_memory[sender_id] = history
-        ga_send(sender_id, reply)
-        return jsonify({"status": "ok"}), 200
+            return "self", 200
+
+        # another process holds this chat (its queue, debounce, language votes): hand it over
+        owner = store.owner_of(sender_id)
+        if owner is not None and store.forward(owner, [message_id, sender_id, text]):
+            return "forwarded", 200
+
+        # ack fast; the worker owning this chat does routing / LLM / send in order
+        if not pool.submit(sender_id, handle_message, sender_id, text):
+            store.release_message(message_id)  # let Green API redeliver it
+            return "busy", 503
+        return "ok", 200
 
     except Exception:
         traceback.print_exc()
-        return jsonify({"status": "fail"}), 500
+        return "fail", 500
+
+
+def _forwarded(item):
+    """A message another process took for a chat this one holds. Already acked: wait for room."""
+    message_id, sender_id, text = item
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while not pool.submit(sender_id, handle_message, sender_id, text):
+        if time.monotonic() > deadline:
+            print("[WORKER] queue full, forwarded message dropped:", message_id)
+            return
+
+
+@bp.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({"workers": pool.stats(), "db": db.stats(), "state": store.stats(),
+                    "intents": router.stats(), "answer_cache": answers.stats(),
+                    "http": {"greenapi": greenapi.stats(), "openrouter": openrouter.stats(),
+                             "media": dict(media_origin.stats(), uploaded=len(uploaded))},
+                    "outbox": dispatcher.stats(), "debounce": chat_debounce.stats(),
+                    "lang": dict(i18n.detect_stats(), pending_switches=len(lang_votes)),
+                    "llm": {"calls": llm_stats["calls"], "errors": llm_stats["errors"],
+                            "streamed": llm_stats["streamed"], "truncated": llm_stats["truncated"],
+                            "ttfm_p50_ms": _pct_ms(llm_stats["ttfm"], 0.5),
+                            "ttfm_p95_ms": _pct_ms(llm_stats["ttfm"], 0.95),
+                            **{k: llm_stats[k] for k in ("input_tokens_est", "prompt_tokens",
+                                                         "cached_tokens", "completion_tokens")}}})
 
 
-@app.route("/", methods=["GET"])
+@bp.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@bp.route("/", methods=["GET"])
 def root():
     return "TsunamiBot для WhatsApp + OpenRouter запущен ✅"
 
 
+# ===================== App / lifecycle =====================
+def create_app():
+    """WSGI app factory. No I/O here: one-time setup is init_once()."""
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+
+def init_once():
+    """Per-deploy setup: schema migrations and the system prompt. gunicorn.conf.py runs it once
+    in the master before forking workers."""
+    db.init_db()
+    system_prompt()
+
+
+def post_fork():
+    """In a freshly forked worker: don't share HTTP connections with the master; start the outbox
+    (its wa_outbox poller sends what was parked before a restart without waiting for new traffic)
+    and the inbox for messages other workers forward to the chats this one holds."""
+    greenapi.reset()
+    openrouter.reset()
+    media_origin.reset()
+    dispatcher.start()
+    store.start_inbox(_forwarded)
+
+
+_stopping = threading.Lock()
+
+
+def shutdown(timeout=DRAIN_TIMEOUT):
+    """Graceful stop: finish queued and in-flight messages (incl. LLM calls), deliver their replies
+    (the rest is parked in wa_outbox for the next start), flush buffered DB writes. Runs once."""
+    if not _stopping.acquire(blocking=False):
+        return
+    deadline = time.monotonic() + timeout
+    chat_debounce.flush_all()                  # buffered fragments are answered, not dropped
+    if not pool.drain(timeout):
+        print("[SHUTDOWN] workers still busy after", timeout, "s;", pool.depth(), "queued")
+    dispatcher.close(max(1.0, deadline - time.monotonic()))
+    db.flush_writes()
+
+
+app = create_app()
+atexit.register(shutdown)      # gunicorn's worker_exit calls it too; SIGTERM -> exit -> here for python main.py
+
 if __name__ == "__main__":
+    init_once()
+    dispatcher.start()
+    store.start_inbox(_forwarded)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
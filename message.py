@@ -0,0 +1,42 @@
+"""Inbound message normalisation, done once per message.
+parse() strips, lowercases and tokenises the text in one go and keeps what the
+routing path needs (first word, detected language + confidence, numeric chat id),
+so update_lang / handle_message / the router don't redo it with their own
+regexes and str.lower() calls.
+"""
+import functools
+import re
+
+import translations as i18n
+
+_WORD = re.compile(r"\w+")
+_NON_DIGIT = re.compile(r"\D")
+
+
+@functools.lru_cache(maxsize=4096)
+def db_id(chat_id):
+    """'77011234567@c.us' -> 77011234567 (the users.id shared with the Telegram bot)."""
+    digits = _NON_DIGIT.sub("", str(chat_id).split("@", 1)[0])
+    return int(digits) if digits else 0
+
+
+class Message:
+    __slots__ = ("chat_id", "text", "body", "low", "words", "first", "lang", "lang_conf", "is_command")
+
+    def __init__(self, chat_id, text):
+        self.chat_id = chat_id
+        self.text = text                       # as received (history, LLM, answer cache)
+        self.body = text.strip()               # "1".."6" menu shortcuts
+        self.low = self.body.lower()
+        self.words = _WORD.findall(self.low)   # punctuation-free tokens
+        self.first = self.words[0] if self.words else ""
+        self.is_command = self.low.startswith("/")
+        self.lang, self.lang_conf = i18n.detect_lower(self.low)   # None, 0.0 for digits/emoji
+
+    @property
+    def db_id(self):
+        return db_id(self.chat_id)
+
+
+def parse(chat_id, text):
+    return Message(chat_id, text)
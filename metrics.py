@@ -0,0 +1,167 @@
+"""Process metrics in Prometheus text format (served on GET /metrics).
+A small in-process registry instead of prometheus_client: label-keyed counters
+and histograms that the owning modules create at import, plus gauges read from
+callbacks at scrape time (queue depths and the like). Recording is a dict
+lookup, a bisect and an add under a per-family lock.
+"""
+import bisect
+import threading
+import time
+
+# seconds; from sub-ms DB statements up to slow LLM answers
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)     # re-import safe: keep the first
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}                                # labels -> [counts per bucket + Inf, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += seconds
+            s[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def series(self):
+        with self._lock:
+            return list(self._series)
+
+    def snapshot(self, *labels):
+        """Count, mean and coarse p50 / p99 (upper bucket bound, like histogram_quantile) of one series."""
+        with self._lock:
+            s = self._series.get(labels)
+            counts, total, n = (list(s[0]), s[1], s[2]) if s else ([], 0.0, 0)
+        out = {"count": n, "avg_ms": round(total / n * 1000, 1) if n else 0.0}
+        for key, q in (("p50_le_s", 0.5), ("p99_le_s", 0.99)):
+            acc, out[key] = 0, 0.0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                if acc >= q * n:
+                    out[key] = bound
+                    break
+        return out
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(c), total, n) for k, (c, total, n) in self._series.items()]
+        out = []
+        for k, counts, total, n in items:
+            acc = 0
+            for bound, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                le = 'le="%s"' % bound
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {total:.6f}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {n}")
+        return out
+
+
+class Gauge:
+    """Value(s) read at scrape time: fn() -> number, or {label tuple: number}."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, fn, labels=()):
+        self.name, self.doc, self.labelnames, self.fn = name, doc, tuple(labels), fn
+
+    def samples(self):
+        try:
+            v = self.fn()
+        except Exception:
+            return []
+        if isinstance(v, dict):
+            return [f"{self.name}{_labels(self.labelnames, k)} {x}" for k, x in v.items()]
+        return [f"{self.name} {v}"]
+
+
+class _Timer:
+    __slots__ = ("h", "labels", "t0")
+
+    def __init__(self, h, labels):
+        self.h, self.labels = h, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.h.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+def counter(name, doc, labels=()):
+    return _register(Counter(name, doc, labels))
+
+
+def histogram(name, doc, labels=(), buckets=BUCKETS):
+    return _register(Histogram(name, doc, labels, buckets))
+
+
+def gauge(name, doc, fn, labels=()):
+    with _registry_lock:
+        _registry[name] = Gauge(name, doc, fn, labels)    # latest callback wins (e.g. after a fork)
+    return _registry[name]
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for m in metrics:
+        lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.samples())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,265 @@
+"""Outbound dispatcher between the handlers and Green API.
+Handlers enqueue; a few sender threads drain per-chat FIFOs under two token
+buckets (whole instance + per chat). Back-to-back texts to the same chat are
+coalesced into one message (texts over the WhatsApp limit are split at
+paragraph / sentence breaks), replies go before broadcasts, and failed sends are
+retried in memory ahead of the chat's later messages, then parked in Postgres
+(db.outbox_*) together with anything still pending at shutdown, so they survive
+a restart. A parked send no longer holds its chat: later messages overtake it.
+Call start() at boot so parked sends are polled without waiting for new traffic.
+"""
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+import cache
+import db
+
+REPLY, BROADCAST = 0, 1
+RATE = float(os.getenv("OUTBOX_RATE", "5"))                # sends/s for the whole Green API instance
+BURST = float(os.getenv("OUTBOX_BURST", "10"))
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))      # sends/s to one chat
+CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+THREADS = int(os.getenv("OUTBOX_THREADS", "4"))
+MAX_TEXT = 4000                                            # coalesced message cap (chars)
+WA_LIMIT = 20000                                           # Green API sendMessage limit: longer texts are split
+ATTEMPTS = 3                                               # in-memory tries before parking in the DB
+PARK_RETRY = 300                                           # seconds before a parked send is tried again
+PARK_MAX_ATTEMPTS = 12
+POLL = 30                                                  # seconds between DB retry-queue polls
+
+
+def split_text(text, limit=WA_LIMIT):
+    """Cut text into parts of at most `limit` chars at the last paragraph, line, sentence or word break
+    in the second half of each part (a hard cut only for text without any)."""
+    parts = []
+    while len(text) > limit:
+        cut = limit
+        for sep in ("\n\n", "\n", ". ", "! ", "? ", "… ", " "):
+            i = text.rfind(sep, limit // 2, limit)
+            if i != -1:
+                cut = i + len(sep)
+                break
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.t = burst, time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a token is available (0 = now). Does not consume."""
+        self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _Item:
+    __slots__ = ("chat_id", "kind", "payload", "priority", "attempts")
+
+    def __init__(self, chat_id, kind, payload, priority, attempts=0):
+        self.chat_id, self.kind, self.payload = chat_id, kind, payload
+        self.priority, self.attempts = priority, attempts
+
+
+class Outbox:
+    def __init__(self, deliver, threads=THREADS, rate=RATE, burst=BURST):
+        """deliver(kind, chat_id, payload) -> True when done (sent, or permanently rejected),
+        False to retry later."""
+        self.deliver = deliver
+        self.threads = threads
+        self.bucket = TokenBucket(rate, burst)
+        self._chat_buckets = cache.TTLCache(50000, 600)
+        self._cv = threading.Condition()
+        self._pending = {}                       # chat_id -> deque[_Item]
+        self._lanes = (deque(), deque())         # chats ready to send: REPLY lane, BROADCAST lane
+        self._delayed = []                       # heap (ready_at, seq, chat_id): rate-limited / backing off
+        self._scheduled = set()                  # chats in a lane, in _delayed or being sent
+        self._seq = itertools.count()
+        self._workers = []
+        self._closed = False
+        self.sent = self.coalesced = self.split = self.failed = self.parked = self.dropped = 0
+
+    # ----- producer side -----
+    def send(self, chat_id, text, priority=REPLY):
+        parts = split_text(text) if len(text) > WA_LIMIT else (text,)
+        self.split += len(parts) - 1
+        for part in parts:                      # same chat FIFO: delivered in order
+            self._enqueue(_Item(chat_id, "text", {"message": part}, priority))
+
+    def send_file(self, chat_id, url_file, caption="", file_name="prize.png", priority=REPLY):
+        self._enqueue(_Item(chat_id, "file", {"urlFile": url_file, "fileName": file_name, "caption": caption},
+                            priority))
+
+    def _enqueue(self, item):
+        if not self._workers:
+            self.start()
+        with self._cv:
+            q = self._pending.setdefault(item.chat_id, deque())
+            q.append(item)
+            if item.chat_id not in self._scheduled:
+                self._scheduled.add(item.chat_id)
+                self._lanes[q[0].priority].append(item.chat_id)
+            self._cv.notify()
+
+    # ----- sender threads -----
+    def start(self):
+        """Start sender threads (and the DB retry poller). Call after any fork."""
+        with self._cv:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                th = threading.Thread(target=self._loop, name=f"wa-outbox-{i}", daemon=True)
+                th.start()
+                self._workers.append(th)
+            if db.DATABASE_URL:
+                th = threading.Thread(target=self._poll_parked, name="wa-outbox-db", daemon=True)
+                th.start()
+                self._workers.append(th)
+
+    def _chat_bucket(self, chat_id):
+        b = self._chat_buckets.get(chat_id)
+        if b is None:
+            b = TokenBucket(CHAT_RATE, CHAT_BURST)
+            self._chat_buckets[chat_id] = b
+        return b
+
+    def _next(self):
+        """Block until some chat may send; pop its coalesced batch. Lock held."""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                chat_id = heapq.heappop(self._delayed)[2]
+                self._lanes[self._pending[chat_id][0].priority].append(chat_id)
+            lane = self._lanes[REPLY] or self._lanes[BROADCAST]
+            if not lane:
+                self._cv.wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+            wait = self.bucket.delay(now)
+            if wait > 0:
+                self._cv.wait(wait)
+                continue
+            chat_id = lane.popleft()
+            cb = self._chat_bucket(chat_id)
+            wait = cb.delay(now)
+            if wait > 0:
+                heapq.heappush(self._delayed, (now + wait, next(self._seq), chat_id))
+                continue
+            self.bucket.consume()
+            cb.consume()
+            return chat_id, self._batch(self._pending[chat_id])
+
+    def _batch(self, q):
+        first = q.popleft()
+        if first.kind != "text":
+            return first, 1
+        parts = [first.payload["message"]]
+        size, n = len(parts[0]), 1
+        while q and q[0].kind == "text" and q[0].priority == first.priority and q[0].attempts == 0 \
+                and size + 2 + len(q[0].payload["message"]) <= MAX_TEXT:
+            parts.append(q.popleft().payload["message"])
+            size += 2 + len(parts[-1])
+            n += 1
+        if n == 1:
+            return first, 1
+        return _Item(first.chat_id, "text", {"message": "\n\n".join(parts)}, first.priority, first.attempts), n
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                chat_id, (item, n) = self._next()
+            try:
+                ok = self.deliver(item.kind, chat_id, item.payload)
+            except Exception:
+                print("[OUTBOX] deliver failed:"); traceback.print_exc()
+                ok = False
+            park = None
+            with self._cv:
+                if self._closed:                        # close() already parked the rest
+                    if not ok:
+                        item.attempts += 1
+                        park = item
+                else:
+                    park = self._settle(chat_id, item, n, ok)
+            if park is not None:
+                self._park([park], PARK_RETRY)
+
+    def _settle(self, chat_id, item, n, ok):
+        """Reschedule the chat after a send. Lock held; returns an item to park, if any."""
+        q, park = self._pending[chat_id], None
+        if ok:
+            self.sent += 1
+            self.coalesced += n - 1
+        else:
+            self.failed += 1
+            item.attempts += 1
+            if item.attempts < ATTEMPTS:                # retry first, keeping the chat's order
+                q.appendleft(item)
+            else:
+                park = item
+        if not q:
+            del self._pending[chat_id]
+            self._scheduled.discard(chat_id)
+        elif ok:
+            self._lanes[q[0].priority].append(chat_id)
+        else:
+            heapq.heappush(self._delayed, (time.monotonic() + 2 ** q[0].attempts, next(self._seq), chat_id))
+        self._cv.notify()
+        return park
+
+    # ----- persistence -----
+    def _park(self, items, delay):
+        for it in items:
+            if it.attempts >= ATTEMPTS * PARK_MAX_ATTEMPTS or not db.DATABASE_URL:
+                self.dropped += 1
+                print("[OUTBOX] dropping send to", it.chat_id, "after", it.attempts, "attempts")
+                continue
+            db.outbox_push(it.chat_id, it.kind, json.dumps(it.payload, ensure_ascii=False),
+                           it.priority, it.attempts, delay)
+            self.parked += 1
+
+    def _poll_parked(self):
+        """Re-enqueue due parked sends (oldest first); they join the back of their chat's queue."""
+        while not self._closed:
+            for chat_id, kind, payload, priority, attempts in db.outbox_claim(100):
+                self._enqueue(_Item(chat_id, kind, json.loads(payload), priority, attempts))
+            time.sleep(POLL)
+
+    def depth(self):
+        with self._cv:
+            return sum(len(q) for q in self._pending.values())
+
+    def close(self, timeout=10.0):
+        """Drain for up to `timeout`, then park whatever is left in the DB (kept for the next start)."""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._cv:
+            self._closed = True
+            left = [it for q in self._pending.values() for it in q]
+            self._pending.clear()
+            self._lanes[REPLY].clear()
+            self._lanes[BROADCAST].clear()
+            self._delayed.clear()
+            self._scheduled.clear()
+        if left:
+            self._park(left, 0)
+
+    def stats(self):
+        with self._cv:
+            return {"depth": sum(len(q) for q in self._pending.values()), "chats": len(self._pending),
+                    "sent": self.sent, "coalesced": self.coalesced, "split": self.split, "failed": self.failed,
+                    "parked": self.parked, "dropped": self.dropped, "tokens": round(self.bucket.tokens, 2)}
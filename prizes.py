@@ -0,0 +1,80 @@
+"""Wheel of fortune: prize draw and issuance (shared with the Telegram bot, like db.py).
+draw() samples translations.PRIZES by weight in O(1) with an alias table built
+once at import (Vose). spin() records the day's spin and issues the prize code
+in one DB statement (db.spin), taking codes from a pre-generated pool
+(prize_codes) that refill_codes() stocks in batches, so issuing never has to
+retry on a code collision.
+"""
+import os
+import random
+import secrets
+import threading
+
+import db
+import translations as i18n
+
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"     # no 0/O, 1/I: read aloud at the counter
+CODE_LEN = 8
+CODE_STOCK = int(os.getenv("PRIZE_CODE_STOCK", "500"))  # pool size refill_codes() tops up to
+
+
+class AliasSampler:
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.prob, self.alias = [1.0] * n, list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], g
+            scaled[g] -= 1.0 - scaled[s]
+            (small if scaled[g] < 1.0 else large).append(g)
+        # leftovers are 1.0 up to float error
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+WHEEL = AliasSampler([p["w"] for p in i18n.PRIZES])
+
+
+def draw(rng=random):
+    return i18n.PRIZES[WHEEL.sample(rng)]
+
+
+def new_code():
+    return "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LEN))
+
+
+_refilling = threading.Lock()
+
+
+def refill_codes(target=CODE_STOCK):
+    """Top the code pool up to `target` (one count + one multi-row insert). Returns codes added."""
+    if not db.DATABASE_URL or not _refilling.acquire(blocking=False):
+        return 0
+    try:
+        need = target - db.prize_code_stock()
+        if need <= 0:
+            return 0
+        codes = {new_code() for _ in range(need)}
+        return len(codes) if db.add_prize_codes(list(codes)) else 0
+    finally:
+        _refilling.release()
+
+
+def spin(chat_id, lang, valid_date, rng=random):
+    """One spin for chat_id: {"status": "already"} or {"status": "win"/"lose", "prize", "label", "code"}.
+    Safe against concurrent spins from the same chat (one of them gets "already")."""
+    prize = draw(rng)
+    label = prize.get(lang) or prize["ru"]
+    spun, code, pooled = db.spin(chat_id, prize["key"], label, prize["role"], prize["real"], valid_date,
+                                 new_code())
+    if not spun:
+        return {"status": "already"}
+    if prize["real"] and not pooled and db.DATABASE_URL:     # pool ran dry: restock off the request path
+        threading.Thread(target=refill_codes, name="prize-codes", daemon=True).start()
+    return {"status": "win" if prize["real"] else "lose", "prize": prize, "label": label, "code": code}
@@ -0,0 +1,91 @@
+"""Prompt-size management for LLM calls.
+count_tokens() is a local estimate (no tokenizer download): BPE vocabularies
+spend ~1 token per 4 Latin chars, ~1 per 2.5 Cyrillic chars and 1-2 per
+emoji/punctuation mark; good enough to budget within ~10-15%.
+build_messages() puts the static system prompt first as a cacheable prefix,
+then as much recent history as fits HISTORY_BUDGET (long replies clipped,
+older turns folded into a one-line recap), then the question.
+"""
+import functools
+import os
+import re
+
+HISTORY_BUDGET = int(os.getenv("LLM_HISTORY_TOKENS", "600"))     # tokens of history per request
+REPLY_CLIP = int(os.getenv("LLM_HISTORY_REPLY_TOKENS", "200"))   # max tokens kept of one past reply
+CACHE_CONTROL = os.getenv("LLM_CACHE_CONTROL", "1") == "1"      # OpenRouter prompt-caching breakpoint
+
+_TOKEN = re.compile(r"[a-zA-Z]+|[Ѐ-ӿ]+|\d+|\s+|.", re.S)
+_CYR = re.compile(r"[Ѐ-ӿ]")
+
+
+def count_tokens(text):
+    n = 0
+    for m in _TOKEN.finditer(text):
+        s = m.group()
+        c = s[0]
+        if c.isspace():
+            continue
+        if c.isascii() and c.isalpha():
+            n += (len(s) + 3) // 4
+        elif _CYR.match(c):
+            n += (len(s) * 2 + 4) // 5
+        elif c.isdigit():
+            n += (len(s) + 2) // 3
+        else:
+            n += 1 if ord(c) < 0x2000 else 2      # emoji / symbols
+    return n
+
+
+_prefix_tokens = functools.lru_cache(maxsize=4)(count_tokens)   # the system prompt rarely changes
+
+
+def clip(text, max_tokens):
+    """Cut text to about max_tokens (at a word boundary), marking the cut with '…'."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:                                 # longest prefix within budget
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text[:lo]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > lo // 2 else cut).rstrip() + " …"
+
+
+def fit_history(history, budget=HISTORY_BUDGET):
+    """Newest turns that fit `budget` (replies clipped), plus a short recap of dropped user turns."""
+    kept, used = [], 0
+    for i in range(len(history) - 1, -1, -1):
+        m = history[i]
+        content = clip(m["content"], REPLY_CLIP) if m["role"] == "assistant" else m["content"]
+        cost = count_tokens(content) + 4                 # + per-message overhead
+        if used + cost > budget:
+            dropped = [h["content"] for h in history[:i + 1] if h["role"] == "user"]
+            if dropped:
+                recap = clip("Earlier the guest asked: " + " | ".join(dropped), max(20, budget // 10))
+                kept.append({"role": "user", "content": f"[{recap}]"})
+            break
+        kept.append({"role": m["role"], "content": content})
+        used += cost
+    kept.reverse()
+    # a chat must not open with an assistant turn after trimming
+    while kept and kept[0]["role"] == "assistant":
+        kept.pop(0)
+    return kept
+
+
+def build_messages(system_prompt, history, question):
+    """[static system prefix] + [budgeted history] + [question]; returns (messages, estimated input tokens)."""
+    if CACHE_CONTROL:
+        system = {"role": "system", "content": [{"type": "text", "text": system_prompt,
+                                                 "cache_control": {"type": "ephemeral"}}]}
+    else:
+        system = {"role": "system", "content": system_prompt}
+    hist = fit_history(history or [])
+    messages = [system, *hist, {"role": "user", "content": question}]
+    est = (_prefix_tokens(system_prompt) + sum(count_tokens(m["content"]) + 4 for m in hist)
+           + count_tokens(question) + 8)
+    return messages, est
@@ -0,0 +1,187 @@
+"""Prize redemption for the cashier / entrance scan path (shared with the Telegram bot, like db.py).
+Every issued code is indexed in process memory (code -> status, valid date, prize): loaded
+with one query when the listener connects (db.prize_index) and kept current from the
+`prizes` NOTIFY channel, which a trigger fires on every issue and redeem, so each process
+(WhatsApp, Telegram, every gunicorn worker) sees the others' writes. Rejected scans (used,
+expired, unknown codes) are answered from memory; a valid code is still redeemed atomically
+in the DB. A miss is looked up in the DB only within RECENT seconds of the last issue, when
+the code may be one whose NOTIFY is still on its way. While the listener is down the index
+is bypassed and every scan goes to the DB.
+"""
+import datetime
+import json
+import os
+import select
+import threading
+import time
+import traceback
+
+import pytz
+
+import db
+import metrics
+
+ALMATY = pytz.timezone("Asia/Almaty")
+CHANNEL = "prizes"
+POLL = 5.0              # seconds the listener waits for a notification per select()
+RECONNECT = 5.0         # seconds before re-LISTENing after the connection dropped
+RECENT = float(os.getenv("REDEEM_RECENT", "10"))    # s after an issue in which a miss is checked in the DB
+
+_SCANS = metrics.counter("wa_redeem_scans_total", "Prize code scans by verdict and where it was answered",
+                         ("verdict", "source"))
+
+
+def today():
+    return datetime.datetime.now(ALMATY).date()
+
+
+def verdict(prize, day):
+    """"ok" (redeemable on `day`), "used", "expired" or "unknown"."""
+    if prize is None:
+        return "unknown"
+    if prize["status"] != "issued":
+        return "used"
+    return "ok" if prize["valid_date"] == day else "expired"
+
+
+class CodeIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codes = {}                        # code -> (status, valid_date, prize_key, prize_label, role)
+        self._strings = {}                      # labels / keys / roles repeat: one object each
+        self._issued_at = 0.0                   # monotonic time of the last issue notification
+        self._live = False                      # LISTENing and loaded: a miss means "unknown"
+        self._thread = None
+        self._pid = None
+        self.loads = self.notified = 0
+
+    def start(self):
+        """Start the listener (lazily on first use too; again in a forked child)."""
+        if not db.DATABASE_URL or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid, self._live = os.getpid(), False
+            self._thread = threading.Thread(target=self._listen, name="prize-listen", daemon=True)
+            self._thread.start()
+
+    def get(self, code):
+        """(known, prize): known=False if the index can't answer (not live, or a miss that may be a
+        code issued a moment ago); prize=None with known=True means there is no such code."""
+        self.start()
+        with self._lock:
+            if not self._live:
+                return False, None
+            row = self._codes.get(code)
+            if row is None:
+                return time.monotonic() - self._issued_at >= RECENT, None
+        status, valid_date, key, label, role = row
+        return True, {"prize_key": key, "prize_label": label, "role": role, "status": status,
+                      "valid_date": valid_date}
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = db.listen(CHANNEL)       # LISTEN before loading: no write falls in between
+                self._load()
+                while True:
+                    if select.select([conn], [], [], POLL)[0]:
+                        conn.poll()
+                        for n in conn.notifies:
+                            self._apply(json.loads(n.payload))
+                        conn.notifies.clear()
+            except Exception as e:
+                print(f"[REDEEM] listener down: {e}")
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._live = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(RECONNECT)
+
+    def _row(self, status, valid_date, key, label, role):
+        st = self._strings
+        return (st.setdefault(status, status), valid_date, st.setdefault(key, key), st.setdefault(label, label),
+                st.setdefault(role, role))
+
+    def _load(self):
+        rows = db.prize_index()
+        if rows is None:
+            raise RuntimeError("prize_index failed")
+        codes = {code: self._row(*rest) for code, *rest in rows}
+        with self._lock:
+            # notifications queued during the load may be older than it: status only moves forward
+            for code, row in self._codes.items():
+                if row[0] != "issued" and code in codes:
+                    codes[code] = (row[0],) + codes[code][1:]
+            self._codes, self._live = codes, True
+            self.loads += 1
+
+    def _apply(self, p):
+        valid_date = datetime.date.fromisoformat(p["valid_date"]) if p["valid_date"] else None
+        with self._lock:
+            self.notified += 1
+            old = self._codes.get(p["code"])
+            status = old[0] if old is not None and old[0] != "issued" else p["status"]
+            if old is None:
+                self._issued_at = time.monotonic()
+            self._codes[p["code"]] = self._row(status, valid_date, p["prize_key"], p["prize_label"], p["role"])
+
+    def mark(self, code, status):
+        """Our own redeem: applied now rather than when its notification comes back."""
+        with self._lock:
+            row = self._codes.get(code)
+            if row is not None:
+                self._codes[code] = (status,) + row[1:]
+
+    def stats(self):
+        with self._lock:
+            return {"live": self._live, "codes": len(self._codes), "loads": self.loads, "notified": self.notified,
+                    "recent_issue": time.monotonic() - self._issued_at < RECENT}
+
+
+codes = CodeIndex()
+
+
+def _lookup(code):
+    """(prize, source): from the index, or from the DB when the index can't answer."""
+    known, prize = codes.get(code)
+    if known:
+        return prize, "cache"
+    return db.get_prize(code), "db"
+
+
+def check(code):
+    """Look a scanned code up without redeeming it: (verdict, prize dict or None)."""
+    day = today()
+    prize, source = _lookup(code)
+    v = verdict(prize, day)
+    _SCANS.inc(v, source)
+    return v, prize
+
+
+def redeem(code, staff_id):
+    """Redeem a scanned code: (verdict, prize). "ok" means it was redeemed just now by staff_id;
+    "error" that the DB could not be written (scan again)."""
+    day = today()
+    known, prize = codes.get(code)
+    if known:
+        v = verdict(prize, day)
+        if v != "ok":
+            _SCANS.inc(v, "cache")
+            return v, prize
+    label = db.redeem_prize(code, staff_id, day)       # the atomic issued -> redeemed step stays in the DB
+    if label is not None:
+        codes.mark(code, "redeemed")
+        _SCANS.inc("ok", "db")
+        return "ok", dict(prize, status="redeemed") if prize else {"prize_label": label, "valid_date": day}
+    prize = db.get_prize(code)                         # lost a race with another scanner, or cache cold
+    v = verdict(prize, day)
+    _SCANS.inc(v, "db")
+    return ("error" if v == "ok" else v), prize         # still redeemable: the UPDATE itself failed
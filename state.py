@@ -0,0 +1,280 @@
+"""Per-chat bot state behind one interface, so several workers / replicas can share it.
+MemoryState keeps everything in this process (cache.TTLCache); RedisState uses any
+Redis-protocol server (REDIS_URL) with atomic SET NX for dedupe / first contact and
+capped, expiring lists for chat history. Like db.py, a broken backend degrades
+instead of failing the message: errors are logged and a safe default is returned.
+
+Per-chat ordering, the free-text debounce and the language votes stay in the process
+that handles the chat. With Redis a chat is leased to one process (owner_of): a message
+that lands on another process is forwarded to the owner's inbox, so every message of a
+chat goes through the same WorkerPool / Debouncer. The lease lapses after CHAT_LEASE
+idle seconds, or as soon as its process stops sending heartbeats.
+"""
+import abc
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+import cache
+
+REDIS_URL = os.getenv("REDIS_URL")
+PREFIX = os.getenv("STATE_PREFIX", "wa:")
+HISTORY_LEN = 8                                          # messages kept per chat (then token-budgeted)
+HISTORY_TTL = float(os.getenv("HISTORY_TTL", str(6 * 3600)))
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL", str(24 * 3600)))    # > Green API redelivery window
+SEEN_TTL = float(os.getenv("SEEN_TTL", str(30 * 86400)))
+LANG_TTL = 24 * 3600                                     # DB (user_prefs) is the source of truth
+CHAT_LEASE = float(os.getenv("CHAT_LEASE", "120"))       # > debounce MAX_WAIT + a slow LLM answer
+ALIVE_TTL = 5                                            # a process silent this long loses its chats
+
+
+class StateBackend(abc.ABC):
+    """claim_message(id) -> True the first time an id is seen (atomic).
+    first_contact(chat) -> True the first time a chat is seen (atomic)."""
+    name = "base"
+
+    @abc.abstractmethod
+    def claim_message(self, message_id):
+        ...
+
+    @abc.abstractmethod
+    def release_message(self, message_id):
+        ...
+
+    @abc.abstractmethod
+    def first_contact(self, chat_id):
+        ...
+
+    @abc.abstractmethod
+    def get_lang(self, chat_id):
+        ...
+
+    @abc.abstractmethod
+    def set_lang(self, chat_id, lang):
+        ...
+
+    @abc.abstractmethod
+    def get_history(self, chat_id):
+        """Oldest first, at most HISTORY_LEN messages."""
+
+    @abc.abstractmethod
+    def append_history(self, chat_id, *messages):
+        ...
+
+    # one process unless overridden: every chat is handled where its webhook lands
+    def owner_of(self, chat_id):
+        """None if this process handles the chat, else the id of the process holding it."""
+        return None
+
+    def forward(self, owner, item):
+        """Hand a message to the process holding its chat. False = handle it here."""
+        return False
+
+    def start_inbox(self, handler):
+        """Start feeding forwarded messages to handler(item) in this process."""
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+def _history_bytes(history):
+    return sum(len(m["content"]) for m in history) * 2 + 200
+
+
+class MemoryState(StateBackend):
+    name = "memory"
+
+    def __init__(self):
+        self.history = cache.TTLCache(int(os.getenv("HISTORY_MAX_CHATS", "5000")), HISTORY_TTL,
+                                      weigh=_history_bytes,
+                                      max_weight=int(os.getenv("HISTORY_MAX_MB", "32")) << 20)
+        self.processed = cache.TTLSet(int(os.getenv("DEDUPE_MAX_IDS", "50000")), DEDUPE_TTL)
+        self.lang = cache.TTLCache(int(os.getenv("LANG_CACHE_MAX", "20000")), LANG_TTL)
+        self.seen = cache.TTLSet(int(os.getenv("SEEN_MAX_CHATS", "100000")), SEEN_TTL)
+
+    def claim_message(self, message_id):
+        return self.processed.add_if_absent(message_id)
+
+    def release_message(self, message_id):
+        self.processed.discard(message_id)
+
+    def first_contact(self, chat_id):
+        return self.seen.add_if_absent(chat_id)
+
+    def get_lang(self, chat_id):
+        return self.lang.get(chat_id)
+
+    def set_lang(self, chat_id, lang):
+        self.lang[chat_id] = lang
+
+    def get_history(self, chat_id):
+        return list(self.history.get(chat_id, ()))
+
+    def append_history(self, chat_id, *messages):
+        self.history.update(chat_id, lambda h: (h + list(messages))[-HISTORY_LEN:], [])
+
+    def stats(self):
+        return {"backend": self.name, "history": self.history.stats(), "dedupe": self.processed.stats(),
+                "lang": self.lang.stats(), "seen": self.seen.stats()}
+
+
+class RedisState(StateBackend):
+    name = "redis"
+
+    def __init__(self, url):
+        import redis                                     # optional dependency, only with REDIS_URL
+        self.r = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2,
+                                      health_check_interval=30)
+        self.errors = self.forwarded = self.received = 0
+        self._me = self._me_pid = self._inbox = None
+
+    def _k(self, kind, key):
+        return f"{PREFIX}{kind}:{key}"
+
+    @property
+    def me(self):
+        """This process (a preloaded app is forked: computed again in each worker)."""
+        if self._me_pid != os.getpid():
+            self._me, self._me_pid = f"{socket.gethostname()}:{os.getpid()}", os.getpid()
+        return self._me
+
+    def _fail(self, what, default):
+        self.errors += 1
+        print(f"[STATE] redis {what} failed:"); traceback.print_exc()
+        return default
+
+    def claim_message(self, message_id):
+        try:
+            return bool(self.r.set(self._k("msg", message_id), 1, nx=True, ex=int(DEDUPE_TTL)))
+        except Exception:
+            return self._fail("claim_message", True)     # better a rare double reply than a lost message
+
+    def release_message(self, message_id):
+        try:
+            self.r.delete(self._k("msg", message_id))
+        except Exception:
+            self._fail("release_message", None)
+
+    def first_contact(self, chat_id):
+        try:
+            return bool(self.r.set(self._k("seen", chat_id), 1, nx=True, ex=int(SEEN_TTL)))
+        except Exception:
+            return self._fail("first_contact", False)    # don't re-send the menu on every message
+
+    def get_lang(self, chat_id):
+        try:
+            v = self.r.get(self._k("lang", chat_id))
+            return v.decode() if v else None
+        except Exception:
+            return self._fail("get_lang", None)
+
+    def set_lang(self, chat_id, lang):
+        try:
+            self.r.set(self._k("lang", chat_id), lang, ex=LANG_TTL)
+        except Exception:
+            self._fail("set_lang", None)
+
+    def get_history(self, chat_id):
+        try:
+            return [json.loads(m) for m in self.r.lrange(self._k("hist", chat_id), 0, -1)]
+        except Exception:
+            return self._fail("get_history", [])
+
+    def append_history(self, chat_id, *messages):
+        key = self._k("hist", chat_id)
+        try:
+            p = self.r.pipeline(transaction=True)
+            p.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+            p.ltrim(key, -HISTORY_LEN, -1)
+            p.expire(key, int(HISTORY_TTL))
+            p.execute()
+        except Exception:
+            self._fail("append_history", None)
+
+    # ----- chat leases -----
+    def owner_of(self, chat_id):
+        import redis
+        key, me, ms = self._k("owner", chat_id), self.me, int(CHAT_LEASE * 1000)
+        try:
+            for _ in range(3):
+                if self.r.set(key, me, nx=True, px=ms):
+                    return None
+                with self.r.pipeline() as p:
+                    try:
+                        p.watch(key)
+                        owner = p.get(key)
+                        owner = owner.decode() if owner else None
+                        alive = owner == me or (owner is not None and p.exists(self._k("alive", owner)))
+                        p.multi()
+                        if alive:
+                            p.pexpire(key, ms)          # every message extends the lease
+                        else:
+                            p.set(key, me, px=ms)       # its process is gone: take the chat over
+                        p.execute()
+                    except redis.WatchError:
+                        continue
+                if alive:
+                    return None if owner == me else owner
+                if owner:                               # what the dead process never picked up
+                    while self.r.lmove(self._k("inbox", owner), self._k("inbox", me)):
+                        pass
+                return None
+            return None
+        except Exception:
+            return self._fail("owner_of", None)         # handle it here
+
+    def forward(self, owner, item):
+        key = self._k("inbox", owner)
+        try:
+            p = self.r.pipeline(transaction=True)
+            p.rpush(key, json.dumps(item, ensure_ascii=False))
+            p.expire(key, int(CHAT_LEASE))
+            p.execute()
+            self.forwarded += 1
+            return True
+        except Exception:
+            return self._fail("forward", False)
+
+    def heartbeat(self):
+        self.r.set(self._k("alive", self.me), 1, ex=ALIVE_TTL)
+
+    def poll_inbox(self, timeout=1):
+        """Next forwarded message for this process, or None after `timeout` seconds."""
+        got = self.r.blpop([self._k("inbox", self.me)], timeout=timeout)
+        if got is None:
+            return None
+        self.received += 1
+        return json.loads(got[1])
+
+    def start_inbox(self, handler):
+        if self._inbox is not None and self._inbox.is_alive():
+            return
+        self._inbox = threading.Thread(target=self._inbox_loop, args=(handler,), name="wa-inbox", daemon=True)
+        self._inbox.start()
+
+    def _inbox_loop(self, handler):
+        while True:
+            try:
+                self.heartbeat()
+                item = self.poll_inbox(1)                # < socket_timeout
+                if item is not None:
+                    handler(item)
+            except Exception:
+                self._fail("inbox", None)
+                time.sleep(1)
+
+    def stats(self):
+        return {"backend": self.name, "errors": self.errors, "forwarded": self.forwarded,
+                "received": self.received}
+
+
+def from_env():
+    if REDIS_URL:
+        try:
+            return RedisState(REDIS_URL)
+        except Exception:
+            print("[STATE] redis unavailable, falling back to in-process state:"); traceback.print_exc()
+    return MemoryState()
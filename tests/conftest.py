@@ -0,0 +1,28 @@
+"""Shared fixtures. `database`: db.py pointed at a throwaway `test_db` schema in TEST_DATABASE_URL
+(created and dropped per test); the test is skipped when no URL is set."""
+import os
+
+import psycopg2
+import pytest
+
+import db
+
+SCHEMA = "test_db"
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL not set")
+    admin = psycopg2.connect(TEST_DATABASE_URL)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    sep = "&" if "?" in TEST_DATABASE_URL else "?"
+    db.close_pool()
+    monkeypatch.setattr(db, "DATABASE_URL", f"{TEST_DATABASE_URL}{sep}options=-csearch_path%3D{SCHEMA}")
+    db.init_db()
+    yield admin
+    db.close_pool()
+    admin.cursor().execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    admin.close()
@@ -0,0 +1,39 @@
+"""Answer cache on near-miss pairs: (cached question, asked question, should the cached answer be reused)."""
+import pytest
+
+import answer_cache
+
+PAIRS = [
+    ("работает ли бар у бассейна", "работает ли бар у бассейна ночью", False),
+    ("сколько стоит вход в выходные дни", "сколько стоит вход в выходные дни детям", False),
+    ("до скольки работает аквапарк в субботу", "до скольки работает аквапарк в субботу вечером", False),
+    ("is there parking near the entrance", "is there free parking near the entrance", False),
+    ("бронь топчана на 5 человек", "бронь топчана на 10 человек", False),
+    ("работает ли бар у бассейна", "Работает ли бар у бассейна??", True),
+    ("есть ли парковка", "а есть ли парковка?", True),
+    ("где находится бассейн с горками", "где находиться бассейн с горками", True),
+    ("можно ли прийти со своей едой", "можно ли прийти со свой едой", True),
+    ("сколько стоит вход в выходные дни", "сколько стоит вход в выходные днии", True),
+]
+
+
+@pytest.mark.parametrize("cached, asked, want", PAIRS)
+def test_near_miss_pairs(cached, asked, want):
+    c = answer_cache.AnswerCache()
+    c.store(cached, "ru", "answer")
+    assert (c.lookup(asked, "ru") is not None) == want
+
+
+def test_time_dependent_questions_are_not_cached():
+    c = answer_cache.AnswerCache()
+    c.store("работает ли бар сейчас", "ru", "answer")
+    assert c.lookup("работает ли бар сейчас", "ru") is None
+    assert c.stats()["size"] == 0
+
+
+def test_new_fingerprint_empties_the_cache():
+    c = answer_cache.AnswerCache(fingerprint="a")
+    c.store("есть ли парковка", "ru", "answer")
+    c.set_fingerprint("b")
+    assert c.lookup("есть ли парковка", "ru") is None
+    assert c.stats()["invalidations"] == 1
@@ -0,0 +1,96 @@
+"""db.py: write-behind buffer, spin days, daily_stats, concurrent spins. Tests using the `database`
+fixture need a throwaway Postgres in TEST_DATABASE_URL and are skipped without one."""
+import datetime
+import threading
+
+import db
+
+from conftest import SCHEMA
+
+
+def test_buffer_is_capped_while_db_is_down(monkeypatch):
+    monkeypatch.setattr(db, "DATABASE_URL", "postgresql://127.0.0.1:1/none?connect_timeout=1")
+    monkeypatch.setattr(db, "BUFFER_MAX", 3)
+    buf = db._WriteBuffer()
+    day = datetime.date(2026, 7, 1)
+    for chat in range(5):
+        buf.add_spin(chat, day, "x")
+    assert len(buf.spins) == 3 and buf.dropped == 2
+    assert not buf.has_spin(0, day) and buf.has_spin(4, day)        # oldest dropped first
+    buf.add_contact((7, "Aru", "+77010000000", "booking", None))
+    buf.flush()                                                      # connection refused: kept for retry
+    assert buf.failed == 1 and buf.rows == 0
+    assert len(buf.spins) == 3 and len(buf.contacts) == 1
+
+
+def test_rejected_rows_are_dropped_not_retried(database):
+    buf = db._WriteBuffer()
+    for i in range(5):
+        buf.add_contact((i, "bad\x00name" if i == 3 else f"guest {i}", "+7701", "booking", None))
+    buf.set_lang(1, "kk")
+    buf.flush()
+    assert (buf.rows, buf.rejected, buf.failed, buf._pending()) == (5, 1, 0, 0)
+    with database.cursor() as cur:
+        cur.execute(f"SELECT chat_id FROM {SCHEMA}.contacts ORDER BY chat_id")
+        assert [r[0] for r in cur.fetchall()] == [0, 1, 2, 4]
+
+
+def test_spin_day_is_one_clock_for_buffer_and_sql(database, monkeypatch):
+    # a session time zone far from Almaty: CURRENT_DATE there is another day for most of the day
+    monkeypatch.setattr(db, "DATABASE_URL", db.DATABASE_URL + "%20-cTimeZone%3DEtc/GMT%2B12")
+    monkeypatch.setattr(db, "WRITE_BEHIND", True)
+    db.record_spin(77, "lose")
+    assert db.can_spin_today(77) is False                            # pending in the buffer
+    db.flush_writes()
+    assert db.can_spin_today(77) is False                            # now from the table
+    assert db.spin(77, "lose", "", "", False, db.spin_day(), None) == (False, None, False)
+    with database.cursor() as cur:
+        cur.execute(f"SELECT spin_date FROM {SCHEMA}.spins WHERE chat_id=77")
+        assert cur.fetchall() == [(db.spin_day(),)]
+
+
+def test_daily_stats_report_reads_counters_and_reconcile_fixes_drift(database, monkeypatch):
+    monkeypatch.setattr(db, "DAILY_STATS", True)
+    monkeypatch.setattr(db, "WRITE_BEHIND", False)
+    db.init_db()
+    day = db.spin_day()
+    db.record_spin(1, "lose")
+    db.record_spin(2, "lose")
+    db.create_prize("C1", 2, "drink", "Drink", "bar", day)
+    assert db.report_data(day, None) == {"spins": 2, "won": [("Drink", 1)], "redeemed": 0, "contacts": 0}
+    with database.cursor() as cur:                                   # a writer that doesn't bump the counters
+        cur.execute(f"INSERT INTO {SCHEMA}.spins (chat_id, spin_date, prize) VALUES (3, %s, 'lose')", (day,))
+    assert db.report_data(day, None)["spins"] == 2                   # the report only reads
+    assert db.reconcile_daily_stats(day) == 1
+    assert db.report_data(day, None)["spins"] == 3
+    assert db.reconcile_daily_stats(day) == 0
+
+
+def test_concurrent_spins_one_winner_per_chat_and_day(database, monkeypatch):
+    monkeypatch.setattr(db, "POOL_MAX", 16)
+    monkeypatch.setattr(db, "_pool", None)                           # rebuilt with the larger size
+    db.add_prize_codes([f"P{i:03d}" for i in range(10)])             # fewer codes than chats: fallbacks too
+    day, chats, taps = db.spin_day(), 20, 6
+    results, lock = [], threading.Lock()
+    start = threading.Barrier(chats * taps)
+
+    def tap(chat, i):
+        start.wait()
+        r = db.spin(chat, "drink", "Drink", "bar", True, day, f"F{chat:03d}{i}")
+        with lock:
+            results.append((chat, r))
+    threads = [threading.Thread(target=tap, args=(chat, i)) for chat in range(chats) for i in range(taps)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    won = [(chat, code) for chat, (spun, code, _) in results if spun]
+    assert sorted(chat for chat, _ in won) == list(range(chats))      # exactly one winning tap per chat
+    assert len({code for _, code in won}) == chats                     # and no code handed out twice
+    with database.cursor() as cur:
+        cur.execute(f"SELECT count(*), count(DISTINCT chat_id) FROM {SCHEMA}.spins WHERE spin_date=%s", (day,))
+        assert cur.fetchone() == (chats, chats)
+        cur.execute(f"SELECT count(*), count(DISTINCT chat_id) FROM {SCHEMA}.prizes")
+        assert cur.fetchone() == (chats, chats)
+        cur.execute(f"SELECT count(*) FROM {SCHEMA}.prize_codes")
+        assert cur.fetchone() == (0,)
@@ -0,0 +1,137 @@
+"""http_client.Client against a local scripted HTTP server: retries with jittered backoff,
+the Retry-After cap, the circuit breaker, latency on /metrics."""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import http_client
+import metrics
+
+
+class Scripted:
+    """Answers requests with the queued (status, headers) in order, then 200s."""
+    def __init__(self):
+        self.script, self.hits = [], 0
+        srv = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                srv.hits += 1
+                status, headers = srv.script.pop(0) if srv.script else (200, {})
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *a):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+
+@pytest.fixture
+def server():
+    s = Scripted()
+    yield s
+    s.server.shutdown()
+    s.server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays the client asked for (not slept) and the jitter ranges it drew them from."""
+    got = {"sleep": [], "uniform": []}
+    monkeypatch.setattr(http_client.time, "sleep", got["sleep"].append)
+    monkeypatch.setattr(http_client.random, "uniform", lambda a, b: got["uniform"].append((a, b)) or b / 2)
+    return got
+
+
+def test_retries_5xx_with_jittered_exponential_backoff(server, sleeps, monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF", 0.5)
+    server.script = [(503, {}), (502, {})]
+    c = http_client.Client("t-retry", retries=2)
+    assert c.get("ep", server.url).status_code == 200
+    assert server.hits == 3 and c.retried == 2
+    assert sleeps["uniform"] == [(0, 0.5), (0, 1.0)]                  # full jitter over BACKOFF * 2^attempt
+    assert sleeps["sleep"] == [0.25, 0.5]
+    assert c.breaker.state == "closed"
+
+
+def test_backoff_is_capped(server, sleeps, monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF", 5.0)
+    server.script = [(500, {})] * 3
+    c = http_client.Client("t-cap", retries=3)
+    assert c.get("ep", server.url).status_code == 200
+    assert sleeps["uniform"] == [(0, 5.0), (0, http_client.BACKOFF_CAP), (0, http_client.BACKOFF_CAP)]
+
+
+def test_retry_after_is_honoured_and_capped(server, sleeps):
+    server.script = [(429, {"Retry-After": "1.5"}), (503, {"Retry-After": "3600"})]
+    c = http_client.Client("t-retry-after", retries=2)
+    assert c.get("ep", server.url).status_code == 200
+    assert sleeps["sleep"] == [1.5, http_client.BACKOFF_CAP] and sleeps["uniform"] == []
+
+
+def test_gives_up_with_the_last_response(server, sleeps):
+    server.script = [(503, {})] * 2
+    c = http_client.Client("t-give-up", retries=1)
+    assert c.get("ep", server.url).status_code == 503
+    assert server.hits == 2 and c.breaker.fails == 1
+
+
+def test_4xx_is_not_retried(server, sleeps):
+    server.script = [(400, {})]
+    c = http_client.Client("t-4xx", retries=2)
+    assert c.get("ep", server.url).status_code == 400
+    assert server.hits == 1 and sleeps["sleep"] == []
+
+
+def test_connection_errors_are_retried_then_raised(sleeps):
+    c = http_client.Client("t-conn", retries=2)
+    with pytest.raises(requests.ConnectionError):
+        c.get("ep", "http://127.0.0.1:1/")
+    assert len(sleeps["sleep"]) == 2 and c.breaker.fails == 1
+
+
+def test_breaker_open_half_open_closed(server, sleeps, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(http_client.time, "monotonic", lambda: clock[0])
+    c = http_client.Client("t-breaker", retries=0, breaker=http_client.Breaker(failures=2, cooldown=30))
+    server.script = [(503, {})] * 2
+    c.get("ep", server.url)
+    assert c.breaker.state == "closed"
+    c.get("ep", server.url)
+    assert c.breaker.state == "open" and c.breaker.trips == 1
+    with pytest.raises(http_client.CircuitOpen):                      # fails fast, the server isn't called
+        c.get("ep", server.url)
+    assert server.hits == 2
+
+    clock[0] += 30                                                     # cooldown over: one probe
+    server.script = [(503, {})]
+    c.get("ep", server.url)
+    assert c.breaker.state == "open" and server.hits == 3             # the probe failed: open again
+    with pytest.raises(http_client.CircuitOpen):
+        c.get("ep", server.url)
+
+    clock[0] += 30
+    assert c.get("ep", server.url).status_code == 200
+    assert c.breaker.state == "closed" and c.breaker.fails == 0
+    assert c.get("ep", server.url).status_code == 200
+
+
+def test_latency_on_metrics(server):
+    c = http_client.Client("t-metrics", retries=0)
+    c.get("sendMessage", server.url)
+    c.get("sendMessage", server.url)
+    text = metrics.render()
+    assert 'wa_http_request_seconds_count{provider="t-metrics",endpoint="sendMessage"} 2' in text
+    assert c.stats()["latency"]["sendMessage"]["count"] == 2
@@ -0,0 +1,96 @@
+"""Language detection on a labelled RU/KK/EN set (none of it in the training strings) and
+update_lang on a new chat. The same set drives bench/lang_bench.py."""
+import os
+
+import pytest
+
+import translations as i18n
+
+# (text, expected)
+LABELLED = [
+    # ru
+    ("Добрый вечер, а у вас сегодня пенная вечеринка?", "ru"),
+    ("сколько будет стоить вход на троих", "ru"),
+    ("а полотенца выдаёте или брать свои", "ru"),
+    ("можно прийти со своей едой", "ru"),
+    ("есть ли парковка рядом", "ru"),
+    ("во сколько закрывается бар", "ru"),
+    ("мы опоздаем минут на двадцать", "ru"),
+    ("подскажите адрес пожалуйста", "ru"),
+    ("какая глубина бассейна", "ru"),
+    ("нужно ли брать паспорт", "ru"),
+    ("спасибо большое", "ru"),
+    ("понятно, тогда до встречи", "ru"),
+    ("а дети до скольки лет бесплатно", "ru"),
+    ("бронь на субботу ещё актуальна?", "ru"),
+    ("privet, skolko stoit vhod v subbotu", "ru"),
+    ("a do skolki vy rabotaete", "ru"),
+    ("spasibo, budem", "ru"),
+    # kk
+    ("Кешке кіруге бола ма?", "kk"),
+    ("бүгін кешке келеміз", "kk"),
+    ("балаларға жеңілдік бар ма", "kk"),
+    ("көлік қоятын орын бар ма", "kk"),
+    ("бар сағат нешеге дейін жұмыс істейді", "kk"),
+    ("мекенжайыңызды жіберіңізші", "kk"),
+    ("рахмет, келеміз", "kk"),
+    ("жарайды, түсінікті", "kk"),
+    ("сіздерде сауна бар ма", "kk"),
+    ("төлемді картамен жасауға бола ма", "kk"),
+    ("бала неше жастан бастап тегін", "kk"),
+    ("салем, бугин ашыксыздар ма", "kk"),
+    ("кыз балалар ушин бага калай", "kk"),
+    ("salem, kiru qansha turady", "kk"),
+    ("rakhmet, baramyz", "kk"),
+    ("qai jerde ornalasqansyzdar", "kk"),
+    ("büğın aşyqsyzdar ma", "kk"),
+    # en
+    ("Good evening, is the foam party on tonight?", "en"),
+    ("how much would entry be for three of us", "en"),
+    ("do you provide towels or should we bring ours", "en"),
+    ("can we bring our own food", "en"),
+    ("is there parking nearby", "en"),
+    ("what time does the bar close", "en"),
+    ("we will be about twenty minutes late", "en"),
+    ("could you send the address please", "en"),
+    ("how deep is the pool", "en"),
+    ("do we need a passport", "en"),
+    ("thank you so much", "en"),
+    ("got it, see you then", "en"),
+    ("up to what age are kids free", "en"),
+    ("is the saturday booking still on?", "en"),
+    ("sorry, wrong chat", "en"),
+    ("any discounts for students", "en"),
+]
+
+
+def test_labelled_accuracy():
+    misses = [(text, want, i18n.detect(text)) for text, want in LABELLED if i18n.detect(text)[0] != want]
+    assert len(misses) <= len(LABELLED) // 20, misses          # 95% or better
+
+
+@pytest.fixture
+def main(monkeypatch):
+    os.environ.setdefault("DATABASE_URL", "")
+    import main
+    sent = []
+    monkeypatch.setattr(main, "ga_send", lambda chat_id, text, *a, **kw: sent.append((chat_id, text)))
+    main.sent = sent
+    return main
+
+
+@pytest.mark.parametrize("text, lang", [("hi", "en"), ("hey", "en"), ("сәлем", "kk"), ("привет", "ru")])
+def test_new_chat_greeting_menu_in_its_language(main, text, lang):
+    chat = f"7700{abs(hash(text)) % 10**7:07d}@c.us"
+    main.handle_message(chat, text)
+    assert main.sent == [(chat, main.wa_t(lang, "wa_menu"))]
+    assert main.L(chat) == lang
+
+
+def test_settled_chat_ignores_one_weak_message(main):
+    chat = "77000000001@c.us"
+    main.handle_message(chat, "сколько стоит вход в субботу")
+    assert main.L(chat) == "ru"
+    main.update_lang(chat, main.message.parse(chat, "ok"))
+    main.update_lang(chat, main.message.parse(chat, "hi"))
+    assert main.L(chat) == "ru"
@@ -0,0 +1,80 @@
+"""redemption.py on Postgres (TEST_DATABASE_URL): the in-memory code index answers rejects without a
+query, follows issues and redeems of other processes through NOTIFY, and redeems in the DB."""
+import datetime
+import time
+
+import pytest
+
+import db
+import redemption
+
+
+def _wait(pred, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not pred():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def _queries():
+    return sum(q["calls"] for q in db.stats()["queries"].values())
+
+
+@pytest.fixture
+def index(database, monkeypatch):
+    today = redemption.today()
+    for i, (status, day) in enumerate((("issued", today), ("redeemed", today),
+                                       ("issued", today - datetime.timedelta(days=1)),
+                                       ("issued", today - datetime.timedelta(days=30)),
+                                       ("redeemed", today - datetime.timedelta(days=30)))):
+        db.create_prize(f"C{i}", i, "shot", "🥃 Shot", "cashier", day)
+        if status == "redeemed":
+            db.redeem_prize(f"C{i}", 1, day)
+    monkeypatch.setattr(redemption, "RECENT", 0.0)
+    idx = redemption.CodeIndex()
+    monkeypatch.setattr(redemption, "codes", idx)
+    idx.start()
+    _wait(lambda: idx.stats()["live"])
+    return idx
+
+
+def test_rejects_come_from_memory(index):
+    q0 = _queries()
+    assert redemption.check("C1")[0] == "used"
+    assert redemption.check("C2")[0] == "expired"
+    assert redemption.check("C3")[0] == "expired"               # a month old: still in the index
+    assert redemption.check("C4")[0] == "used"
+    assert redemption.check("TYPO")[0] == "unknown"
+    assert redemption.redeem("C4", 2)[0] == "used"
+    assert redemption.redeem("TYPO", 2)[0] == "unknown"
+    assert _queries() == q0
+
+
+def test_redeem_goes_to_the_db_once(index):
+    v, prize = redemption.redeem("C0", 2)
+    assert v == "ok" and prize["status"] == "redeemed"
+    q0 = _queries()
+    assert redemption.redeem("C0", 2)[0] == "used"
+    assert _queries() == q0
+    assert db.get_prize("C0")["status"] == "redeemed"
+
+
+def test_other_processes_writes_arrive_by_notify(index):
+    other = redemption.CodeIndex()
+    other.start()
+    _wait(lambda: other.stats()["live"])
+    db.create_prize("NEW", 9, "beer", "🍺 Beer", "cashier", redemption.today())
+    _wait(lambda: index.get("NEW")[1] is not None)
+    assert redemption.redeem("NEW", 2)[0] == "ok"
+    _wait(lambda: other.get("NEW")[1]["status"] == "redeemed")
+
+
+def test_miss_right_after_an_issue_is_checked_in_the_db(index, monkeypatch):
+    monkeypatch.setattr(redemption, "RECENT", 60.0)
+    assert index.get("TYPO") == (True, None)                      # nothing issued since the load
+    db.create_prize("NEW", 9, "beer", "🍺 Beer", "cashier", redemption.today())
+    _wait(lambda: index.get("NEW")[1] is not None)
+    assert index.get("TYPO") == (False, None)                     # its NOTIFY could still be on the way
+    q0 = _queries()
+    assert redemption.check("TYPO") == ("unknown", None)
+    assert _queries() == q0 + 1
@@ -0,0 +1,165 @@
+"""RedisState against fakeredis: atomic claims, history cap / TTL, chat leases, fallbacks when Redis fails."""
+import os
+
+import fakeredis
+import pytest
+import redis
+
+import state
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def backend(monkeypatch, server):
+    fake = classmethod(lambda cls, url, **kw: fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(redis.Redis, "from_url", fake)
+    return state.RedisState("redis://fake")
+
+
+def test_state_backend_is_abstract():
+    with pytest.raises(TypeError):
+        state.StateBackend()
+
+
+def test_claim_message_once(backend):
+    assert backend.claim_message("m1") is True
+    assert backend.claim_message("m1") is False
+    assert backend.claim_message("m2") is True
+    assert 0 < backend.r.ttl(f"{state.PREFIX}msg:m1") <= state.DEDUPE_TTL
+
+
+def test_claim_message_shared_between_processes(server, backend):
+    other = state.RedisState.__new__(state.RedisState)
+    other.r, other.errors = fakeredis.FakeRedis(server=server), 0
+    assert backend.claim_message("m1") is True
+    assert other.claim_message("m1") is False
+
+
+def test_release_message_allows_redelivery(backend):
+    assert backend.claim_message("m1")
+    backend.release_message("m1")
+    assert backend.claim_message("m1") is True
+
+
+def test_first_contact_once(backend):
+    assert backend.first_contact("7701@c.us") is True
+    assert backend.first_contact("7701@c.us") is False
+    assert 0 < backend.r.ttl(f"{state.PREFIX}seen:7701@c.us") <= state.SEEN_TTL
+
+
+def test_lang_roundtrip(backend):
+    assert backend.get_lang("c") is None
+    backend.set_lang("c", "kk")
+    assert backend.get_lang("c") == "kk"
+    assert 0 < backend.r.ttl(f"{state.PREFIX}lang:c") <= state.LANG_TTL
+
+
+def test_history_capped_and_expiring(backend):
+    for i in range(state.HISTORY_LEN + 3):
+        backend.append_history("c", {"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"})
+    history = backend.get_history("c")
+    assert len(history) == state.HISTORY_LEN
+    assert history[-1] == {"role": "assistant", "content": f"a{state.HISTORY_LEN + 2}"}
+    assert 0 < backend.r.ttl(f"{state.PREFIX}hist:c") <= state.HISTORY_TTL
+
+
+def test_history_keeps_non_ascii(backend):
+    backend.append_history("c", {"role": "user", "content": "сәлем 👋"})
+    assert backend.get_history("c") == [{"role": "user", "content": "сәлем 👋"}]
+
+
+def test_fallbacks_when_redis_is_down(server, backend):
+    backend.set_lang("c", "ru")
+    server.connected = False
+    assert backend.claim_message("m1") is True           # better a rare double reply than a lost message
+    assert backend.first_contact("c") is False           # don't re-send the menu on every message
+    assert backend.get_lang("c") is None
+    assert backend.get_history("c") == []
+    backend.set_lang("c", "en")
+    backend.append_history("c", {"role": "user", "content": "hi"})
+    backend.release_message("m1")
+    assert backend.stats()["errors"] == 7
+    assert backend.owner_of("c") is None                 # handle it here
+    server.connected = True
+    assert backend.get_lang("c") == "ru"
+
+
+def _process(server, name):
+    s = state.RedisState.__new__(state.RedisState)
+    s.r = fakeredis.FakeRedis(server=server)
+    s.errors = s.forwarded = s.received = 0
+    s._me, s._me_pid, s._inbox = name, os.getpid(), None
+    return s
+
+
+def test_chat_lease_sends_a_chat_to_one_process(server):
+    a, b = _process(server, "A"), _process(server, "B")
+    a.heartbeat()
+    b.heartbeat()
+    assert a.owner_of("c1") is None                      # first one takes it
+    assert b.owner_of("c1") == "A"
+    assert b.owner_of("c2") is None
+    assert a.owner_of("c2") == "B"
+    assert a.owner_of("c1") is None
+    assert 0 < a.r.pttl(f"{state.PREFIX}owner:c1") <= state.CHAT_LEASE * 1000
+
+
+def test_forwarded_messages_reach_the_owner_in_order(server):
+    a, b = _process(server, "A"), _process(server, "B")
+    for i in range(3):
+        assert b.forward("A", ["m%d" % i, "c1", "text %d" % i])
+    assert [a.poll_inbox(1) for _ in range(3)] == [["m%d" % i, "c1", "text %d" % i] for i in range(3)]
+    assert a.poll_inbox(1) is None
+    assert (b.stats()["forwarded"], a.stats()["received"]) == (3, 3)
+
+
+def test_dead_owner_loses_its_chats_and_inbox(server):
+    a, b = _process(server, "A"), _process(server, "B")
+    a.heartbeat()
+    assert a.owner_of("c1") is None
+    b.forward("A", ["m1", "c1", "hi"])
+    a.r.delete(f"{state.PREFIX}alive:A")                 # A stopped sending heartbeats
+    assert b.owner_of("c1") is None                      # B takes the chat over...
+    assert b.poll_inbox(1) == ["m1", "c1", "hi"]         # ...and what A never picked up
+    b.heartbeat()
+    assert a.owner_of("c1") == "B"
+
+
+def test_memory_state_handles_every_chat_here():
+    m = state.MemoryState()
+    assert m.owner_of("c1") is None
+    assert m.forward("A", ["m1", "c1", "hi"]) is False
+
+
+def test_from_env_falls_back_to_memory(monkeypatch):
+    def broken(url):
+        raise OSError("no redis")
+    monkeypatch.setattr(state, "REDIS_URL", "redis://fake")
+    monkeypatch.setattr(state, "RedisState", broken)
+    assert isinstance(state.from_env(), state.MemoryState)
+
+
+class _Req:
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self, force=False):
+        return self.data
+
+
+def test_webhook_forwards_a_chat_held_elsewhere(server, monkeypatch):
+    os.environ.setdefault("DATABASE_URL", "")
+    import main
+    a, b = _process(server, "A"), _process(server, "B")
+    a.heartbeat()
+    a.owner_of("7701@c.us")
+    monkeypatch.setattr(main, "store", b)
+    payload = {"typeWebhook": "incomingMessageReceived", "idMessage": "m1", "senderData": {"chatId": "7701@c.us"},
+               "messageData": {"textMessageData": {"textMessage": "сколько стоит вход"}}}
+    assert main._webhook(_Req(payload)) == ("forwarded", 200)
+    assert main._webhook(_Req(payload)) == ("duplicate", 200)
+    assert a.poll_inbox(1) == ["m1", "7701@c.us", "сколько стоит вход"]
@@ -0,0 +1,95 @@
+"""Streamed LLM replies against bench/fakes.OpenRouterStub: SSE parsing, where replies are cut into
+WhatsApp messages, and what a guest / the chat history get when the stream breaks off."""
+import os
+
+import pytest
+import requests
+
+from bench.fakes import OpenRouterStub
+
+os.environ.setdefault("DATABASE_URL", "")
+import main  # noqa: E402
+
+ANSWER = ("Вход в будни 7000 ₸. В выходные 10000 ₸.\n\nСауна включена. Полотенца можно взять на месте! "
+          "Дети до 7 лет бесплатно. Ждём вас в Tsunami 🌊")
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    stubs = []
+
+    def start(**kw):
+        stub = OpenRouterStub(answer=ANSWER, **kw)
+        stubs.append(stub)
+        monkeypatch.setattr(main, "OPENROUTER_URL", f"{stub.url}/api/v1/chat/completions")
+        return stub
+    main.openrouter.reset()
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+def _stream(min_chunk, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_MIN_CHUNK", min_chunk)
+    sent = []
+    reply, complete = main.ask_openrouter_stream("сколько стоит вход", [], sent.append)
+    return reply, complete, sent
+
+
+def test_sse_deltas_skip_comments_and_keep_usage(llm):
+    stub = llm()
+    usage = {}
+    with requests.post(f"{stub.url}/api/v1/chat/completions", json={"stream": True}, stream=True) as r:
+        deltas = list(main._sse_deltas(r, usage))
+    assert "".join(deltas) == ANSWER
+    assert all(len(d) <= 12 for d in deltas)
+    assert usage["prompt_tokens"] == 900
+
+
+def test_sse_deltas_raise_on_a_stream_without_done(llm):
+    stub = llm(cut_after=3)
+    with requests.post(f"{stub.url}/api/v1/chat/completions", json={"stream": True}, stream=True) as r:
+        with pytest.raises(RuntimeError):
+            list(main._sse_deltas(r, {}))
+
+
+def test_split_ready():
+    assert main._split_ready("short. text", 50) == (None, "short. text")
+    para = "a" * 30 + ". first\n\nsecond. " + "b" * 5
+    assert main._split_ready(para, 20) == ("a" * 30 + ". first", "second. " + "b" * 5)   # paragraph first
+    assert main._split_ready("a" * 30 + ". b. c", 20) == ("a" * 30 + ". b.", "c")        # else the last sentence
+    assert main._split_ready("a" * 30 + ". " + "b" * 5, 40) == (None, "a" * 30 + ". " + "b" * 5)
+    assert main._split_ready("x" * 100, 20) == (None, "x" * 100)                          # no boundary: wait
+
+
+def test_min_chunk_rule(llm, monkeypatch):
+    llm()
+    reply, complete, sent = _stream(30, monkeypatch)
+    assert complete and len(sent) > 1
+    assert all(len(part) >= 30 for part in sent[:-1])           # only the tail may be shorter
+    assert reply == "\n\n".join(sent)
+    assert " ".join(reply.split()) == " ".join(ANSWER.split())
+
+
+def test_broken_stream_ends_with_ai_cut(llm, monkeypatch):
+    llm(cut_after=5)
+    reply, complete, sent = _stream(20, monkeypatch)
+    assert not complete
+    assert sent[-1] == main.AI_CUT
+    assert reply == "\n\n".join(sent[:-1]) and reply                 # what the guest got before the break
+    assert ANSWER.startswith(reply.split("\n\n")[0])
+
+
+def test_partial_reply_is_kept_out_of_history(llm, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "OPENROUTER_STREAM", True)
+    monkeypatch.setattr(main, "STREAM_MIN_CHUNK", 20)
+    monkeypatch.setattr(main, "ga_send", lambda chat_id, text, *a, **kw: sent.append(text))
+    llm(cut_after=5)
+    main._ask("77000000070@c.us", [("сколько стоит вход на троих в будни", "ru")])
+    assert sent[-1] == main.AI_CUT
+    assert main.store.get_history("77000000070@c.us") == []
+    assert main.answers.lookup("сколько стоит вход на троих в будни", "ru") is None
+    llm()
+    main._ask("77000000070@c.us", [("сколько стоит вход на троих в будни", "ru")])
+    assert [m["role"] for m in main.store.get_history("77000000070@c.us")] == ["user", "assistant"]
@@ -1,24 +1,28 @@
 """i18n for the Tsunami bot. Languages: ru, kk (Kazakh), en.
 detect_lang() picks the language from the user's message; for /start we fall
-back to the Telegram app language (lang_from_code).
+back to the Telegram app language (lang_from_code). detect() also returns a
+confidence, so callers can ignore short or ambiguous messages (see the
+language detection section at the bottom).
 """
+import functools
+import itertools
+import math
 import re
 
-_KK = set("әғқңөұүһіӘҒҚҢӨҰҮҺІ")
-
 
 def detect_lang(text):
-    """Return 'ru' / 'kk' / 'en' from text, or None if there's no clear signal."""
-    if not text:
-        return None
-    t = text.lower()
-    if any(c in _KK for c in t):
-        return "kk"
-    if re.search(r"[а-яё]", t):
-        return "ru"
-    if re.search(r"[a-z]", t):
-        return "en"
-    return None
+    """Return 'ru' / 'kk' / 'en' from text, or None if there are no letters."""
+    return detect_lang_lower(text.lower()) if text else None
+
+
+def detect_lang_lower(t):
+    """detect_lang() for text that is already lowercased."""
+    return detect_lower(t)[0]
+
+
+def detect(text):
+    """(lang, confidence 0..1) for text; (None, 0.0) if there are no letters."""
+    return detect_lower(text.lower()) if text else (None, 0.0)
 
 
 def lang_from_code(code):
@@ -155,3 +159,137 @@ def t(lang, key, **kw):
 
 def greet(lang, idx):
     return (GREET.get(lang) or GREET["ru"])[idx]
+
+
+# ----- Language detection -----
+# Text is split on whitespace; each token splits into Cyrillic and Latin letter
+# runs (codepoint range classes; digits, emoji and punctuation drop out). The script with more
+# letters decides which languages compete; Kazakh-only letters in either script
+# settle it as kk. Otherwise character trigrams weigh the languages that share
+# the script: ru vs kk for Cyrillic, en vs ru/kk typed in Latin transliteration.
+# Trigram tables are built at import from the strings above plus a few everyday
+# chat words (_LANG_SEED); token scores are cached, chat vocabulary repeats a lot.
+# Confidence shrinks for short texts and for text mixing both scripts.
+_RUNS = re.compile("[а-яёәғқңөұүһі]+|[a-zäğñöūüış]+")
+_KK_CYR = re.compile("[әғқңөұүһі]")
+_KK_LAT = re.compile("[äğñöūüış]")
+
+_LANG_SEED = {
+    "ru": "привет здравствуйте добрый день сколько стоит вход а можно ли с детьми как к вам доехать где вы "
+          "находитесь когда работаете до скольки открыты сегодня завтра есть свободные места спасибо хорошо "
+          "да нет пожалуйста подскажите хотим прийти компанией человек нужно ли бронировать заранее",
+    "kk": "сәлем сәлеметсіз бе қайырлы күн кіру қанша тұрады балалармен болады ма сіздерге қалай жетуге "
+          "болады қайдасыздар қашан жұмыс істейсіздер нешеге дейін ашықсыздар бүгін ертең бос орын бар ма "
+          "рахмет жақсы иә жоқ өтінемін айтыңызшы достармен келгіміз келеді неше адам алдын ала брондау керек пе",
+    "en": "hello hi good afternoon how much is the entry can we come with kids how do we get to you where are "
+          "you located when are you open until what time today tomorrow are there free spots thanks okay "
+          "yes no please could you tell us we want to come with friends people do we need to book in advance",
+}
+_TRANSLIT = str.maketrans({
+    "а": "a", "ә": "a", "б": "b", "в": "v", "г": "g", "ғ": "gh", "д": "d", "е": "e", "ё": "yo", "ж": "zh",
+    "з": "z", "и": "i", "й": "y", "к": "k", "қ": "q", "л": "l", "м": "m", "н": "n", "ң": "ng", "о": "o",
+    "ө": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ұ": "u", "ү": "u", "ф": "f", "х": "kh",
+    "һ": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "і": "i", "ь": "", "э": "e",
+    "ю": "yu", "я": "ya",
+})
+_TAG = re.compile(r"<[^>]+>|\{\w+\}")
+_MAX_WORDS = 24                                     # score at most this many words of a message
+_MIN_LETTERS = 12                                  # full confidence from this many letters on
+_SMOOTH = 0.5
+_LAT_PRIOR = -3.0                                   # translit profiles are synthetic: English unless clear
+
+
+def _words(lang):
+    parts = list(T[lang].values()) + GREET[lang] + [p[lang] for p in PRIZES] + [_LANG_SEED[lang]]
+    return _RUNS.findall(_TAG.sub(" ", " ".join(parts).lower()))
+
+
+def _trigrams(words):
+    counts = {}
+    for w in words:
+        w = " " + w + " "
+        for g in zip(w, w[1:], w[2:]):
+            counts[g] = counts.get(g, 0) + 1
+    return counts
+
+
+def _log_ratio(a, b):
+    """{trigram: log P_a - log P_b} over trigrams seen in either profile (unseen ones score 0)."""
+    ta, tb = sum(a.values()), sum(b.values())
+    grams = set(a) | set(b)
+    return {g: math.log((a.get(g, 0) + _SMOOTH) / (ta + _SMOOTH * len(grams)))
+            - math.log((b.get(g, 0) + _SMOOTH) / (tb + _SMOOTH * len(grams))) for g in grams}
+
+
+def _build_tables():
+    ru, kk, en = _words("ru"), _words("kk"), _words("en")
+    en_p = _trigrams([w for w in en if w.isascii()])
+    return (_log_ratio(_trigrams(kk), _trigrams(ru)),
+            _log_ratio(_trigrams([w.translate(_TRANSLIT) for w in kk]), en_p),
+            _log_ratio(_trigrams([w.translate(_TRANSLIT) for w in ru]), en_p))
+
+
+_KK_VS_RU, _KKLAT_VS_EN, _RULAT_VS_EN = _build_tables()
+
+
+def _score(table, w):
+    w = " " + w + " "
+    return sum(map(table.get, zip(w, w[1:], w[2:]), itertools.repeat(0.0)))
+
+
+@functools.lru_cache(maxsize=16384)
+def _token(tok):
+    """(cyrillic letters, latin letters, kazakh-only letters, kk-vs-ru, kk-lat-vs-en, ru-lat-vs-en)
+    for one whitespace token ("вход?", "vip-зона", "👍" all work)."""
+    nc = nl = marks = 0
+    cyr = kk = ru = 0.0
+    for w in _RUNS.findall(tok):
+        if w[0] <= "z":
+            nl += len(w)
+            marks += len(_KK_LAT.findall(w))
+            kk += _score(_KKLAT_VS_EN, w)
+            ru += _score(_RULAT_VS_EN, w)
+        else:
+            nc += len(w)
+            marks += len(_KK_CYR.findall(w))
+            cyr += _score(_KK_VS_RU, w)
+    return nc, nl, marks, cyr, kk, ru
+
+
+def _detect(t):
+    nc = nl = marks = 0
+    cyr = kk = ru = 0.0
+    for c, l, m, s, k, r in map(_token, t.split()[:_MAX_WORDS]):    # per-token work is cached: only sums here
+        nc += c
+        nl += l
+        marks += m
+        cyr += s
+        kk += k
+        ru += r
+    n = nc + nl
+    if not n:
+        return None, 0.0
+    scale = (n / _MIN_LETTERS if n < _MIN_LETTERS else 1.0) * (nc if nc > nl else nl) / n
+    if marks:
+        return "kk", (0.7 + 0.3 * min(1.0, n / _MIN_LETTERS)) * (nc if nc > nl else nl) / n
+    if nc >= nl:
+        p = 1.0 / (1.0 + math.exp(-cyr if cyr > -50.0 else 50.0))          # P(kk) over ru
+        return ("kk", p * scale) if p > 0.5 else ("ru", (1.0 - p) * scale)
+    kk += _LAT_PRIOR
+    ru += _LAT_PRIOR
+    top = max(0.0, kk, ru)                          # log-odds against en (0)
+    p = 1.0 / (math.exp(-top) + math.exp(kk - top) + math.exp(ru - top))
+    return ("en" if top == 0.0 else "kk" if kk >= ru else "ru"), p * scale
+
+
+_detect_cached = functools.lru_cache(maxsize=4096)(_detect)
+
+
+def detect_lower(t):
+    """detect() for text that is already lowercased. Recent short texts are cached."""
+    return _detect_cached(t) if len(t) <= 200 else _detect(t)
+
+
+def detect_stats():
+    c = _detect_cached.cache_info()
+    return {"cached": c.currsize, "hits": c.hits, "misses": c.misses}
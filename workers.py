@@ -0,0 +1,134 @@
+"""Background worker pool for the webhook.
+The webhook only validates, dedupes and enqueues; routing, LLM and Green API
+sends run here. Each chat has its own FIFO and at most one task running, so a
+guest's messages are always handled in arrival order; ready chats are served by
+any free worker (like outbox.Outbox), so one slow LLM call holds up only its own
+chat. The queue is bounded: when it is full, submit() returns False and the
+caller pushes back.
+"""
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+WORKERS = int(os.getenv("WORKER_THREADS", "4"))
+QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "200"))     # queued tasks over all chats
+PUT_TIMEOUT = float(os.getenv("WORKER_PUT_TIMEOUT", "0.05"))
+
+
+def _pct(values, p):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+
+class WorkerPool:
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, put_timeout=PUT_TIMEOUT):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.put_timeout = put_timeout
+        self._cv = threading.Condition()
+        self._pending = {}                      # key -> deque[(t_enqueued, fn, args)]
+        self._ready = deque()                   # keys with queued work and nothing running
+        self._queued = self._running = 0
+        self._threads = []
+        self._waits = deque(maxlen=1000)       # seconds spent queued
+        self._runs = deque(maxlen=1000)        # seconds spent handling
+        self.enqueued = self.rejected = self.done = self.failed = 0
+
+    # threads start lazily so the pool is safe to create before a fork
+    def _start(self):
+        with self._cv:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                th = threading.Thread(target=self._loop, name=f"wa-worker-{i}", daemon=True)
+                th.start()
+                self._threads.append(th)
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) behind earlier tasks for `key`. False if the queue is full."""
+        if not self._threads:
+            self._start()
+        deadline = time.monotonic() + self.put_timeout
+        with self._cv:
+            while self._queued >= self.queue_size:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.rejected += 1
+                    return False
+                self._cv.wait(left)
+            q = self._pending.get(key)
+            if q is None:                       # idle chat: nothing queued or running
+                q = self._pending[key] = deque()
+                self._ready.append(key)
+            q.append((time.monotonic(), fn, args))
+            self._queued += 1
+            self.enqueued += 1
+            self._cv.notify_all()
+        return True
+
+    def _next(self):
+        """Block until some chat is ready; pop its oldest task. Lock held."""
+        while not self._ready:
+            self._cv.wait()
+        key = self._ready.popleft()
+        t0, fn, args = self._pending[key].popleft()
+        self._queued -= 1
+        self._running += 1
+        self._cv.notify_all()                   # room for a blocked submit()
+        return key, t0, fn, args
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                key, t0, fn, args = self._next()
+            t1 = time.monotonic()
+            self._waits.append(t1 - t0)
+            ok = False
+            try:
+                fn(*args)
+                ok = True
+            except Exception:
+                print("[WORKER] task failed:"); traceback.print_exc()
+            finally:
+                self._runs.append(time.monotonic() - t1)
+                with self._cv:
+                    if ok:
+                        self.done += 1
+                    else:
+                        self.failed += 1
+                    self._running -= 1
+                    if self._pending[key]:
+                        self._ready.append(key)         # behind chats that waited meanwhile
+                    else:
+                        del self._pending[key]
+                    self._cv.notify_all()
+
+    def depth(self):
+        with self._cv:
+            return self._queued
+
+    def drain(self, timeout=30.0):
+        """Wait until queued work is finished (or timeout). True if fully drained."""
+        deadline = time.monotonic() + timeout
+        with self._cv:
+            while self._queued or self._running:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cv.wait(min(left, 0.05))
+        return True
+
+    def stats(self):
+        waits, runs = list(self._waits), list(self._runs)
+        with self._cv:
+            counts = {"depth": self._queued, "chats": len(self._pending), "running": self._running,
+                      "enqueued": self.enqueued, "rejected": self.rejected, "done": self.done, "failed": self.failed}
+        return {
+            "workers": self.workers, **counts,
+            "wait_p50_ms": round(_pct(waits, 0.5) * 1000, 1), "wait_p99_ms": round(_pct(waits, 0.99) * 1000, 1),
+            "run_p50_ms": round(_pct(runs, 0.5) * 1000, 1), "run_p99_ms": round(_pct(runs, 0.99) * 1000, 1),
+        }